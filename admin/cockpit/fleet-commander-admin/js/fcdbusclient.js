@@ -52,8 +52,8 @@ function FleetCommanderDbusClient(readycb, errorcb) {
         ).fail(errorhandler);
     };
 
-    this.HeartBeat = function (cb) {
-        self._proxy.HeartBeat().done(
+    this.HeartBeat = function (uuid, cb) {
+        self._proxy.HeartBeat(uuid).done(
             function (resp) {
                 cb(resp);
             }
@@ -101,6 +101,22 @@ function FleetCommanderDbusClient(readycb, errorcb) {
         ).fail(errorhandler);
     };
 
+    this.CheckKnownHosts = function (hostnames, cb) {
+        self._proxy.CheckKnownHosts(JSON.stringify(hostnames)).done(
+            function (resp) {
+                cb(JSON.parse(resp));
+            }
+        ).fail(errorhandler);
+    };
+
+    this.AddKnownHosts = function (hosts, cb) {
+        self._proxy.AddKnownHosts(JSON.stringify(hosts)).done(
+            function (resp) {
+                cb(JSON.parse(resp));
+            }
+        ).fail(errorhandler);
+    };
+
     this.InstallPubkey = function (hostname, user, pass, cb) {
         self._proxy.InstallPubkey(hostname, user, pass).done(
             function (resp) {
@@ -142,6 +158,14 @@ function FleetCommanderDbusClient(readycb, errorcb) {
         ).fail(errorhandler);
     };
 
+    this.ValidateApplies = function (applies, cb) {
+        self._proxy.ValidateApplies(JSON.stringify(applies)).done(
+            function (resp) {
+                cb(JSON.parse(resp));
+            }
+        ).fail(errorhandler);
+    };
+
     this.DeleteProfile = function (uid, cb) {
         self._proxy.DeleteProfile(uid).done(
             function (resp) {
@@ -184,8 +208,8 @@ function FleetCommanderDbusClient(readycb, errorcb) {
         ).fail(errorhandler);
     };
 
-    this.SessionStop = function (cb) {
-        self._proxy.SessionStop().done(
+    this.SessionStop = function (uuid, cb) {
+        self._proxy.SessionStop(uuid).done(
             function (resp) {
                 cb(JSON.parse(resp));
             }
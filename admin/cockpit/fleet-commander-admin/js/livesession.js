@@ -465,7 +465,8 @@ function parseFCMsg(str, msg, cb, initial_cb) {
 
 function startHeartBeat() {
     window.setInterval(function () {
-        fc.HeartBeat(resp => {});
+        const session_uuid = sessionStorage.getItem("fc.session.uuid") || '';
+        fc.HeartBeat(session_uuid, resp => {});
     }, 1000);
 }
 
@@ -473,7 +474,9 @@ function stopLiveSession(cb) {
     if (fcsc) {
         fcsc.stop();
     }
-    fc.SessionStop(function () {
+    const session_uuid = sessionStorage.getItem("fc.session.uuid") || '';
+    sessionStorage.removeItem("fc.session.uuid");
+    fc.SessionStop(session_uuid, function () {
         if (typeof cb === 'function') {
             cb();
         } else {
@@ -487,7 +490,8 @@ function reconnectSpice(err) {
         console.log('FC: SPICE connection error:', err.message);
     }
 
-    fc.IsSessionActive('', function (resp) {
+    const session_uuid = sessionStorage.getItem("fc.session.uuid") || '';
+    fc.IsSessionActive(session_uuid, function (resp) {
         if (DEBUG > 0) {
             console.log('FC: Current session active status:', resp);
         }
@@ -533,6 +537,7 @@ function startLiveSession() {
         const domain = sessionStorage.getItem("fc.session.domain");
         fc.SessionStart(domain, function (resp) {
             if (resp.status) {
+                sessionStorage.setItem("fc.session.uuid", resp.uuid);
                 const conn_details = resp.connection_details;
                 const viewers = {
                     spice_html5: startSpiceHtml5,
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+# vi:ts=4 sw=4 sts=4
+
+# Copyright (C) 2021 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the licence, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program; if not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import
+import logging
+from functools import wraps
+
+logger = logging.getLogger(__name__)
+
+
+def connection_required(f=None, retry=True):
+    """
+    Decorator for connector methods needing a connection.
+
+    Decorated methods connect first. When the connection is lost with any of
+    the connector errors, connector reconnects and the call is run again.
+    Methods decorated with retry=False are not run again, as writes could
+    have been applied already, and the error is raised once reconnected.
+
+    Connectors must provide connect(), disconnect(), _connection_used() and
+    _connection_errors() methods, an _in_call attribute and a stats dict with
+    a reconnects counter
+    """
+    if f is None:
+        return lambda f: connection_required(f, retry=retry)
+
+    @wraps(f)
+    def wrapped(obj, *args, **kwargs):
+        obj.connect()
+        # Only outermost call retries, as nested calls share the connection
+        outermost = not obj._in_call
+        obj._in_call = True
+        try:
+            result = f(obj, *args, **kwargs)
+        except obj._connection_errors() as e:
+            obj.disconnect()
+            if not outermost:
+                raise
+            logger.warning(
+                "%s: Connection lost. Reconnecting: %s", type(obj).__name__, e
+            )
+            obj.stats["reconnects"] += 1
+            obj.connect()
+            if not retry:
+                raise
+            try:
+                result = f(obj, *args, **kwargs)
+            except obj._connection_errors():
+                obj.disconnect()
+                raise
+        finally:
+            if outermost:
+                obj._in_call = False
+        obj._connection_used()
+        return result
+
+    return wrapped
@@ -23,7 +23,7 @@ from __future__ import absolute_import
 import sqlite3
 import json
 
-SCHEMA_VERSION = 1.1
+SCHEMA_VERSION = 1.2
 
 
 class SQLiteDict:
@@ -181,6 +181,10 @@ class ConfigValues(SQLiteDict):
         del self["tunnel_pid"]
         del self["keys"]
 
+        # remove old single live session data, now kept in sessions table
+        del self["uuid"]
+        del self["connection_details"]
+
         super().update_schema()
 
 
@@ -192,6 +196,22 @@ class ProfilesData(SQLiteDict):
     TABLE_NAME = "profiles"
 
 
+class SessionsData(SQLiteDict):
+    """
+    Live sessions database handler
+    """
+
+    TABLE_NAME = "sessions"
+
+
+class PoolData(SQLiteDict):
+    """
+    Pre-started session domains pool database handler
+    """
+
+    TABLE_NAME = "pool"
+
+
 class BaseDBManager:
     """
     Database manager class
@@ -240,3 +260,7 @@ class DBManager(BaseDBManager):
         self.config = ConfigValues(self)
         # Profiles
         self.profiles = ProfilesData(self)
+        # Live sessions
+        self.sessions = SessionsData(self)
+        # Pre-started session domains
+        self.pool = PoolData(self)
@@ -19,30 +19,39 @@
 # Authors: Oliver Gutiérrez <ogutierrez@redhat.com>
 #          Alberto Ruiz <aruiz@redhat.com>
 
-import os
 import json
 import logging
+import re
 import uuid
 import getpass
-import tempfile
+import hashlib
+import random
+import socket
+import threading
+import time
 import optparse  # pylint: disable=deprecated-module
 
-from functools import wraps
+from concurrent.futures import ThreadPoolExecutor
 
+import dns.exception
 import dns.resolver
 
 import ldap
 import ldap.sasl
 import ldap.modlist
+from ldap.controls import SimplePagedResultsControl
 
 import samba
 import samba.getopt as options
+from samba import ntstatus
 from samba.credentials import Credentials, MUST_USE_KERBEROS
 from samba.ndr import ndr_unpack, ndr_pack
 from samba.dcerpc import security
 from samba.ntacls import dsacl2fsacl
 from samba.samba3 import param as s3param
 
+from .connection import connection_required
+
 logger = logging.getLogger(__name__)
 
 try:
@@ -54,6 +63,25 @@ except ImportError:
 GPO_SMB_PATH = "\\\\%s\\SysVol\\%s\\Policies\\%s"
 SMB_DIRECTORY_PATH = "smb://%s/SysVol/%s/Policies/%s"
 
+# Errors meaning a pooled SMB connection is no longer usable
+SMB_CONNECTION_ERRORS = (
+    ntstatus.NT_STATUS_CONNECTION_DISCONNECTED,
+    ntstatus.NT_STATUS_CONNECTION_RESET,
+    ntstatus.NT_STATUS_NETWORK_NAME_DELETED,
+    ntstatus.NT_STATUS_PIPE_BROKEN,
+    ntstatus.NT_STATUS_IO_TIMEOUT,
+    # Expired Kerberos authenticated sessions
+    ntstatus.NT_STATUS_NETWORK_SESSION_EXPIRED,
+    ntstatus.NT_STATUS_USER_SESSION_DELETED,
+    ntstatus.NT_STATUS_INVALID_HANDLE,
+)
+
+# Errors meaning a file or its directory does not exist
+SMB_NOT_FOUND_ERRORS = (
+    ntstatus.NT_STATUS_OBJECT_NAME_NOT_FOUND,
+    ntstatus.NT_STATUS_OBJECT_PATH_NOT_FOUND,
+)
+
 GPO_APPLY_GROUP_POLICY_CAR = "edacfd8f-ffb3-11d1-b41d-00a0c968f939"
 
 FC_PROFILE_PREFIX = "_FC_%s"
@@ -104,13 +132,17 @@ GPO_DACL_ACCESS_ACE = "(A;CI;RPLCRC;;;%s)"
 DEFAULT_PROFILE_JSON_DATA = json.dumps({"priority": 50, "settings": {}})
 
 
-def connection_required(f):
-    @wraps(f)
-    def wrapped(obj, *args, **kwargs):
-        obj.connect()
-        return f(obj, *args, **kwargs)
+# SDDL tokens: section headers with their owner, group or flags value, and
+# ACEs, which may hold a resource attribute or condition between parenthesis
+SDDL_TOKEN_REGEX = re.compile(
+    r"([OGDS]):([^():]*?)(?=[OGDS]:|\(|$)|\(([^()]*(?:\([^()]*\)[^()]*)*)\)"
+)
+
 
-    return wrapped
+def _to_str(value):
+    if isinstance(value, bytes):
+        return value.decode()
+    return value
 
 
 class ADConnector:
@@ -119,7 +151,47 @@ class ADConnector:
     """
 
     CACHED_DOMAIN_DN = None
-    CACHED_SERVER_NAME = None
+
+    # Seconds to wait for domain controllers to accept connections
+    CONNECT_TIMEOUT = 5
+    # Seconds a failed domain controller is skipped
+    SERVER_RETRY_INTERVAL = 300
+    # Seconds DNS SRV results are kept when their TTL is missing or too short
+    MIN_SRV_TTL = 60
+    # Maximum number of domain controllers probed for latency
+    MAX_PROBED_SERVERS = 8
+
+    # Seconds a connection is trusted after its last successful use
+    HEALTH_CHECK_INTERVAL = 60
+
+    # Seconds SID and name resolutions are cached
+    SID_CACHE_TTL = 300
+    # Maximum number of ORed terms in each search filter
+    LOOKUP_CHUNK_SIZE = 100
+    # Entries per page in paged searches. Below default AD MaxPageSize
+    SEARCH_PAGE_SIZE = 500
+
+    # Seconds a pooled SMB connection is used before opening a new one
+    SMB_CONNECTION_MAX_AGE = 600
+
+    # SMB connections by server and service as (expiration time, connection)
+    # tuples, and Samba configuration, are shared by the whole process
+    _smb_lock = threading.Lock()
+    _smb_loadparm = None
+    _smb_connections = {}
+
+    # Domain controllers by domain as (expiration time, servers) tuples, and
+    # domain controller health, are shared by the whole process
+    _dc_lock = threading.Lock()
+    _srv_cache = {}
+    _dc_health = {}
+
+    # Search base and name key by principal object class
+    PRINCIPAL_SEARCHES = {
+        "user": ("CN=Users,%s", "username"),
+        "group": ("%s", "groupname"),
+        "computer": ("CN=Computers,%s", "hostname"),
+    }
 
     def __init__(self, domain):
         logger.debug("Initializing domain %s AD connector", domain)
@@ -133,34 +205,208 @@ class ADConnector:
             % dn,
         }
         self.connection = None
+        self._server_name = None
+        self._server_expires = None
+        self._in_call = False
+        self._last_used = None
+        self.stats = {
+            "binds": 0,
+            "reconnects": 0,
+            "health_checks": 0,
+            "smb_connects": 0,
+            "smb_writes": 0,
+        }
+        # Resolution caches holding (expiration time, object) tuples
+        self._sid_cache = {}
+        self._name_cache = {}
+        self._domain_sid = None
 
     def _get_domain_dn(self):
         if self.CACHED_DOMAIN_DN is None:
             self.CACHED_DOMAIN_DN = "DC=%s" % ",DC=".join(self.domain.split("."))
         return self.CACHED_DOMAIN_DN
 
-    def _get_server_name(self):
-        logger.debug("Getting LDAP service machine name")
-        # Resolve LDAP service machine
-        if self.CACHED_SERVER_NAME is None:
+    @staticmethod
+    def _sort_srv_records(records):
+        """
+        Order (priority, weight, host, port) SRV records by priority, and
+        randomly by weight for same priority servers as in RFC 2782
+        """
+        ordered = []
+        for priority in sorted({record[0] for record in records}):
+            group = [record for record in records if record[0] == priority]
+            while group:
+                weights = [record[1] for record in group]
+                if not any(weights):
+                    ordered.extend(group)
+                    break
+                record = random.choices(group, weights)[0]
+                group.remove(record)
+                ordered.append(record)
+        return ordered
+
+    def _get_servers(self):
+        """
+        Get domain controllers as ordered (priority, weight, host, port) SRV
+        records from DNS
+        """
+        now = time.monotonic()
+        with self._dc_lock:
+            cached = self._srv_cache.get(self.domain)
+        if cached is not None and cached[0] > now:
+            return cached[1]
+
+        logger.debug("Resolving LDAP service machines")
+        try:
             result = dns.resolver.query(
                 "_ldap._tcp.dc._msdcs.%s" % self.domain.lower(), "SRV"
             )
-            self.CACHED_SERVER_NAME = str(result[0].target)[:-1]
-        logger.debug("LDAP server: %s", self.CACHED_SERVER_NAME)
-        return self.CACHED_SERVER_NAME
+        except dns.exception.DNSException as e:
+            if cached is None:
+                raise
+            # Keep using known servers until DNS is back
+            logger.warning("Error resolving LDAP service machines: %s", e)
+            ttl = self.MIN_SRV_TTL
+            servers = cached[1]
+        else:
+            ttl = max(result.rrset.ttl, self.MIN_SRV_TTL)
+            servers = self._sort_srv_records(
+                [
+                    (r.priority, r.weight, str(r.target).rstrip("."), r.port)
+                    for r in result
+                ]
+            )
+        logger.debug("LDAP service machines: %s", servers)
+        with self._dc_lock:
+            self._srv_cache[self.domain] = (now + ttl, servers)
+        return servers
+
+    def _get_server_health(self, host):
+        # Needs _dc_lock held
+        return self._dc_health.setdefault(
+            host, {"connects": 0, "failures": 0, "latency": None, "down_until": 0}
+        )
+
+    def _probe_server(self, host, port):
+        """
+        Measure time to open a TCP connection to server, or None if unreachable
+        """
+        started = time.monotonic()
+        try:
+            socket.create_connection((host, port), self.CONNECT_TIMEOUT).close()
+        except OSError as e:
+            logger.debug("Domain controller %s:%s unreachable: %s", host, port, e)
+            return None
+        return time.monotonic() - started
+
+    def _select_server(self, servers):
+        """
+        Select fastest reachable domain controller among available ones with
+        the best priority
+        """
+        now = time.monotonic()
+        with self._dc_lock:
+            available = [
+                server
+                for server in servers
+                if self._get_server_health(server[2])["down_until"] <= now
+            ]
+        # When every server failed, try them all again
+        candidates = (available or servers)[: self.MAX_PROBED_SERVERS]
+        if len(candidates) == 1:
+            return candidates[0][2]
+
+        with ThreadPoolExecutor(max_workers=len(candidates)) as executor:
+            latencies = list(
+                executor.map(
+                    self._probe_server,
+                    [host for _p, _w, host, _port in candidates],
+                    [port for _p, _w, _host, port in candidates],
+                )
+            )
+        reachable = []
+        with self._dc_lock:
+            for index, (server, latency) in enumerate(zip(candidates, latencies)):
+                priority, _weight, host, _port = server
+                health = self._get_server_health(host)
+                health["latency"] = latency
+                if latency is None:
+                    health["failures"] += 1
+                    health["down_until"] = now + self.SERVER_RETRY_INTERVAL
+                else:
+                    reachable.append((priority, latency, index, host))
+        if not reachable:
+            # Let the connection itself report the error
+            return candidates[0][2]
+        return min(reachable)[3]
+
+    def _get_server_name(self):
+        if self._server_name is None or time.monotonic() >= self._server_expires:
+            logger.debug("Getting LDAP service machine name")
+            servers = self._get_servers()
+            self._server_name = self._select_server(servers)
+            with self._dc_lock:
+                self._server_expires = self._srv_cache[self.domain][0]
+            logger.debug("LDAP server: %s", self._server_name)
+        return self._server_name
+
+    def _server_failed(self, host, error):
+        """
+        Mark domain controller as failed so next one is used
+        """
+        logger.warning("Domain controller %s failed: %s", host, error)
+        with self._dc_lock:
+            health = self._get_server_health(host)
+            health["failures"] += 1
+            health["down_until"] = time.monotonic() + self.SERVER_RETRY_INTERVAL
+        with self._smb_lock:
+            for key in list(self._smb_connections):
+                if key[0] == host:
+                    del self._smb_connections[key]
+        if self._server_name == host:
+            self._server_name = None
+
+    def get_server_stats(self):
+        """
+        Get health statistics of known domain controllers
+        """
+        with self._dc_lock:
+            return {
+                host: {k: v for k, v in health.items() if k != "down_until"}
+                for host, health in self._dc_health.items()
+            }
 
     def _generate_gpo_uuid(self):
         return "{%s}" % str(uuid.uuid4()).upper()
 
+    @classmethod
+    def _get_smb_loadparm(cls):
+        with cls._smb_lock:
+            if cls._smb_loadparm is None:
+                # Create options like if we were using command line
+                parser = optparse.OptionParser()
+                sambaopts = options.SambaOptions(parser)
+                # Samba options
+                parm = sambaopts.get_loadparm()
+                s3_lp = s3param.get_context()
+                s3_lp.load(parm.configfile)
+                cls._smb_loadparm = parm
+            return cls._smb_loadparm
+
     def _get_smb_connection(self, service="SysVol"):
-        # Create options like if we were using command line
-        parser = optparse.OptionParser()
-        sambaopts = options.SambaOptions(parser)
-        # Samba options
-        parm = sambaopts.get_loadparm()
-        s3_lp = s3param.get_context()
-        s3_lp.load(parm.configfile)
+        key = (self._get_server_name(), service)
+        now = time.monotonic()
+        with self._smb_lock:
+            # Connections close once dropped. Expired ones are dropped here,
+            # including those to servers not used anymore
+            for pooled_key, (expires, _conn) in list(self._smb_connections.items()):
+                if expires <= now:
+                    del self._smb_connections[pooled_key]
+            _expires, conn = self._smb_connections.get(key, (None, None))
+        if conn is not None:
+            return conn
+
+        parm = self._get_smb_loadparm()
         # Build credentials from credential options
         creds = Credentials()
         # Credentials need username and realm to be not empty strings to work
@@ -169,93 +415,103 @@ class ADConnector:
         # Connect to SMB using kerberos
         creds.set_kerberos_state(MUST_USE_KERBEROS)
         # Create connection
-        conn = libsmb.Conn(self._get_server_name(), service, lp=parm, creds=creds)
+        logger.debug("Opening SMB connection to \\\\%s\\%s", *key)
+        conn = libsmb.Conn(key[0], service, lp=parm, creds=creds)
+        self.stats["smb_connects"] += 1
+        with self._smb_lock:
+            self._smb_connections[key] = (
+                time.monotonic() + self.SMB_CONNECTION_MAX_AGE,
+                conn,
+            )
         return conn
 
+    def _drop_smb_connection(self, service="SysVol"):
+        key = (self._get_server_name(), service)
+        with self._smb_lock:
+            self._smb_connections.pop(key, None)
+
+    def _smb_call(self, func, service="SysVol"):
+        """
+        Run func with a pooled SMB connection, reconnecting once if the
+        server closed it
+        """
+        try:
+            return func(self._get_smb_connection(service))
+        except samba.NTSTATUSError as e:
+            if e.args[0] not in SMB_CONNECTION_ERRORS:
+                raise
+            logger.debug("SMB connection lost. Reconnecting: %s", e)
+            self._drop_smb_connection(service)
+            return func(self._get_smb_connection(service))
+
     def _load_smb_data(self, gpo_uuid):
-        conn = self._get_smb_connection()
         furi = "%s\\Policies\\%s\\fleet-commander.json" % (self.domain, gpo_uuid)
-        data = json.loads(conn.loadfile(furi))
+        data = json.loads(self._smb_call(lambda conn: conn.loadfile(furi)))
         return data
 
     def _prepare_gpo_data(self, profile):
-        # Create GPO data locally in a temporary directory
-        logger.debug("Preparing GPO data locally")
-        gpodir = tempfile.mkdtemp()
-        # Machine and user directories
-        os.mkdir(os.path.join(gpodir, "Machine"))
-        os.mkdir(os.path.join(gpodir, "User"))
-        # GPT file
-        gpt_contents = "[General]\r\nVersion=0\r\n"
-        with open(os.path.join(gpodir, "GPT.INI"), "w", encoding="utf-8") as fd:
-            fd.write(gpt_contents)
-
-        with open(
-            os.path.join(gpodir, "fleet-commander.json"), "w", encoding="utf-8"
-        ) as fd:
-            fd.write(
-                json.dumps(
-                    {
-                        "priority": profile["priority"],
-                        "settings": profile["settings"],
-                    }
-                )
-            )
-        return gpodir
-
-    def _copy_directory_local_to_remote(
-        self, conn, localdir, remotedir, ignore_existing=False
-    ):
-        """
-        Copied from Samba netcmd GPO code
-        """
-        logger.debug("Copying GPO from %s to %s", localdir, remotedir)
-        if not conn.chkpath(remotedir):
-            conn.mkdir(remotedir)
-        l_dirs = [localdir]
-        r_dirs = [remotedir]
-        while l_dirs:
-            l_dir = l_dirs.pop()
-            r_dir = r_dirs.pop()
-
-            dirlist = os.listdir(l_dir)
-            dirlist.sort()
-            for e in dirlist:
-                l_name = os.path.join(l_dir, e)
-                r_name = r_dir + "\\" + e
-
-                if os.path.isdir(l_name):
-                    l_dirs.append(l_name)
-                    r_dirs.append(r_name)
-                    try:
-                        conn.mkdir(r_name)
-                    except samba.NTSTATUSError:
-                        if not ignore_existing:
-                            raise
-                else:
-                    with open(l_name, "rb") as fd:
-                        data = fd.read()
+        """
+        Build GPO contents as a manifest of relative paths to file contents.
+        Directories have no contents
+        """
+        logger.debug("Preparing GPO data")
+        settings = json.dumps(
+            {
+                "priority": profile["priority"],
+                "settings": profile["settings"],
+            }
+        )
+        return {
+            # Machine and user directories
+            "Machine": None,
+            "User": None,
+            # GPT file
+            "GPT.INI": b"[General]\r\nVersion=0\r\n",
+            "fleet-commander.json": settings.encode(),
+        }
 
-                    conn.savefile(r_name, data)
+    def _write_gpo_data(self, conn, remotedir, manifest):
+        """
+        Write GPO manifest into remote directory, skipping existing directories
+        and files whose remote contents are unchanged
+        """
+        logger.debug("Writing GPO data to %s", remotedir)
+        for name, data in manifest.items():
+            r_name = remotedir + "\\" + name.replace("/", "\\")
+            if data is None:
+                if not conn.chkpath(r_name):
+                    conn.mkdir(r_name)
+                continue
+            try:
+                current = hashlib.sha256(conn.loadfile(r_name)).digest()
+            except samba.NTSTATUSError as e:
+                if e.args[0] not in SMB_NOT_FOUND_ERRORS:
+                    raise
+                current = None
+            if current == hashlib.sha256(data).digest():
+                logger.debug("%s is unchanged", r_name)
+                continue
+            conn.savefile(r_name, data)
+            self.stats["smb_writes"] += 1
 
     def _save_smb_data(self, gpo_uuid, profile, sddl=None):
         logger.debug("Saving profile settings in CIFs share")
 
-        # Prepare GPO data locally
-        gpodir = self._prepare_gpo_data(profile)
-
-        conn = self._get_smb_connection()
+        manifest = self._prepare_gpo_data(profile)
 
         # Create remote directory
         duri = "%s\\Policies\\%s" % (self.domain, gpo_uuid)
-        logger.debug("Creating directory %s", duri)
-        if not conn.chkpath(duri):
-            conn.mkdir(duri)
-        # Check if we need to set ACLs
-        if sddl is not None:
-            self._set_smb_permissions(conn, duri, sddl)
-        # Copy local data to remote directory
-        self._copy_directory_local_to_remote(conn, gpodir, duri, True)
+
+        def save(conn):
+            logger.debug("Creating directory %s", duri)
+            if not conn.chkpath(duri):
+                conn.mkdir(duri)
+            # Check if we need to set ACLs
+            if sddl is not None:
+                self._set_smb_permissions(conn, duri, sddl)
+            self._write_gpo_data(conn, duri, manifest)
+
+        self._smb_call(save)
 
     def _set_smb_permissions(self, conn, duri, sddl):
         logger.debug("Setting CIFs permissions for %s", duri)
@@ -274,16 +530,15 @@ class ADConnector:
 
     def _remove_smb_data(self, gpo_uuid):
         logger.debug("Removing CIFs data for GPO %s", gpo_uuid)
-        # Connect to SMB using kerberos
-        conn = self._get_smb_connection()
         # Remove directory and its contents
-        duri = duri = "%s\\Policies\\%s" % (self.domain, gpo_uuid)
-        conn.deltree(duri)
+        duri = "%s\\Policies\\%s" % (self.domain, gpo_uuid)
+        self._smb_call(lambda conn: conn.deltree(duri))
 
-    def _get_ldap_profile_data(self, s_filter, controls=None):
+    def _get_ldap_profile_data(self, s_filter, controls=None, attrs=None):
         logger.debug("Getting data from AD LDAP. filter: %s", s_filter)
         base_dn = "CN=Policies,CN=System,%s" % self._get_domain_dn()
-        attrs = ["cn", "displayName", "description", "nTSecurityDescriptor"]
+        if attrs is None:
+            attrs = ["cn", "displayName", "description", "nTSecurityDescriptor"]
         resultlist = self.connection.search_s(
             base_dn, ldap.SCOPE_SUBTREE, s_filter, attrs
         )
@@ -315,33 +570,23 @@ class ADConnector:
     def _security_descriptor_from_profile(self, profile):
         # Security descriptor
         current_user = getpass.getuser().split("@")[0]
-        current_user_sid = self.get_user(current_user)["sid"]
+        users = self.get_users([current_user] + list(profile["users"]))
+        current_user_sid = users[current_user]["sid"]
         gpo_aces = ""
         gpo_access_aces = ""
 
-        for user in profile["users"]:
-            obj = self.get_user(user)
-            if obj is not None:
-                gpo_aces += GPO_DACL_ACE % obj["sid"]
-                gpo_access_aces += GPO_DACL_ACCESS_ACE % obj["sid"]
-            else:
-                logger.warning("User %s does not exist. Ignoring.", user)
-
-        for group in profile["groups"]:
-            obj = self.get_group(group)
-            if obj is not None:
-                gpo_aces += GPO_DACL_ACE % obj["sid"]
-                gpo_access_aces += GPO_DACL_ACCESS_ACE % obj["sid"]
-            else:
-                logger.warning("Group %s does not exist. Ignoring.", group)
-
-        for host in profile["hosts"]:
-            obj = self.get_host(host)
-            if obj is not None:
-                gpo_aces += GPO_DACL_ACE % obj["sid"]
-                gpo_access_aces += GPO_DACL_ACCESS_ACE % obj["sid"]
-            else:
-                logger.warning("Host %s does not exist. Ignoring.", host)
+        for kind, names, objects in (
+            ("User", profile["users"], users),
+            ("Group", profile["groups"], self.get_groups(profile["groups"])),
+            ("Host", profile["hosts"], self.get_hosts(profile["hosts"])),
+        ):
+            for name in names:
+                obj = objects.get(name)
+                if obj is not None:
+                    gpo_aces += GPO_DACL_ACE % obj["sid"]
+                    gpo_access_aces += GPO_DACL_ACCESS_ACE % obj["sid"]
+                else:
+                    logger.warning("%s %s does not exist. Ignoring.", kind, name)
 
         shd = SecurityDescriptorHelper(
             DEFAULT_GPO_SECURITY_DESCRIPTOR
@@ -350,21 +595,82 @@ class ADConnector:
         )
         return shd.to_sd()
 
-    def connect(self, sanity_check=True):
+    def _check_connection(self):
         """
-        Connect to AD server
+        Check LDAP connection is still usable
         """
-        # TODO: Check LDAP connection to avoid binding every time
-        logger.debug("Connecting to AD LDAP server")
-        server_name = self._get_server_name()
+        self.stats["health_checks"] += 1
+        try:
+            self.connection.whoami_s()
+        except ldap.LDAPError as e:
+            logger.debug("LDAP connection check failed: %s", e)
+            return False
+        self._last_used = time.monotonic()
+        return True
+
+    def _connection_used(self):
+        self._last_used = time.monotonic()
+
+    @staticmethod
+    def _connection_errors():
+        return (ldap.SERVER_DOWN,)
+
+    def disconnect(self):
+        """
+        Close LDAP connection
+        """
+        if self.connection is not None:
+            try:
+                self.connection.unbind_s()
+            except ldap.LDAPError as e:
+                logger.debug("Error closing LDAP connection: %s", e)
+            self.connection = None
+
+    def _bind(self, server_name):
         # Connect to LDAP using Kerberos
         logger.debug("Initializing LDAP connection to %s", server_name)
-        self.connection = ldap.initialize("ldap://%s" % server_name)
-        self.connection.set_option(ldap.OPT_REFERRALS, 0)
+        connection = ldap.initialize("ldap://%s" % server_name)
+        connection.set_option(ldap.OPT_REFERRALS, 0)
+        connection.set_option(ldap.OPT_NETWORK_TIMEOUT, self.CONNECT_TIMEOUT)
         sasl_auth = ldap.sasl.sasl({}, "GSSAPI")
-        self.connection.protocol_version = 3
+        connection.protocol_version = 3
         logger.debug("Binding LDAP connection")
-        self.connection.sasl_interactive_bind_s("", sasl_auth)
+        connection.sasl_interactive_bind_s("", sasl_auth)
+        return connection
+
+    def connect(self, sanity_check=True):
+        """
+        Connect to AD server
+        """
+        if self.connection is not None:
+            # Reuse bound connection
+            if time.monotonic() - self._last_used < self.HEALTH_CHECK_INTERVAL:
+                return
+            if self._check_connection():
+                return
+            logger.debug("LDAP connection is not usable. Reconnecting")
+            self.stats["reconnects"] += 1
+            self.disconnect()
+        logger.debug("Connecting to AD LDAP server")
+        failed = set()
+        while True:
+            server_name = self._get_server_name()
+            try:
+                connection = self._bind(server_name)
+                break
+            except ldap.SERVER_DOWN as e:
+                # Fail over to next domain controller
+                self._server_failed(server_name, e)
+                failed.add(server_name)
+                if self._get_server_name() in failed:
+                    raise
+        with self._dc_lock:
+            self._get_server_health(server_name)["connects"] += 1
+        # Keep connection only once bound
+        self.connection = connection
+        self._domain_sid = None
+        self.stats["binds"] += 1
+        self._last_used = time.monotonic()
         logger.debug("LDAP connection succesful")
 
     @connection_required
@@ -379,7 +685,7 @@ class ADConnector:
             return profile["settings"][FC_GLOBAL_POLICY_NS]["global_policy"]
         return FC_GLOBAL_POLICY_DEFAULT
 
-    @connection_required
+    @connection_required(retry=False)
     def set_global_policy(self, policy):
         ldap_filter = "(displayName=%s)" % (
             FC_PROFILE_PREFIX % FC_GLOBAL_POLICY_PROFILE_NAME
@@ -392,44 +698,52 @@ class ADConnector:
         profile["settings"][FC_GLOBAL_POLICY_NS]["global_policy"] = policy
         self.save_profile(profile)
 
-    @connection_required
+    @connection_required(retry=False)
     def save_profile(self, profile):
-        # Check if profile exists
+        # Check if profile exists, getting only the attributes to compare.
+        # Settings and applies are not loaded
         cn = profile.get("cn", None)
-        # Check if profile exists
-        old_profile = None
+        old_profile_data = None
         if cn is not None:
             ldap_filter = "(CN=%s)" % cn
-            old_profile_data = self._get_ldap_profile_data(ldap_filter)
-            if old_profile_data:
-                old_profile = self._data_to_profile(old_profile_data)
-        if old_profile is not None:
+            old_profile_data = self._get_ldap_profile_data(
+                ldap_filter,
+                attrs=["displayName", "description", "nTSecurityDescriptor"],
+            )
+        if old_profile_data:
             logger.debug("Profile with cn %s already exists. Modifying", cn)
-            logger.debug("Old profile: %s", old_profile)
             logger.debug("New profile: %s", profile)
-            # Modify existing profile
+            # Modify only changed attributes of existing profile
             sd = self._security_descriptor_from_profile(profile)
             gpo_uuid = profile["cn"]
-            ldif = [
-                (
-                    ldap.MOD_REPLACE,
-                    "displayName",
-                    (FC_PROFILE_PREFIX % profile["name"]).encode(),
-                ),
-                (ldap.MOD_REPLACE, "nTSecurityDescriptor", ndr_pack(sd)),
-            ]
-            if profile["description"]:
-                ldif.append(
-                    (ldap.MOD_REPLACE, "description", profile["description"].encode())
+            ldif = []
+            display_name = (FC_PROFILE_PREFIX % profile["name"]).encode()
+            if old_profile_data.get("displayName", (None,))[0] != display_name:
+                ldif.append((ldap.MOD_REPLACE, "displayName", display_name))
+            # Server adds inherited ACEs, so compare only explicit security
+            old_sdh = SecurityDescriptorHelper(
+                old_profile_data["nTSecurityDescriptor"][0], self
+            )
+            new_sdh = SecurityDescriptorHelper(sd, self)
+            sd_changed = (
+                old_sdh.get_explicit_security() != new_sdh.get_explicit_security()
+            )
+            if sd_changed:
+                ldif.append((ldap.MOD_REPLACE, "nTSecurityDescriptor", ndr_pack(sd)))
+            description = profile["description"].encode() or None
+            if old_profile_data.get("description", (None,))[0] != description:
+                ldif.append((ldap.MOD_REPLACE, "description", description))
+
+            if ldif:
+                logger.debug("LDIF data to be sent to LDAP: %s", ldif)
+                dn = "CN=%s,CN=Policies,CN=System,%s" % (
+                    gpo_uuid,
+                    self._get_domain_dn(),
                 )
-            else:
-                ldif.append((ldap.MOD_REPLACE, "description", None))
-
-            logger.debug("LDIF data to be sent to LDAP: %s", ldif)
-            dn = "CN=%s,CN=Policies,CN=System,%s" % (gpo_uuid, self._get_domain_dn())
-            logger.debug("Modifying profile under %s", dn)
-            self.connection.modify_s(dn, ldif)
-            self._save_smb_data(gpo_uuid, profile, sd.as_sddl())
+                logger.debug("Modifying profile under %s", dn)
+                self.connection.modify_s(dn, ldif)
+            # Share permissions only change along with the security descriptor
+            self._save_smb_data(gpo_uuid, profile, sd.as_sddl() if sd_changed else None)
         else:
             logger.debug("Saving new profile")
             # Create new profile
@@ -455,7 +769,7 @@ class ADConnector:
             self._save_smb_data(gpo_uuid, profile, sd.as_sddl())
         return gpo_uuid
 
-    @connection_required
+    @connection_required(retry=False)
     def del_profile(self, name):
         dn = "CN=%s,CN=Policies,CN=System,%s" % (name, self._get_domain_dn())
         try:
@@ -465,29 +779,68 @@ class ADConnector:
         # Remove samba files
         self._remove_smb_data(name)
 
+    def _paged_search(self, base_dn, scope, s_filter, attrs):
+        """
+        Iterate over search results, retrieved in pages so server size
+        limits do not truncate them
+        """
+        control = SimplePagedResultsControl(True, size=self.SEARCH_PAGE_SIZE, cookie="")
+        while True:
+            try:
+                msgid = self.connection.search_ext(
+                    base_dn, scope, s_filter, attrs, serverctrls=[control]
+                )
+                _rtype, resultlist, _msgid, serverctrls = self.connection.result3(msgid)
+            except ldap.SERVER_DOWN:
+                # Iteration happens out of connection_required, so make next
+                # call reconnect
+                self.disconnect()
+                raise
+            for dn, data in resultlist:
+                # Skip referrals
+                if dn is not None:
+                    yield dn, data
+            cookies = [
+                c.cookie
+                for c in serverctrls
+                if c.controlType == SimplePagedResultsControl.controlType
+            ]
+            if not cookies or not cookies[0]:
+                return
+            control.cookie = cookies[0]
+
     @connection_required
     def get_profiles(self):
-        profiles = []
+        """
+        Iterate over profiles as (cn, name, description) tuples
+        """
+        # Decorator only connects, as results are fetched while iterating.
+        # Enumeration is not retried if connection is lost, as some results
+        # may have been consumed already
+        return self._iter_profiles()
+
+    def _iter_profiles(self):
         base_dn = "CN=Policies,CN=System,%s" % self._get_domain_dn()
-        s_filter = "(objectclass=groupPolicyContainer)"
+        # Let the server filter out other GPOs and the global policy
+        s_filter = (
+            "(&(objectclass=groupPolicyContainer)(displayName=%s*)(!(displayName=%s)))"
+            % (
+                FC_PROFILE_PREFIX % "",
+                FC_PROFILE_PREFIX % FC_GLOBAL_POLICY_PROFILE_NAME,
+            )
+        )
         attrs = [
             "cn",
             "displayName",
             "description",
         ]
-        resultlist = self.connection.search_s(
+        for _dn, resdata in self._paged_search(
             base_dn, ldap.SCOPE_SUBTREE, s_filter, attrs
-        )
-        for res in resultlist:
-            resdata = res[1]
-            if resdata:
-                cn = resdata["cn"][0].decode()
-                name = resdata.get("displayName", (cn,))[0].decode()
-                pname = FC_PROFILE_PREFIX % FC_GLOBAL_POLICY_PROFILE_NAME
-                if name.startswith(FC_PROFILE_PREFIX[:-2]) and name != pname:
-                    desc = resdata.get("description", (b"",))[0].decode()
-                    profiles.append((cn, name[len(FC_PROFILE_PREFIX) - 2 :], desc))
-        return profiles
+        ):
+            cn = resdata["cn"][0].decode()
+            name = resdata["displayName"][0].decode()
+            desc = resdata.get("description", (b"",))[0].decode()
+            yield (cn, name[len(FC_PROFILE_PREFIX) - 2 :], desc)
 
     @connection_required
     def get_profile(self, cn):
@@ -498,85 +851,202 @@ class ADConnector:
             return self._data_to_profile(data)
         return None
 
+    @connection_required
+    def load_profiles(self, cns):
+        """
+        Load several profiles at once. Returns a dictionary with found profiles
+        """
+        base_dn = "CN=Policies,CN=System,%s" % self._get_domain_dn()
+        attrs = ["cn", "displayName", "description", "nTSecurityDescriptor"]
+        resultlist = self._search_chunks(base_dn, "%s", "CN", cns, attrs)
+        # Resolve principals of all profiles in one go
+        sids = set()
+        for _dn, data in resultlist:
+            sdh = SecurityDescriptorHelper(data["nTSecurityDescriptor"][0], self)
+            sids.update(
+                ace.account_sid
+                for ace in sdh.dacls
+                if ace.object_guid == GPO_APPLY_GROUP_POLICY_CAR
+            )
+        self.get_objects_by_sid(sids)
+        # Settings files are read using the same SMB connection
+        profiles = {}
+        for _dn, data in resultlist:
+            profile = self._data_to_profile(data)
+            profiles[profile["cn"]] = profile
+        return profiles
+
     @connection_required
     def get_profile_rule(self, name):
         pass
 
-    @connection_required
-    def get_user(self, username):
-        base_dn = "CN=Users,%s" % self._get_domain_dn()
-        s_filter = "(&(objectclass=user)(CN=%s))" % username
-        attrs = ["cn", "objectSid"]
-        resultlist = self.connection.search_s(
-            base_dn, ldap.SCOPE_SUBTREE, s_filter, attrs
+    def _search_chunks(self, base_dn, s_filter, attr, values, attrs):
+        """
+        Search objects having any of given attribute values. Values are ORed
+        in as few search filters as possible
+        """
+        results = []
+        values = list(values)
+        for i in range(0, len(values), self.LOOKUP_CHUNK_SIZE):
+            terms = "".join(
+                "(%s=%s)" % (attr, value)
+                for value in values[i : i + self.LOOKUP_CHUNK_SIZE]
+            )
+            resultlist = self.connection.search_s(
+                base_dn, ldap.SCOPE_SUBTREE, s_filter % ("(|%s)" % terms), attrs
+            )
+            results.extend([x for x in resultlist if x[0] is not None])
+        return results
+
+    def _get_principals(self, objectclass, names):
+        base, key = self.PRINCIPAL_SEARCHES[objectclass]
+        now = time.monotonic()
+        principals = {}
+        missing = {}
+        for name in names:
+            cached = self._name_cache.get((objectclass, name.lower()))
+            if cached is not None and cached[0] > now:
+                principals[name] = cached[1]
+            else:
+                missing[name.lower()] = name
+        if not missing:
+            return principals
+
+        resultlist = self._search_chunks(
+            base % self._get_domain_dn(),
+            "(&(objectclass=%s)%%s)" % objectclass,
+            "CN",
+            missing.values(),
+            ["cn", "objectSid"],
         )
-        if len(resultlist) > 0:
-            data = resultlist[0]
-            return {
-                "cn": data[0],
-                "username": data[1]["cn"][0],
-                "sid": self.get_sid(data[1]["objectSid"][0]),
+        expires = now + self.SID_CACHE_TTL
+        for dn, data in resultlist:
+            name = missing.get(_to_str(data["cn"][0]).lower())
+            if name is None:
+                continue
+            obj = {
+                "cn": dn,
+                key: data["cn"][0],
+                "sid": self.get_sid(data["objectSid"][0]),
             }
-        return None
+            principals[name] = obj
+            self._name_cache[(objectclass, name.lower())] = (expires, obj)
+            self._sid_cache[str(obj["sid"])] = (
+                expires,
+                {"cn": _to_str(data["cn"][0]), "objectClass": [objectclass]},
+            )
+        return principals
+
+    @connection_required
+    def get_users(self, usernames):
+        """
+        Get users by name. Returns a dictionary with found users
+        """
+        return self._get_principals("user", usernames)
+
+    @connection_required
+    def get_groups(self, groupnames):
+        """
+        Get groups by name. Returns a dictionary with found groups
+        """
+        return self._get_principals("group", groupnames)
+
+    @connection_required
+    def get_hosts(self, hostnames):
+        """
+        Get hosts by name. Returns a dictionary with found hosts
+        """
+        return self._get_principals("computer", hostnames)
+
+    @connection_required
+    def check_applies(self, applies):
+        """
+        Check users, groups and hosts of profile applies exist, with one
+        search per object class. Returns (found, missing) sets by applies key
+        """
+        result = {}
+        for key, getter in (
+            ("users", self.get_users),
+            ("groups", self.get_groups),
+            ("hosts", self.get_hosts),
+        ):
+            names = set(applies.get(key, []))
+            found = set(getter(names)) if names else set()
+            result[key] = (found, names - found)
+        # There are no host groups in Active Directory
+        result["hostgroups"] = (set(), set(applies.get("hostgroups", [])))
+        return result
+
+    @connection_required
+    def get_user(self, username):
+        return self.get_users([username]).get(username)
 
     @connection_required
     def get_group(self, groupname):
-        base_dn = "%s" % self._get_domain_dn()
-        s_filter = "(&(objectclass=group)(CN=%s))" % groupname
-        attrs = ["cn", "objectSid"]
-        resultlist = self.connection.search_s(
-            base_dn, ldap.SCOPE_SUBTREE, s_filter, attrs
-        )
-        resultlist = [x for x in resultlist if x[0] is not None]
-        if len(resultlist) > 0:
-            data = resultlist[0]
-            return {
-                "cn": data[0],
-                "groupname": data[1]["cn"][0],
-                "sid": self.get_sid(data[1]["objectSid"][0]),
-            }
-        return None
+        return self.get_groups([groupname]).get(groupname)
 
     @connection_required
     def get_host(self, hostname):
-        base_dn = "CN=Computers,%s" % self._get_domain_dn()
-        s_filter = "(&(objectclass=computer)(CN=%s))" % hostname
-        attrs = ["cn", "objectSid"]
-        resultlist = self.connection.search_s(
-            base_dn, ldap.SCOPE_SUBTREE, s_filter, attrs
-        )
-        if len(resultlist) > 0:
-            data = resultlist[0]
-            return {
-                "cn": data[0],
-                "hostname": data[1]["cn"][0],
-                "sid": self.get_sid(data[1]["objectSid"][0]),
-            }
-        return None
+        return self.get_hosts([hostname]).get(hostname)
+
+    def get_objects_by_sid(self, sids, classes=("computer", "user", "group")):
+        """
+        Get objects by SID. Returns a dictionary with found objects
+        """
+        now = time.monotonic()
+        objects = {}
+        missing = set()
+        for sid in sids:
+            cached = self._sid_cache.get(sid)
+            if cached is not None and cached[0] > now:
+                obj = cached[1]
+                if obj is not None and set(obj["objectClass"]) & set(classes):
+                    objects[sid] = obj
+            else:
+                missing.add(sid)
+        if not missing:
+            return objects
 
-    def get_object_by_sid(self, sid, classes=["computer", "user", "group"]):
-        base_dn = "%s" % self._get_domain_dn()
         object_classes = "".join(["(objectclass=%s)" % x for x in classes])
-        s_filter = "(&(|%s)(objectSid=%s))" % (object_classes, sid)
-        attrs = ["cn", "objectClass"]
-        resultlist = self.connection.search_s(
-            base_dn, ldap.SCOPE_SUBTREE, s_filter, attrs
+        resultlist = self._search_chunks(
+            self._get_domain_dn(),
+            "(&(|%s)%%s)" % object_classes,
+            "objectSid",
+            sorted(missing),
+            ["cn", "objectClass", "objectSid"],
         )
-        resultlist = [x for x in resultlist if x[0] is not None]
-        if len(resultlist) > 0:
-            data = resultlist[0][1]
-            return {"cn": data["cn"][0], "objectClass": data["objectClass"]}
-        return None
+        resolved = {}
+        for _dn, data in resultlist:
+            resolved[str(self.get_sid(data["objectSid"][0]))] = {
+                "cn": _to_str(data["cn"][0]),
+                "objectClass": [_to_str(x) for x in data["objectClass"]],
+            }
+        expires = now + self.SID_CACHE_TTL
+        for sid in missing:
+            # Unknown SIDs are cached too, as removed accounts stay in ACLs
+            obj = resolved.get(sid)
+            self._sid_cache[sid] = (expires, obj)
+            if obj is not None:
+                objects[sid] = obj
+        return objects
+
+    def get_object_by_sid(self, sid, classes=("computer", "user", "group")):
+        return self.get_objects_by_sid([sid], classes).get(sid)
 
     def get_sid(self, sid_ndr):
         return ndr_unpack(security.dom_sid, sid_ndr)
 
     def get_domain_sid(self):
-        base_dn = "%s" % self._get_domain_dn()
-        s_filter = "(objectClass=*)"
-        attrs = ["objectSid"]
-        resultlist = self.connection.search_s(base_dn, ldap.SCOPE_BASE, s_filter, attrs)
-        return self.get_sid(resultlist[0][1]["objectSid"][0])
+        # Domain SID does not change, so get it once per connection
+        if self._domain_sid is None:
+            base_dn = "%s" % self._get_domain_dn()
+            s_filter = "(objectClass=*)"
+            attrs = ["objectSid"]
+            resultlist = self.connection.search_s(
+                base_dn, ldap.SCOPE_BASE, s_filter, attrs
+            )
+            self._domain_sid = self.get_sid(resultlist[0][1]["objectSid"][0])
+        return self._domain_sid
 
 
 class SecurityDescriptorHelper:
@@ -600,41 +1070,58 @@ class SecurityDescriptorHelper:
 
     def parse_sddl(self, sddl):
         logger.debug("Parsing SDDL for security descriptor. Given SDDL: %s", sddl)
-        # SACLs
-        if "S:" in sddl:
-            sacl_index = sddl.index("S:")
-            sacl_data = sddl[sacl_index + 2 :]
-            if "(" in sacl_data:
-                self.sacl_flags = sacl_data[: sacl_data.index("(")]
-                sacl_aces = sacl_data[sacl_data.index("(") :]
-                self.sacls = [ACEHelper(x) for x in sacl_aces[1:][:-1].split(")(")]
-            else:
-                self.sacl_flags = sacl_data
-        else:
-            sacl_index = len(sddl) - 1
-        # DACLs
-        if "D:" in sddl:
-            dacl_index = sddl.index("D:")
-            dacl_data = sddl[dacl_index + 2 : sacl_index]
-            if "(" in dacl_data:
-                self.dacl_flags = dacl_data[: dacl_data.index("(")]
-                dacl_aces = dacl_data[dacl_data.index("(") :]
-                self.dacls = [ACEHelper(x) for x in dacl_aces[1:][:-1].split(")(")]
-            else:
-                self.dacl_flags = dacl_data
-        # Group
-        g_index = sddl.index("G:")
-        self.group_sid = sddl[g_index + 2 : dacl_index]
+        self.owner_sid = ""
+        self.group_sid = ""
+        self.dacl_flags = ""
+        self.dacls = []
+        self._dacl_set = set()
+        self.sacl_flags = ""
+        self.sacls = []
+        section = None
+        for match in SDDL_TOKEN_REGEX.finditer(sddl):
+            name, value, ace = match.groups()
+            if ace is None:
+                section = name
+                if name == "O":
+                    self.owner_sid = value
+                elif name == "G":
+                    self.group_sid = value
+                elif name == "D":
+                    self.dacl_flags = value
+                else:
+                    self.sacl_flags = value
+            elif section == "D":
+                self.add_dacl_ace(ACEHelper(ace))
+            elif section == "S":
+                self.sacls.append(ACEHelper(ace))
         logger.debug("SDDL parse finished")
-        # Owner
-        self.owner_sid = sddl[2:g_index]
 
     def add_dacl_ace(self, ace):
-        logger.debug("Adding ACE to security descriptor: %s")
-        if ace not in self.dacls:
-            self.dacls.append(ACEHelper(str(ace)))
+        if not isinstance(ace, ACEHelper):
+            ace = ACEHelper(str(ace))
+        if ace not in self._dacl_set:
+            self.dacls.append(ace)
+            self._dacl_set.add(ace)
         else:
-            logger.debug("ACE %s already exists for this security descriptor")
+            logger.debug("ACE %s already exists for this security descriptor", ace)
+
+    def get_explicit_dacl(self):
+        """
+        Get DACL ACEs not inherited from parent objects
+        """
+        return {str(ace) for ace in self.dacls if "ID" not in ace.flags}
+
+    def get_explicit_security(self):
+        """
+        Get owner, group, DACL flags and DACL ACEs not inherited from parent
+        objects
+        """
+        return (
+            self.owner_sid,
+            self.group_sid,
+            self.dacl_flags,
+            self.get_explicit_dacl(),
+        )
 
     def get_fc_applies(self):
         logger.debug("Getting applies from security descriptor ACEs")
@@ -642,18 +1129,23 @@ class SecurityDescriptorHelper:
         groups = set()
         hosts = set()
 
-        for ace in self.dacls:
-            # Manage GPO object ACEs only
-            if ace.object_guid == GPO_APPLY_GROUP_POLICY_CAR:
-                # Manage ACEs that apply to an user
-                obj = self.connector.get_object_by_sid(ace.account_sid)
-                if obj is not None:
-                    if "user" in obj["objectClass"]:
-                        users.add(obj["cn"])
-                    elif "group" in obj["objectClass"]:
-                        groups.add(obj["cn"])
-                    elif "computer" in obj["objectClass"]:
-                        hosts.add(obj["cn"])
+        # Manage GPO object ACEs only, resolving all their SIDs at once
+        sids = [
+            ace.account_sid
+            for ace in self.dacls
+            if ace.object_guid == GPO_APPLY_GROUP_POLICY_CAR
+        ]
+        objects = self.connector.get_objects_by_sid(sids)
+        for sid in sids:
+            obj = objects.get(sid)
+            if obj is not None:
+                # Computer accounts are users too
+                if "computer" in obj["objectClass"]:
+                    hosts.add(obj["cn"])
+                elif "user" in obj["objectClass"]:
+                    users.add(obj["cn"])
+                elif "group" in obj["objectClass"]:
+                    groups.add(obj["cn"])
         applies = {
             "users": sorted(list(users)),
             "groups": sorted(list(groups)),
@@ -689,42 +1181,49 @@ class SecurityDescriptorHelper:
 
 
 class ACEHelper:
-    __hash__ = None
+    """
+    ACE hashable by its contents, so it must not be modified
+    """
 
-    def __init__(self, ace_string):
-        # Remove parenthesis from ACE string
-        ace_string = ace_string.replace("(", "").replace(")", "")
-        # Split data
-        data = ace_string.split(";")
-        self.type = data[0]
-        self.flags = data[1]
-        self.rights = data[2]
-        self.object_guid = data[3]
-        self.inherit_object_guid = data[4]
-        self.account_sid = data[5]
-        # Resource attribute is optional
-        if len(data) > 6:
-            self.resource_attribute = data[6]
-        else:
-            self.resource_attribute = None
+    __slots__ = (
+        "type",
+        "flags",
+        "rights",
+        "object_guid",
+        "inherit_object_guid",
+        "account_sid",
+        "resource_attribute",
+        "ace_string",
+        "_key",
+    )
 
-    @property
-    def ace_string(self):
-        data = [
+    def __init__(self, ace_string):
+        # Remove enclosing parenthesis from ACE string
+        if ace_string.startswith("(") and ace_string.endswith(")"):
+            ace_string = ace_string[1:-1]
+        # Split data. Resource attribute is optional and may contain ';'
+        data = ace_string.split(";", 6)
+        if len(data) < 6:
+            raise ValueError("Invalid ACE: %s" % ace_string)
+        (
             self.type,
             self.flags,
             self.rights,
             self.object_guid,
             self.inherit_object_guid,
             self.account_sid,
-        ]
-        if self.resource_attribute is not None:
-            data.append(self.resource_attribute)
-        return "(%s)" % ";".join(data)
+        ) = data[:6]
+        self.resource_attribute = data[6] if len(data) > 6 else None
+        self.ace_string = "(%s)" % ace_string
+        self._key = tuple(data)
 
     def __eq__(self, other):
-        ace_str = str(other)
-        return ace_str == self.ace_string
+        if isinstance(other, ACEHelper):
+            return self._key == other._key
+        return str(other) == self.ace_string
+
+    def __hash__(self):
+        return hash(self._key)
 
     def __repr__(self):
         return "ACEHelper%s" % self.ace_string
@@ -25,7 +25,11 @@ import sys
 import json
 import logging
 import re
+import signal
+import threading
 import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from functools import wraps
 
 import dbus
@@ -84,6 +88,31 @@ class FleetCommanderDbusService(dbus.service.Object):
         "viewer": "spice_html5",
     }
 
+    # Optional session pool settings in hypervisor configuration
+    DEFAULT_HYPERVISOR_POOL_CONF = {
+        "pool_size": 0,
+        "pool_templates": [],
+        "pool_max_age": 3600,
+        "pool_reap_on_idle": True,
+    }
+
+    MAX_POOL_SIZE = 8
+
+    # Delay before retrying a pool template whose domain failed to start.
+    # Doubles on each consecutive failure up to the maximum
+    POOL_RETRY_DELAY = 30
+    POOL_MAX_RETRY_DELAY = 1800
+
+    # Optional capacity hints for each hypervisor. Minimum free memory in MiB
+    DEFAULT_HYPERVISOR_CAPACITY_CONF = {
+        "max_sessions": 0,
+        "min_free_memory": 0,
+    }
+
+    # Concurrent hypervisor host keys scanning
+    MAX_KNOWN_HOSTS_CHECK = 64
+    HOST_KEYSCAN_TIMEOUT = 5
+
     def __init__(self, args):
         """
         Class initialization
@@ -136,7 +165,9 @@ class FleetCommanderDbusService(dbus.service.Object):
         else:
             # Load FreeIPA connector
             logger.debug("Activating IPA domain support for %s", domain)
-            self.realm_connector = fcfreeipa.FreeIPAConnector()
+            self.realm_connector = fcfreeipa.FreeIPAConnector(
+                compress_profiles=args["compress_profiles"]
+            )
 
         self.GOA_PROVIDERS_FILE = os.path.join(args["data_dir"], "fc-goa-providers.ini")
 
@@ -166,21 +197,42 @@ class FleetCommanderDbusService(dbus.service.Object):
         self._loop = None
         self._last_call_time = None
         self._last_heartbeat = None
+        # Last heartbeat time for each live session
+        self._session_heartbeats = {}
+        self._pool_check_scheduled = False
+        # Template of the pooled domain being started in background
+        self._pool_starting = None
+        # Consecutive start failures and next retry time by pool template
+        self._pool_failures = {}
+        # Number of sessions being started in background
+        self._sessions_starting = 0
+        # Sessions being destroyed in background
+        self._teardown = set()
+        # Domain inventories and their hypervisor configuration by host
+        self._inventories = {}
 
     def run(self):
         dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
         bus_name = dbus.service.BusName(DBUS_BUS_NAME, dbus.SessionBus())
         dbus.service.Object.__init__(self, bus_name, DBUS_OBJECT_PATH)
         self._loop = GLib.MainLoop()
+        # Quit main loop on termination to stop SSH tunnels
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            GLib.unix_signal_add(GLib.PRIORITY_HIGH, signum, self._loop.quit)
 
         # Start session checking
         self.start_session_checking()
+        self.restore_session_tunnels()
 
         # Set last call time to an initial value
         self._last_call_time = time.time()
 
         # Enter main loop
-        self._loop.run()
+        try:
+            self._loop.run()
+        finally:
+            # SSH tunnels are child processes of this service
+            libvirtcontroller.LibVirtController.close_tunnels()
 
     def get_realm_details(self):
         sssd_provider = Gio.DBusProxy.new_for_bus_sync(
@@ -220,11 +272,38 @@ class FleetCommanderDbusService(dbus.service.Object):
         # Return unknown domain and use IPA as directory server
         return ("UNKNOWN", "ipa")
 
-    def get_libvirt_controller(self):
+    def get_hypervisors(self):
+        """
+        Get configured hypervisors, main one first
+        """
+        main = self.db.config["hypervisor"]
+        hypervisors = [
+            {
+                key: value
+                for key, value in main.items()
+                if key != "hypervisors" and key not in self.DEFAULT_HYPERVISOR_POOL_CONF
+            }
+        ]
+        hypervisors.extend(main.get("hypervisors", []))
+        return hypervisors
+
+    def get_hypervisor(self, host=None):
+        """
+        Get hypervisor configuration by host. Main hypervisor by default
+        """
+        hypervisors = self.get_hypervisors()
+        if host is None:
+            return hypervisors[0]
+        for hypervisor in hypervisors:
+            if hypervisor["host"] == host:
+                return hypervisor
+        raise KeyError("Unknown hypervisor %s" % host)
+
+    def get_libvirt_controller(self, host=None):
         """
         Get a libvirtcontroller instance
         """
-        hypervisor = self.db.config["hypervisor"]
+        hypervisor = self.get_hypervisor(host)
         return libvirtcontroller.controller(
             viewer_type=hypervisor["viewer"],
             data_path=self.state_dir,
@@ -265,47 +344,515 @@ class FleetCommanderDbusService(dbus.service.Object):
             data.update(self.db.config["hypervisor"])
         return data
 
+    def get_domain_inventory(self, host=None):
+        """
+        Get domain inventory for given hypervisor configuration
+        """
+        hypervisor = self.get_hypervisor(host)
+        host = hypervisor["host"]
+        config, inventory = self._inventories.get(host, (None, None))
+        if inventory is None or config != hypervisor:
+            if inventory is not None:
+                self.drop_domain_inventory(host)
+            logger.debug("Creating domain inventory for %s", host)
+            inventory = libvirtcontroller.DomainInventory(
+                self.get_libvirt_controller(host)
+            )
+            self._inventories[host] = (hypervisor, inventory)
+        return inventory
+
+    def drop_domain_inventory(self, host):
+        """
+        Closes domain inventory for given host to start over on next use
+        """
+        _config, inventory = self._inventories.pop(host, (None, None))
+        if inventory is not None:
+            inventory.close()
+
+    def invalidate_domain_inventory(self, host=None):
+        for inventory_host, (_config, inventory) in self._inventories.items():
+            if host is None or inventory_host == host:
+                inventory.invalidate()
+
     def get_domains(self, only_temporary=False):
-        tries = 0
-        while tries < self.LIST_DOMAINS_RETRIES:
-            tries += 1
+        """
+        Get domains of all hypervisors tagged with their host
+        """
+        try:
+            hosts = [hypervisor["host"] for hypervisor in self.get_hypervisors()]
+        except Exception as e:
+            logger.error("Error retrieving domains %s", e)
+            return None
+
+        alldomains = None
+        for host in hosts:
+            tries = 0
+            while tries < self.LIST_DOMAINS_RETRIES:
+                tries += 1
+                try:
+                    domains = self.get_domain_inventory(host).domains()
+                    break
+                except Exception as e:
+                    error = e
+                    logger.debug("Getting %s domains try %s: %s", host, tries, error)
+                    # Start over with a new connection
+                    self.drop_domain_inventory(host)
+            else:
+                logger.error("Error retrieving domains from %s: %s", host, error)
+                continue
+            alldomains = (alldomains or []) + [
+                dict(domain, hypervisor=host)
+                for domain in domains
+                if domain["temporary"] or not only_temporary
+            ]
+        logger.debug("Domains retrieved: %s", alldomains)
+        return alldomains
+
+    def merge_domains(self, domains):
+        """
+        Merges domains present in several hypervisors
+        """
+        merged = OrderedDict()
+        for domain in domains:
+            domain = dict(domain)
+            host = domain.pop("hypervisor")
+            if domain["uuid"] not in merged:
+                domain["hypervisors"] = [host]
+                merged[domain["uuid"]] = domain
+            else:
+                entry = merged[domain["uuid"]]
+                entry["hypervisors"].append(host)
+                entry["active"] = entry["active"] or domain["active"]
+        return list(merged.values())
+
+    def select_hypervisor(self, template_uuid):
+        """
+        Get host of least loaded hypervisor having given template
+        """
+        hypervisors = self.get_hypervisors()
+        if len(hypervisors) == 1:
+            return hypervisors[0]["host"]
+
+        hosts = {
+            d["hypervisor"]
+            for d in self.get_domains() or []
+            if d["uuid"] == template_uuid and not d["temporary"]
+        }
+        candidates = [h for h in hypervisors if h["host"] in hosts]
+        if not candidates:
+            raise RuntimeError("Template %s not found in hypervisors" % template_uuid)
+        if len(candidates) == 1:
+            return candidates[0]["host"]
+
+        futures = {}
+        with ThreadPoolExecutor(max_workers=len(candidates)) as executor:
+            for hypervisor in candidates:
+                host = hypervisor["host"]
+                # Configuration database can only be used from this thread
+                try:
+                    ctrlr = self.get_domain_inventory(host).ctrlr
+                except Exception as e:
+                    logger.error("Error getting hypervisor %s load: %s", host, e)
+                    continue
+                futures[host] = executor.submit(ctrlr.get_load)
+
+        best = None
+        for hypervisor in candidates:
+            host = hypervisor["host"]
+            if host not in futures:
+                continue
             try:
-                domains = self.get_libvirt_controller().list_domains()
-                if only_temporary:
-                    domains = [d for d in domains if d["temporary"]]
-                logger.debug("Domains retrieved: %s", domains)
-                return domains
+                load = futures[host].result()
             except Exception as e:
-                error = e
-                logger.debug("Getting domain try %s: %s", tries, error)
-        logger.error("Error retrieving domains %s", error)
-        return None
+                logger.error("Error getting hypervisor %s load: %s", host, e)
+                continue
+            logger.debug("Hypervisor %s load: %s", host, load)
+            max_sessions = hypervisor.get("max_sessions", 0)
+            min_free_memory = hypervisor.get("min_free_memory", 0) * 1024 * 1024
+            if max_sessions and load["sessions"] >= max_sessions:
+                continue
+            if load["free_memory"] < min_free_memory:
+                continue
+            # Free memory each session would get after placing a new one
+            score = load["free_memory"] / (load["sessions"] + 1)
+            if best is None or score > best[0]:
+                best = (score, host)
+
+        if best is None:
+            raise RuntimeError("No hypervisor with free capacity for new sessions")
+        return best[1]
+
+    def start_session_domain(self, template_uuid, done):
+        """
+        Starts session in a background thread using a pooled domain if
+        available or in the least loaded hypervisor. Calls done from main loop
+        with used controller, hypervisor host and session params, or an error
+        """
+        debug_logger = self.args["debug_logger"]
+        claimed = self.claim_pooled_domain(template_uuid)
+        pooled_host = claimed[1].get("hypervisor") if claimed is not None else None
+
+        def pooled_failed(pooled_uuid, error):
+            logger.warning("Error using pooled domain %s: %s", pooled_uuid, error)
+            self.teardown_sessions([pooled_uuid], pooled_host)
+            start_new()
+
+        def start_done(ctrlr, host, pooled, session_params, error):
+            self._sessions_starting -= 1
+            if error is None:
+                done(ctrlr, host, session_params, None)
+            elif pooled is not None:
+                pooled_failed(pooled.domain, error)
+            else:
+                done(None, None, None, error)
+            return False
 
-    def stop_current_session(self):
+        def start(ctrlr, host, pooled):
+            try:
+                session_params = ctrlr.session_start(
+                    template_uuid, debug_logger=debug_logger, pooled=pooled
+                )
+            except Exception as e:
+                GLib.idle_add(start_done, ctrlr, host, pooled, None, e)
+            else:
+                # Get back to main loop to report results
+                GLib.idle_add(start_done, ctrlr, host, pooled, session_params, None)
+
+        def start_thread(ctrlr, host, pooled=None):
+            # Started domain looks orphaned until it is recorded as a session
+            self._sessions_starting += 1
+            threading.Thread(
+                target=start,
+                args=(ctrlr, host, pooled),
+                name="fc-session-start",
+                daemon=True,
+            ).start()
+
+        def start_new():
+            try:
+                host = self.select_hypervisor(template_uuid)
+                ctrlr = self.get_libvirt_controller(host)
+            except Exception as e:
+                done(None, None, None, e)
+                return
+            start_thread(ctrlr, host)
 
-        if "uuid" not in self.db.config:
-            logger.error("There was no session started")
-            return False, "There was no session started"
+        if claimed is None:
+            start_new()
+            return
 
-        domain_uuid = self.db.config["uuid"]
+        pooled_uuid, pooled = claimed
+        try:
+            ctrlr = self.get_libvirt_controller(pooled_host)
+            host = self.get_hypervisor(pooled_host)["host"]
+        except Exception as e:
+            pooled_failed(pooled_uuid, e)
+            return
+        start_thread(
+            ctrlr,
+            host,
+            ctrlr.pool_params(domain=pooled_uuid, ticket=pooled["ticket"]),
+        )
+
+    def stop_session(self, session_uuid, ctrlr=None):
+
+        if session_uuid not in self.db.sessions:
+            logger.error("There was no session started with UUID %s", session_uuid)
+            return False, "There was no session started"
 
-        del self.db.config["uuid"]
-        del self.db.config["connection_details"]
+        host = self.db.sessions[session_uuid].get("hypervisor")
+        del self.db.sessions[session_uuid]
+        self._session_heartbeats.pop(session_uuid, None)
 
         try:
-            self.get_libvirt_controller().session_stop(domain_uuid)
+            if ctrlr is None:
+                ctrlr = self.get_libvirt_controller(host)
+            ctrlr.session_stop(session_uuid)
         except Exception as e:
-            logger.error("Error stopping session: %s", e)
+            logger.error("Error stopping session %s: %s", session_uuid, e)
             return False, "Error stopping session: %s" % e
+        finally:
+            self.invalidate_domain_inventory(host)
 
         return True, None
 
+    def check_hypervisor_data(self, data):
+        """
+        Check connection settings and capacity hints of a hypervisor
+        """
+        errors = {}
+        if not set(data) <= (
+            set(self.DEFAULT_HYPERVISOR_CONF)
+            | set(self.DEFAULT_HYPERVISOR_CAPACITY_CONF)
+            | set(self.DEFAULT_HYPERVISOR_POOL_CONF)
+            | {"hypervisors"}
+        ):
+            errors["schema"] = "Invalid configuration schema"
+            return errors
+        # Check username
+        if not isinstance(data["username"], str) or not re.match(
+            SYSTEM_USER_REGEX, data["username"]
+        ):
+            errors["username"] = "Invalid username specified"
+        # Check hostname
+        if not isinstance(data["host"], str) or (
+            not re.match(HOSTNAME_AND_PORT_REGEX, data["host"])
+            and not re.match(IPADDRESS_AND_PORT_REGEX, data["host"])
+        ):
+            errors["host"] = "Invalid hostname specified"
+        # Check libvirt mode
+        if data["mode"] not in ("system", "session"):
+            errors["mode"] = "Invalid session type"
+        if data["viewer"] not in libvirtcontroller.VIEWERS:
+            errors["viewer"] = "Unsupported libvirt viewer type"
+        # Check capacity hints
+        for key in self.DEFAULT_HYPERVISOR_CAPACITY_CONF:
+            value = data.get(key, 0)
+            if not isinstance(value, int) or isinstance(value, bool) or value < 0:
+                errors[key] = "Invalid hypervisor capacity setting"
+        return errors
+
+    def get_pool_config(self):
+        """
+        Get session pool configuration from hypervisor configuration
+        """
+        config = dict(self.DEFAULT_HYPERVISOR_POOL_CONF)
+        hypervisor = self.db.config.get("hypervisor", {})
+        config.update({key: hypervisor[key] for key in config if key in hypervisor})
+        return config
+
+    def claim_pooled_domain(self, template_uuid):
+        """
+        Take a pre-started domain for given template out of the pool
+        """
+        max_age = self.get_pool_config()["pool_max_age"]
+        now = time.time()
+        for domain_uuid, pooled in self.db.pool.items():
+            if pooled["template"] != template_uuid:
+                continue
+            if pooled["debug_logger"] != self.args["debug_logger"]:
+                continue
+            if max_age and now - pooled["created"] > max_age:
+                continue
+            del self.db.pool[domain_uuid]
+            return domain_uuid, pooled
+        return None
+
+    def teardown_sessions(self, identifiers, host=None):
+        """
+        Destroys given session domains of a hypervisor in a background thread
+        """
+        identifiers = [i for i in identifiers if i not in self._teardown]
+        if not identifiers:
+            return
+
+        try:
+            ctrlr = self.get_libvirt_controller(host)
+        except Exception as e:
+            logger.error("Error destroying sessions %s: %s", identifiers, e)
+            return
+
+        def teardown_done(errors):
+            for identifier, error in errors.items():
+                logger.error(
+                    "Error destroying session with UUID %s: %s", identifier, error
+                )
+            self._teardown.difference_update(identifiers)
+            self.invalidate_domain_inventory(host)
+            return False
+
+        def teardown():
+            try:
+                errors = ctrlr.sessions_stop(identifiers)
+            except Exception as e:
+                errors = dict.fromkeys(identifiers, e)
+            # Get back to main loop to report results
+            GLib.idle_add(teardown_done, errors)
+
+        logger.info("Destroying sessions: %s", identifiers)
+        self._teardown.update(identifiers)
+        threading.Thread(
+            target=teardown, name="fc-session-teardown", daemon=True
+        ).start()
+
+    def teardown_hosts_sessions(self, hosts):
+        """
+        Destroys session domains given as a dict of lists by hypervisor host
+        """
+        for host, identifiers in hosts.items():
+            self.teardown_sessions(identifiers, host)
+
+    def check_session_pool(self):
+        """
+        Reaps pooled domains and starts one new pooled domain in background
+        if needed
+        """
+        if "hypervisor" not in self.db.config:
+            return
+
+        pool_config = self.get_pool_config()
+        now = time.time()
+        idle = now - self._last_call_time > self.tmp_session_destroy_timeout
+        keep_warm = pool_config["pool_size"] > 0 and not (
+            idle and pool_config["pool_reap_on_idle"]
+        )
+        templates = pool_config["pool_templates"] if keep_warm else []
+
+        reap = []
+        counts = dict.fromkeys(templates, 0)
+        for domain_uuid, pooled in self.db.pool.items():
+            template = pooled["template"]
+            if (
+                template not in counts
+                or pooled["debug_logger"] != self.args["debug_logger"]
+                or counts[template] >= pool_config["pool_size"]
+                or (
+                    pool_config["pool_max_age"]
+                    and now - pooled["created"] > pool_config["pool_max_age"]
+                )
+            ):
+                reap.append(domain_uuid)
+            else:
+                counts[template] += 1
+
+        missing = [t for t in templates if counts[t] < pool_config["pool_size"]]
+
+        if reap:
+            logger.info("Destroying pooled domains: %s", reap)
+            hosts = {}
+            for domain_uuid in reap:
+                host = self.db.pool[domain_uuid].get("hypervisor")
+                hosts.setdefault(host, []).append(domain_uuid)
+                del self.db.pool[domain_uuid]
+            self.teardown_hosts_sessions(hosts)
+
+        # Skip templates whose domains recently failed to start
+        missing = [t for t in missing if self._pool_failures.get(t, (0, 0))[1] <= now]
+        if not missing or self._pool_starting is not None:
+            return
+
+        # Start one domain at a time. Pool gets checked again when done
+        self.start_pooled_domain(missing[0])
+
+    def start_pooled_domain(self, template):
+        """
+        Starts a pooled domain from given template in a background thread
+        """
+        try:
+            host = self.select_hypervisor(template)
+            ctrlr = self.get_libvirt_controller(host)
+        except Exception as e:
+            self.pool_domain_failed(template, e)
+            return
+
+        debug_logger = self.args["debug_logger"]
+
+        def start_done(pooled, error):
+            self._pool_starting = None
+            if error is not None:
+                self.pool_domain_failed(template, error)
+            else:
+                logger.debug(
+                    "Started pooled domain %s from %s in %s",
+                    pooled.domain,
+                    template,
+                    host,
+                )
+                self._pool_failures.pop(template, None)
+                self.db.pool[pooled.domain] = {
+                    "template": template,
+                    "hypervisor": host,
+                    "ticket": pooled.ticket,
+                    "created": time.time(),
+                    "debug_logger": debug_logger,
+                }
+                self.invalidate_domain_inventory(host)
+            self.schedule_session_pool_check()
+            return False
+
+        def start():
+            try:
+                pooled = ctrlr.pool_domain_start(template, debug_logger=debug_logger)
+            except Exception as e:
+                GLib.idle_add(start_done, None, e)
+            else:
+                # Get back to main loop to report results
+                GLib.idle_add(start_done, pooled, None)
+
+        logger.info("Starting pooled domain from %s in %s", template, host)
+        self._pool_starting = template
+        threading.Thread(target=start, name="fc-session-pool", daemon=True).start()
+
+    def pool_domain_failed(self, template, error):
+        """
+        Delays next pooled domain start from given template
+        """
+        failures = self._pool_failures.get(template, (0, 0))[0] + 1
+        delay = min(
+            self.POOL_RETRY_DELAY * 2 ** (failures - 1), self.POOL_MAX_RETRY_DELAY
+        )
+        self._pool_failures[template] = (failures, time.time() + delay)
+        logger.error(
+            "Error starting pooled domain from %s (retrying in %ss): %s",
+            template,
+            delay,
+            error,
+        )
+
+    def schedule_session_pool_check(self):
+        """
+        Checks session pool from main loop when idle
+        """
+        if self._pool_check_scheduled:
+            return
+
+        def pool_check():
+            self._pool_check_scheduled = False
+            self.check_session_pool()
+            return False
+
+        self._pool_check_scheduled = True
+        GLib.idle_add(pool_check)
+
     def start_session_checking(self):
         self._last_heartbeat = time.time()
+        # Sessions that survived a service restart get a full timeout period
+        for session_uuid, _session in self.db.sessions.items():
+            self._session_heartbeats[session_uuid] = self._last_heartbeat
         # Add callback for temporary sessions check
         GLib.timeout_add(1000, self.check_running_sessions)
         logger.debug("Started session checking")
 
+    def restore_session_tunnels(self):
+        """
+        Opens again SSH tunnels of sessions that survived a service restart
+        in a background thread
+        """
+        tunnels = []
+        for session_uuid, session in self.db.sessions.items():
+            if not session.get("tunnel"):
+                continue
+            try:
+                ctrlr = self.get_libvirt_controller(session.get("hypervisor"))
+            except Exception as e:
+                logger.error("Error restoring session %s tunnel: %s", session_uuid, e)
+                continue
+            tunnels.append((ctrlr, session_uuid, session["tunnel"]))
+        if not tunnels:
+            return
+
+        def restore():
+            for ctrlr, session_uuid, local_forwards in tunnels:
+                try:
+                    ctrlr.session_restore_tunnel(session_uuid, local_forwards)
+                except Exception as e:
+                    logger.error(
+                        "Error restoring session %s tunnel: %s", session_uuid, e
+                    )
+
+        logger.info("Restoring SSH tunnels of %s sessions", len(tunnels))
+        threading.Thread(target=restore, name="fc-tunnel-restore", daemon=True).start()
+
     def parse_hypervisor_hostname(self, hostname):
         hostdata = hostname.split(":", maxsplit=1)
         if len(hostdata) == 2:
@@ -319,36 +866,56 @@ class FleetCommanderDbusService(dbus.service.Object):
         """
         Checks currently running sessions and destroy temporary ones on timeout
         """
-        time_passed = time.time() - self._last_heartbeat
-        if time_passed > self.tmp_session_destroy_timeout:
+        now = time.time()
+        # Stop sessions whose heartbeat has timed out
+        stalled = [
+            session_uuid
+            for session_uuid, heartbeat in self._session_heartbeats.items()
+            if now - heartbeat > self.tmp_session_destroy_timeout
+        ]
+        if stalled:
+            logger.info("Destroying stalled sessions: %s", stalled)
+            hosts = {}
+            for session_uuid in stalled:
+                host = self.db.sessions[session_uuid].get("hypervisor")
+                hosts.setdefault(host, []).append(session_uuid)
+                del self.db.sessions[session_uuid]
+                del self._session_heartbeats[session_uuid]
+            self.teardown_hosts_sessions(hosts)
+
+        time_passed = now - self._last_heartbeat
+        # Domains being started are not known yet and look orphaned
+        if (
+            time_passed > self.tmp_session_destroy_timeout
+            and self._pool_starting is None
+            and not self._sessions_starting
+        ):
             domains = self.get_domains(only_temporary=True)
             logger.debug("Currently active temporary sessions: %s", domains)
-            if domains:
-                logger.info("Destroying stalled sessions")
-                # Stop current session
-                current_uuid = self.db.config.get("uuid", False)
-                if current_uuid:
-                    logger.debug("Stopping current session: %s", current_uuid)
-                    self.stop_current_session()
-                for domain in domains:
-                    ctrlr = self.get_libvirt_controller()
-                    domain_uuid = domain["uuid"]
-                    if current_uuid != domain_uuid:
-                        try:
-                            ctrlr.session_stop(domain_uuid)
-                        except Exception as e:
-                            logger.error(
-                                "Error destroying session with UUID %s: %s",
-                                domain_uuid,
-                                e,
-                            )
-            if time.time() - self._last_call_time > self.auto_quit_timeout:
+            orphaned = {}
+            for domain in domains or []:
+                domain_uuid = domain["uuid"]
+                if domain_uuid in self.db.pool:
+                    # Pooled domains are handled by session pool checks
+                    continue
+                if domain_uuid in self.db.sessions:
+                    del self.db.sessions[domain_uuid]
+                    self._session_heartbeats.pop(domain_uuid, None)
+                orphaned.setdefault(domain["hypervisor"], []).append(domain_uuid)
+            if orphaned:
+                logger.info("Destroying orphaned temporary sessions")
+                self.teardown_hosts_sessions(orphaned)
+            if self._teardown:
+                logger.debug("Waiting for sessions teardown before quitting")
+            elif time.time() - self._last_call_time > self.auto_quit_timeout:
                 # Quit service
                 logger.debug("Closing Fleet Commander Admin service due to inactivity")
                 self._loop.quit()
             else:
                 logger.debug("Resetting timer for session check")
                 self._last_heartbeat = time.time()
+
+        self.schedule_session_pool_check()
         return True
 
     @set_last_call_time
@@ -379,11 +946,14 @@ class FleetCommanderDbusService(dbus.service.Object):
             )
 
     @set_last_call_time
-    @dbus.service.method(DBUS_INTERFACE_NAME, in_signature="", out_signature="b")
-    def HeartBeat(self):
+    @dbus.service.method(DBUS_INTERFACE_NAME, in_signature="s", out_signature="b")
+    def HeartBeat(self, session_uuid):
         # Update last heartbeat time
         self._last_heartbeat = time.time()
-        return True
+        if session_uuid in self._session_heartbeats:
+            self._session_heartbeats[session_uuid] = self._last_heartbeat
+            return True
+        return session_uuid == ""
 
     @set_last_call_time
     @dbus.service.method(DBUS_INTERFACE_NAME, in_signature="", out_signature="b")
@@ -410,23 +980,50 @@ class FleetCommanderDbusService(dbus.service.Object):
             errors["data"] = "Invalid configuration data"
             return json.dumps({"status": False, "errors": errors})
 
-        if set(data) != set(self.DEFAULT_HYPERVISOR_CONF):
+        keys = set(data)
+        required = set(self.DEFAULT_HYPERVISOR_CONF)
+        optional = (
+            set(self.DEFAULT_HYPERVISOR_POOL_CONF)
+            | set(self.DEFAULT_HYPERVISOR_CAPACITY_CONF)
+            | {"hypervisors"}
+        )
+        if not required <= keys <= required | optional:
             errors["schema"] = "Invalid configuration schema"
             return json.dumps({"status": False, "errors": errors})
 
-        # Check username
-        if not re.match(SYSTEM_USER_REGEX, data["username"]):
-            errors["username"] = "Invalid username specified"
-        # Check hostname
-        if not re.match(HOSTNAME_AND_PORT_REGEX, data["host"]) and not re.match(
-            IPADDRESS_AND_PORT_REGEX, data["host"]
+        errors.update(self.check_hypervisor_data(data))
+        # Check session pool settings
+        pool_size = data.get("pool_size", 0)
+        if not isinstance(pool_size, int) or not 0 <= pool_size <= self.MAX_POOL_SIZE:
+            errors["pool_size"] = "Invalid session pool size"
+        pool_templates = data.get("pool_templates", [])
+        if not isinstance(pool_templates, list) or not all(
+            isinstance(t, str) for t in pool_templates
         ):
-            errors["host"] = "Invalid hostname specified"
-        # Check libvirt mode
-        if data["mode"] not in ("system", "session"):
-            errors["mode"] = "Invalid session type"
-        if data["viewer"] not in libvirtcontroller.VIEWERS:
-            errors["viewer"] = "Unsupported libvirt viewer type"
+            errors["pool_templates"] = "Invalid session pool templates"
+        pool_max_age = data.get("pool_max_age", 0)
+        if not isinstance(pool_max_age, int) or pool_max_age < 0:
+            errors["pool_max_age"] = "Invalid session pool maximum age"
+        if not isinstance(data.get("pool_reap_on_idle", True), bool):
+            errors["pool_reap_on_idle"] = "Invalid session pool reaping setting"
+        # Check additional hypervisors
+        hypervisors = data.get("hypervisors", [])
+        hosts = [data["host"]]
+        if not isinstance(hypervisors, list):
+            errors["hypervisors"] = "Invalid additional hypervisors"
+        else:
+            for hypervisor in hypervisors:
+                if (
+                    not isinstance(hypervisor, dict)
+                    or not required
+                    <= set(hypervisor)
+                    <= required | set(self.DEFAULT_HYPERVISOR_CAPACITY_CONF)
+                    or self.check_hypervisor_data(hypervisor)
+                    or hypervisor["host"] in hosts
+                ):
+                    errors["hypervisors"] = "Invalid additional hypervisors"
+                    break
+                hosts.append(hypervisor["host"])
 
         if errors:
             return json.dumps({"status": False, "errors": errors})
@@ -442,6 +1039,16 @@ class FleetCommanderDbusService(dbus.service.Object):
     @dbus.service.method(DBUS_INTERFACE_NAME, in_signature="s", out_signature="s")
     def SetHypervisorConfig(self, jsondata):
         data = json.loads(jsondata)
+        # Keep session pool and multiple hypervisor settings not managed by
+        # the caller
+        current = self.db.config.get("hypervisor", {})
+        for key in (
+            list(self.DEFAULT_HYPERVISOR_POOL_CONF)
+            + list(self.DEFAULT_HYPERVISOR_CAPACITY_CONF)
+            + ["hypervisors"]
+        ):
+            if key in current and key not in data:
+                data[key] = current[key]
         # Save hypervisor configuration
         self.db.config["hypervisor"] = data
         return json.dumps({"status": True})
@@ -452,7 +1059,7 @@ class FleetCommanderDbusService(dbus.service.Object):
         host, port = self.parse_hypervisor_hostname(hostname)
 
         # Check if hypervisor is a known host
-        known = self.ssh.check_known_host(self.known_hosts_file, host)
+        known = self.ssh.check_known_host(self.known_hosts_file, host, port)
 
         if not known:
             # Obtain SSH fingerprint for host
@@ -480,7 +1087,7 @@ class FleetCommanderDbusService(dbus.service.Object):
         host, port = self.parse_hypervisor_hostname(hostname)
 
         # Check if hypervisor is a known host
-        known = self.ssh.check_known_host(self.known_hosts_file, host)
+        known = self.ssh.check_known_host(self.known_hosts_file, host, port)
 
         if not known:
             try:
@@ -493,6 +1100,113 @@ class FleetCommanderDbusService(dbus.service.Object):
 
         return json.dumps({"status": True})
 
+    def parse_hypervisor_hostnames(self, hostnames):
+        """
+        Parses a list of hypervisor hostnames
+        """
+        if (
+            not isinstance(hostnames, list)
+            or not all(isinstance(h, str) and h for h in hostnames)
+            or len(hostnames) > self.MAX_KNOWN_HOSTS_CHECK
+        ):
+            raise ValueError("Invalid hostnames list")
+        return {
+            hostname: self.parse_hypervisor_hostname(hostname) for hostname in hostnames
+        }
+
+    @set_last_call_time
+    @dbus.service.method(DBUS_INTERFACE_NAME, in_signature="s", out_signature="s")
+    def CheckKnownHosts(self, jsondata):
+        try:
+            hostnames = self.parse_hypervisor_hostnames(json.loads(jsondata))
+        except Exception as e:
+            logger.error("Error checking known hosts: %s", e)
+            return json.dumps({"status": False, "error": "Invalid hostnames list"})
+
+        hosts = {}
+        # Hostnames by host and port, as "host" and "host:22" are the same
+        unknown = {}
+        for hostname, (host, port) in hostnames.items():
+            if self.ssh.check_known_host(self.known_hosts_file, host, port):
+                hosts[hostname] = {"status": True}
+            else:
+                unknown.setdefault((host, str(port)), []).append(hostname)
+
+        # Obtain SSH fingerprints for unknown hosts. Scans run concurrently
+        # but still block this D-Bus call for up to HOST_KEYSCAN_TIMEOUT, or
+        # a multiple of it with more unknown hosts than scan workers
+        keys, errors = self.ssh.scan_hosts_keys(
+            list(unknown), timeout=self.HOST_KEYSCAN_TIMEOUT
+        )
+        for host, key_data in keys.items():
+            try:
+                result = {
+                    "status": False,
+                    "fprint": self.ssh.get_fingerprint_from_key_data(key_data),
+                    "keys": key_data,
+                }
+            except Exception as e:
+                errors[host] = e
+                continue
+            for hostname in unknown[host]:
+                hosts[hostname] = dict(result)
+        for host, error in errors.items():
+            logger.error("Error getting hypervisor %s fingerprint: %s", host, error)
+            for hostname in unknown[host]:
+                hosts[hostname] = {
+                    "status": False,
+                    "error": "Error connecting to SSH service.",
+                }
+
+        return json.dumps({"status": True, "hosts": hosts})
+
+    @set_last_call_time
+    @dbus.service.method(DBUS_INTERFACE_NAME, in_signature="s", out_signature="s")
+    def AddKnownHosts(self, jsondata):
+        """
+        Adds keys previously returned by CheckKnownHosts for accepted hosts
+        """
+        try:
+            accepted = json.loads(jsondata)
+            if not isinstance(accepted, dict):
+                raise ValueError("Invalid hosts data")
+            hostnames = self.parse_hypervisor_hostnames(list(accepted))
+        except Exception as e:
+            logger.error("Error adding known hosts: %s", e)
+            return json.dumps({"status": False, "error": "Invalid hosts data"})
+
+        key_data = []
+        errors = {}
+        for hostname, (host, port) in hostnames.items():
+            if self.ssh.check_known_host(self.known_hosts_file, host, port):
+                continue
+            keys = accepted[hostname]
+            # Only accept keys for the given host
+            names = {host, "[{}]:{}".format(host, port)}
+            lines = [line for line in str(keys).splitlines() if line and line[0] != "#"]
+            try:
+                if not lines or any(line.split()[0] not in names for line in lines):
+                    raise ValueError("Key data does not belong to host")
+                self.ssh.get_fingerprint_from_key_data("\n".join(lines))
+            except Exception as e:
+                logger.error("Invalid key data for %s: %s", hostname, e)
+                errors[hostname] = "Invalid key data"
+                continue
+            key_data.extend(lines)
+
+        if key_data:
+            try:
+                self.ssh.add_keys_to_known_hosts(
+                    self.known_hosts_file, "\n".join(key_data) + "\n"
+                )
+            except Exception as e:
+                logger.error("Error adding hosts to known hosts: %s", e)
+                return json.dumps(
+                    {"status": False, "error": "Error adding hosts to known hosts"}
+                )
+
+        return json.dumps({"status": not errors, "errors": errors})
+
     @set_last_call_time
     @dbus.service.method(DBUS_INTERFACE_NAME, in_signature="sss", out_signature="s")
     def InstallPubkey(self, hostname, user, passwd):
@@ -587,7 +1301,7 @@ class FleetCommanderDbusService(dbus.service.Object):
     @dbus.service.method(DBUS_INTERFACE_NAME, in_signature="", out_signature="s")
     def GetProfiles(self):
         try:
-            profiles = self.realm_connector.get_profiles()
+            profiles = list(self.realm_connector.get_profiles())
             logger.debug("Profiles data fetched: %s", profiles)
             return json.dumps({"status": True, "data": profiles})
         except Exception as e:
@@ -612,6 +1326,24 @@ class FleetCommanderDbusService(dbus.service.Object):
                 }
             )
 
+    @set_last_call_time
+    @dbus.service.method(DBUS_INTERFACE_NAME, in_signature="s", out_signature="s")
+    def ValidateApplies(self, applies):
+        applies = json.loads(applies)
+        logger.debug("Validating profile applies: %s", applies)
+        try:
+            result = self.realm_connector.check_applies(applies)
+        except Exception as e:
+            logger.error("Error validating profile applies: %s", e)
+            return json.dumps(
+                {"status": False, "error": "Error validating profile applies"}
+            )
+        data = {
+            key: {"found": sorted(found), "missing": sorted(missing)}
+            for key, (found, missing) in result.items()
+        }
+        return json.dumps({"status": True, "data": data})
+
     @set_last_call_time
     @dbus.service.method(DBUS_INTERFACE_NAME, in_signature="s", out_signature="s")
     def DeleteProfile(self, name):
@@ -628,44 +1360,110 @@ class FleetCommanderDbusService(dbus.service.Object):
     def ListDomains(self):
         domains = self.get_domains()
         if domains is not None:
-            return json.dumps({"status": True, "domains": domains})
+            return json.dumps({"status": True, "domains": self.merge_domains(domains)})
         return json.dumps({"status": False, "error": "Error retrieving domains"})
 
     @set_last_call_time
-    @dbus.service.method(DBUS_INTERFACE_NAME, in_signature="s", out_signature="s")
-    def SessionStart(self, domain_uuid):
+    @dbus.service.method(
+        DBUS_INTERFACE_NAME,
+        in_signature="s",
+        out_signature="s",
+        async_callbacks=("reply_handler", "error_handler"),
+    )
+    def SessionStart(self, domain_uuid, reply_handler, error_handler):
+
+        logger.debug("Starting new session from domain %s", domain_uuid)
+
+        def session_started(lvirtctrlr, host, session_params, error):
+            if error is not None:
+                logger.error("Error starting session: %s", error)
+                reply_handler(
+                    json.dumps(
+                        {
+                            "status": False,
+                            "error": "Error starting session: {}".format(error),
+                        }
+                    )
+                )
+                return
+
+            self.db.sessions[session_params.domain] = {
+                "template": domain_uuid,
+                "connection_details": session_params.details,
+                "started": time.time(),
+                "spice_wait_time": lvirtctrlr.stats["spice_wait_time"],
+                "hypervisor": host,
+                # Needed to open tunnel again after a service restart
+                "tunnel": lvirtctrlr.tunnel_forwards(session_params.domain),
+            }
+            logger.info(
+                "Session %s started in %s. SPICE wait time: %s",
+                session_params.domain,
+                host,
+                lvirtctrlr.stats["spice_wait_time"],
+            )
+            self._session_heartbeats[session_params.domain] = time.time()
 
-        logger.debug("Starting new session")
-        if self.db.config.get("uuid", None) is not None:
-            logger.error("Session already started")
-            return json.dumps({"status": False, "error": "Session already started"})
+            # Do not wait for the domain event to know about the new session
+            self.invalidate_domain_inventory(host)
 
-        try:
-            lvirtctrlr = self.get_libvirt_controller()
-            session_params = lvirtctrlr.session_start(
-                domain_uuid, debug_logger=self.args["debug_logger"]
-            )
-        except Exception as e:
-            logger.error("Error starting session: %s", e)
-            return json.dumps(
-                {"status": False, "error": "Error starting session: {}".format(e)}
+            # Replace claimed pooled domain in background
+            self.schedule_session_pool_check()
+
+            reply_handler(
+                json.dumps(
+                    {
+                        "status": True,
+                        "uuid": session_params.domain,
+                        "connection_details": session_params.details,
+                    }
+                )
             )
 
-        self.db.config["uuid"] = session_params.domain
-        self.db.config["connection_details"] = session_params.details
+        def start_done(lvirtctrlr, host, session_params, error):
+            try:
+                session_started(lvirtctrlr, host, session_params, error)
+            except Exception as e:
+                logger.error("Error recording started session: %s", e)
+                error_handler(e)
 
-        return json.dumps(
-            {"status": True, "connection_details": session_params.details}
-        )
+        # Domain start waits for its SPICE port, so it runs in background
+        self.start_session_domain(domain_uuid, start_done)
 
     @set_last_call_time
-    @dbus.service.method(DBUS_INTERFACE_NAME, in_signature="", out_signature="s")
-    def SessionStop(self):
-        status, msg = self.stop_current_session()
+    @dbus.service.method(DBUS_INTERFACE_NAME, in_signature="s", out_signature="s")
+    def SessionStop(self, session_uuid):
+        status, msg = self.stop_session(session_uuid)
         if status:
             return json.dumps({"status": True})
         return json.dumps({"status": False, "error": msg})
 
+    @set_last_call_time
+    @dbus.service.method(DBUS_INTERFACE_NAME, in_signature="", out_signature="s")
+    def ListSessions(self):
+        sessions = [
+            {
+                "uuid": session_uuid,
+                "template": session["template"],
+                "started": session["started"],
+                "spice_wait_time": session.get("spice_wait_time"),
+                "hypervisor": session.get("hypervisor"),
+                "tunnel": None,
+            }
+            for session_uuid, session in self.db.sessions.items()
+        ]
+        # Add SSH tunnel health and traffic counters
+        controllers = {}
+        for session in sessions:
+            host = session["hypervisor"]
+            try:
+                if host not in controllers:
+                    controllers[host] = self.get_libvirt_controller(host)
+                session["tunnel"] = controllers[host].tunnel_stats(session["uuid"])
+            except Exception as e:
+                logger.error("Error getting SSH tunnel statistics: %s", e)
+        return json.dumps({"status": True, "sessions": sessions})
+
     @set_last_call_time
     @dbus.service.method(DBUS_INTERFACE_NAME, in_signature="ss", out_signature="s")
     def SessionSave(self, uid, data):
@@ -733,22 +1531,26 @@ class FleetCommanderDbusService(dbus.service.Object):
     @dbus.service.method(DBUS_INTERFACE_NAME, in_signature="s", out_signature="b")
     def IsSessionActive(self, uuid):
         if uuid == "":
-            # Asking for current session
-            if "uuid" in self.db.config:
-                logger.debug(
-                    "Checking for default session with uuid: %s", self.db.config["uuid"]
-                )
-                uuid = self.db.config["uuid"]
-            else:
-                logger.debug("Default session not started")
+            logger.debug("No session uuid given")
+            return False
+
+        session = self.db.sessions.get(uuid)
+        if session is not None and "hypervisor" in session:
+            hosts = [session["hypervisor"]]
+        else:
+            try:
+                hosts = [h["host"] for h in self.get_hypervisors()]
+            except Exception as e:
+                logger.error("Error checking session %s: %s", uuid, e)
                 return False
 
-        domains = self.get_domains()
-        for domain in domains:
-            if domain["uuid"] == uuid:
-                logger.debug("Session found: %s", domain)
-                return domain["active"]
-        logger.debug("Given session uuid not found in domains")
+        for host in hosts:
+            try:
+                if self.get_domain_inventory(host).is_active(uuid):
+                    return True
+            except Exception as e:
+                logger.error("Error checking session %s: %s", uuid, e)
+                self.drop_domain_inventory(host)
         return False
 
     @set_last_call_time
@@ -22,22 +22,15 @@
 from __future__ import absolute_import
 import json
 import logging
-from functools import wraps
+import time
+import zlib
 
 from ipalib import api
 from ipalib import errors
 
-logger = logging.getLogger(__name__)
-
-
-def connection_required(f):
-    @wraps(f)
-    def wrapped(obj, *args, **kwargs):
-        if not api.isdone("bootstrap"):
-            obj.connect()
-        return f(obj, *args, **kwargs)
+from .connection import connection_required
 
-    return wrapped
+logger = logging.getLogger(__name__)
 
 
 class IPAConnectionError(Exception):
@@ -48,7 +41,38 @@ class RenameToExistingException(Exception):
     pass
 
 
+class IPACommandError(Exception):
+    pass
+
+
 class FreeIPAConnector:
+
+    # Seconds the connection is trusted after its last successful use
+    HEALTH_CHECK_INTERVAL = 60
+
+    # Profile settings bigger than this size in bytes are stored compressed
+    # when enabled, prefixed by magic string
+    COMPRESS_THRESHOLD = 8192
+    COMPRESS_MAGIC = b"FCZ1"
+
+    # Show command for each kind of profile applies
+    APPLIES_SHOW_COMMANDS = {
+        "users": "user_show",
+        "groups": "group_show",
+        "hosts": "host_show",
+        "hostgroups": "hostgroup_show",
+    }
+
+    # Connection state and statistics are shared by the whole process, as the
+    # IPA API object is
+    _state = {"last_used": None, "sanity_checked": False}
+    stats = {"connects": 0, "reconnects": 0, "pings": 0}
+
+    def __init__(self, compress_profiles=False):
+        self._in_call = False
+        # Compressed profiles can not be read by older clients
+        self.compress_profiles = compress_profiles
+
     def connect(self, sanity_check=True):
         """
         Connect to FreeIPA server
@@ -57,25 +81,90 @@ class FreeIPAConnector:
             if not api.isdone("bootstrap"):
                 api.bootstrap(context="fleetcommander", log=None)
                 api.finalize()
-            if not api.Backend.rpcclient.isconnected():
+            if api.Backend.rpcclient.isconnected():
+                # Skip ping when connection was used recently
+                last_used = self._state["last_used"]
+                if (
+                    last_used is not None
+                    and time.monotonic() - last_used < self.HEALTH_CHECK_INTERVAL
+                    and (self._state["sanity_checked"] or not sanity_check)
+                ):
+                    return
+            else:
+                api.Backend.rpcclient.connect()
+                self.stats["connects"] += 1
+            try:
+                self._ping()
+            except self._connection_errors():
+                # Stale connection. Open a new one
+                logger.debug("FreeIPAConnector: Connection not usable. Reconnecting")
+                self.stats["reconnects"] += 1
+                self.disconnect()
                 api.Backend.rpcclient.connect()
-            api.Command.ping()
-            # Sanity check
-            if sanity_check:
+                self.stats["connects"] += 1
+                self._ping()
+            # Sanity check is done once per process
+            if sanity_check and not self._state["sanity_checked"]:
                 self._do_sanity_check()
+                self._state["sanity_checked"] = True
         except Exception as e:
             logger.error("FreeIPAConnector: Error connecting to FreeIPA: %s", e)
             raise
+        self._state["last_used"] = time.monotonic()
+
+    def _ping(self):
+        self.stats["pings"] += 1
+        api.Command.ping()
+
+    def _connection_used(self):
+        self._state["last_used"] = time.monotonic()
+
+    @staticmethod
+    def _connection_errors():
+        return (errors.NetworkError, errors.KerberosError, errors.SessionError)
+
+    def disconnect(self):
+        """
+        Close connection to FreeIPA server
+        """
+        self._state["last_used"] = None
+        try:
+            if api.Backend.rpcclient.isconnected():
+                api.Backend.rpcclient.disconnect()
+        except Exception as e:
+            logger.debug("FreeIPAConnector: Error closing connection: %s", e)
 
     def _prepare_profile_base_args(self, profile):
         name = str(profile["name"])
         settings = json.dumps(profile["settings"]).encode()
+        if self.compress_profiles and len(settings) > self.COMPRESS_THRESHOLD:
+            compressed = self.COMPRESS_MAGIC + zlib.compress(settings, 9)
+            logger.debug(
+                "FreeIPAConnector: Compressed settings of profile %s from %s to "
+                "%s bytes",
+                name,
+                len(settings),
+                len(compressed),
+            )
+            if len(compressed) < len(settings):
+                settings = compressed
         return {
             "cn": name,
             "description": profile["description"],
             "ipadeskdata": settings,
         }
 
+    @classmethod
+    def _load_profile_settings(cls, ipadeskdata):
+        """
+        Load profile settings from plain or compressed JSON data
+        """
+        if isinstance(ipadeskdata, str):
+            ipadeskdata = ipadeskdata.encode()
+        if ipadeskdata.startswith(cls.COMPRESS_MAGIC):
+            ipadeskdata = zlib.decompress(ipadeskdata[len(cls.COMPRESS_MAGIC) :])
+        return json.loads(ipadeskdata)
+
     def _create_profile(self, profile):
         name = str(profile["name"])
         logger.debug(
@@ -159,11 +248,34 @@ class FreeIPAConnector:
         # Update rules for profile
         self._update_profile_rules(profile, oldname=oldname)
 
+    def _batch(self, commands, ignore=()):
+        """
+        Run (method, args, options) commands in a single batch call and return
+        their results. Failures other than ignored error names are raised
+        """
+        result = api.Command.batch(
+            *[
+                {"method": method, "params": [list(args), options]}
+                for method, args, options in commands
+            ]
+        )
+        results = result["results"]
+        for (method, args, _options), res in zip(commands, results):
+            error = res.get("error")
+            if error is not None and res.get("error_name") not in ignore:
+                logger.error(
+                    "FreeIPAConnector: Error running %s for %s: %s",
+                    method,
+                    args,
+                    error,
+                )
+                raise IPACommandError("%s: %s" % (method, error))
+        return results
+
     def _update_profile_rules(self, profile, oldname=None):
         name = str(profile["name"])
 
         parms = {
-            "cn": name,
             "ipadeskprofiletarget": name,
             "ipadeskprofilepriority": profile["priority"],
         }
@@ -173,97 +285,118 @@ class FreeIPAConnector:
             logger.debug(
                 "FreeIPAConnector: Updating rule %s and renaming to %s", oldname, name
             )
-            parms["cn"] = oldname
-            parms["rename"] = name
+            rule_parms = dict(parms, cn=oldname, rename=name)
         else:
             logger.debug("FreeIPAConnector: Updating rule for %s", name)
+            rule_parms = dict(parms, cn=name)
 
         # If not hosts, set hostcategory to all
         if profile["hosts"] == [] and profile["hostgroups"] == []:
-            parms["hostcategory"] = "all"
+            rule_parms["hostcategory"] = "all"
         else:
-            parms["hostcategory"] = None
+            rule_parms["hostcategory"] = None
+
+        # Update rule and get current users, groups, hosts and hostgroups
+        results = self._batch(
+            [
+                ("deskprofilerule_mod", (), rule_parms),
+                ("deskprofilerule_show", (name,), {"all": True}),
+            ],
+            ignore=("EmptyModlist",),
+        )
+        applies = self._get_profile_applies_from_rule(results[1]["result"])
 
-        try:
-            api.Command.deskprofilerule_mod(**parms)
-        except errors.EmptyModlist:
-            pass
-        except Exception as e:
-            logger.error(
-                "FreeIPAConnector: Error updating rule %s: %s - %s",
-                name,
-                e,
-                e.__class__,
+        def members_command(method, **members):
+            return (
+                method,
+                (name,),
+                {key: [str(x) for x in values] for key, values in members.items()},
             )
-            raise e
 
-        # Get current users, groups, hosts and hostgroups for this rule
-        rule = self.get_profile_rule(name)
-        applies = self._get_profile_applies_from_rule(rule)
-        # Get users and groups to add
-        udif = set(profile["users"]) - set(applies["users"])
-        gdif = set(profile["groups"]) - set(applies["groups"])
-        # Add the users and groups to rule
-        api.Command.deskprofilerule_add_user(
-            name,
-            user=[str(x) for x in udif],
-            group=[str(x) for x in gdif],
-        )
-        # Get users and groups to remove
-        udif = set(applies["users"]) - set(profile["users"])
-        gdif = set(applies["groups"]) - set(profile["groups"])
-        # Remove users and groups from rule
-        api.Command.deskprofilerule_remove_user(
-            name,
-            user=[str(x) for x in udif],
-            group=[str(x) for x in gdif],
-        )
-
-        if parms["hostcategory"] == "all":
-            api.Command.deskprofilerule_remove_host(
-                name,
-                host=[str(x) for x in applies["hosts"]],
-                hostgroup=[str(x) for x in applies["hostgroups"]],
+        # Add missing users and groups, and remove the ones not in profile.
+        # Commands without changes are skipped
+        commands = []
+        users_add = set(profile["users"]) - set(applies["users"])
+        groups_add = set(profile["groups"]) - set(applies["groups"])
+        if users_add or groups_add:
+            commands.append(
+                members_command(
+                    "deskprofilerule_add_user", user=users_add, group=groups_add
+                )
             )
+        users_remove = set(applies["users"]) - set(profile["users"])
+        groups_remove = set(applies["groups"]) - set(profile["groups"])
+        if users_remove or groups_remove:
+            commands.append(
+                members_command(
+                    "deskprofilerule_remove_user",
+                    user=users_remove,
+                    group=groups_remove,
+                )
+            )
+
+        # Same for hosts and hostgroups, removing all if hostcategory is all
+        if rule_parms["hostcategory"] == "all":
+            hosts_add = hostgroups_add = set()
+            hosts_remove = set(applies["hosts"])
+            hostgroups_remove = set(applies["hostgroups"])
         else:
-            # Get hosts and hostgroups to add
-            hdif = set(profile["hosts"]) - set(applies["hosts"])
-            hgdif = set(profile["hostgroups"]) - set(applies["hostgroups"])
-            # Add the hosts and hostgroups to rule
-            api.Command.deskprofilerule_add_host(
-                name,
-                host=[str(x) for x in hdif],
-                hostgroup=[str(x) for x in hgdif],
+            hosts_add = set(profile["hosts"]) - set(applies["hosts"])
+            hostgroups_add = set(profile["hostgroups"]) - set(applies["hostgroups"])
+            hosts_remove = set(applies["hosts"]) - set(profile["hosts"])
+            hostgroups_remove = set(applies["hostgroups"]) - set(profile["hostgroups"])
+        add_host_index = None
+        if hosts_add or hostgroups_add:
+            add_host_index = len(commands)
+            commands.append(
+                members_command(
+                    "deskprofilerule_add_host", host=hosts_add, hostgroup=hostgroups_add
+                )
             )
-            # Get hosts and hostgroups to remove
-            hdif = set(applies["hosts"]) - set(profile["hosts"])
-            hgdif = set(applies["hostgroups"]) - set(profile["hostgroups"])
-            # Remove hosts and hostgroups from rule
-            api.Command.deskprofilerule_remove_host(
-                name,
-                host=[str(x) for x in hdif],
-                hostgroup=[str(x) for x in hgdif],
+        if hosts_remove or hostgroups_remove:
+            commands.append(
+                members_command(
+                    "deskprofilerule_remove_host",
+                    host=hosts_remove,
+                    hostgroup=hostgroups_remove,
+                )
             )
 
-            # Check final hosts and set hostcategory to all if needed
-            rule = self.get_profile_rule(name)
-            applies = self._get_profile_applies_from_rule(rule)
-            logger.debug("FreeIPAConnector: Applies after update: %s", applies)
-            if not applies["hosts"] and not applies["hostgroups"]:
-                logger.debug("FreeIPAConnector: Setting hostcategory to all")
-                parms["hostcategory"] = "all"
-                try:
-                    api.Command.deskprofilerule_mod(**parms)
-                except errors.EmptyModlist:
-                    pass
-                except Exception as e:
-                    logger.error(
-                        "FreeIPAConnector: Error updating rule %s: %s - %s",
-                        name,
-                        e,
-                        e.__class__,
-                    )
-                    raise e
+        if not commands:
+            logger.debug("FreeIPAConnector: Rule %s members are up to date", name)
+            return
+        results = self._batch(commands)
+
+        if rule_parms["hostcategory"] == "all":
+            return
+
+        # Check final hosts from the changes made, skipping the ones IPA
+        # failed to add, and set hostcategory to all if needed
+        failed_hosts = set()
+        failed_hostgroups = set()
+        if add_host_index is not None:
+            failed = results[add_host_index].get("failed", {}).get("memberhost", {})
+            failed_hosts = {str(x[0]) for x in failed.get("host", ())}
+            failed_hostgroups = {str(x[0]) for x in failed.get("hostgroup", ())}
+        hosts = (set(applies["hosts"]) - hosts_remove) | (hosts_add - failed_hosts)
+        hostgroups = (set(applies["hostgroups"]) - hostgroups_remove) | (
+            hostgroups_add - failed_hostgroups
+        )
+        logger.debug("FreeIPAConnector: Hosts after update: %s, %s", hosts, hostgroups)
+        if not hosts and not hostgroups:
+            logger.debug("FreeIPAConnector: Setting hostcategory to all")
+            try:
+                api.Command.deskprofilerule_mod(cn=name, hostcategory="all", **parms)
+            except errors.EmptyModlist:
+                pass
+            except Exception as e:
+                logger.error(
+                    "FreeIPAConnector: Error updating rule %s: %s - %s",
+                    name,
+                    e,
+                    e.__class__,
+                )
+                raise e
 
     def _get_all_hosts(self):
         try:
@@ -338,6 +471,66 @@ class FreeIPAConnector:
         except errors.NotFound:
             return False
 
+    def _check_exist(self, names):
+        """
+        Check names by applies key exist using a single batch call.
+        Returns (found, missing) sets by applies key
+        """
+        commands = []
+        keys = []
+        for key, values in names.items():
+            for name in set(values):
+                commands.append((self.APPLIES_SHOW_COMMANDS[key], (str(name),), {}))
+                keys.append((key, name))
+        result = {key: (set(), set()) for key in names}
+        if commands:
+            results = self._batch(commands, ignore=("NotFound",))
+            for (key, name), res in zip(keys, results):
+                found, missing = result[key]
+                if res.get("error") is None:
+                    found.add(name)
+                else:
+                    missing.add(name)
+        return result
+
+    @connection_required
+    def check_users_exist(self, usernames):
+        """
+        Check users exist. Returns sets of found and missing names
+        """
+        return self._check_exist({"users": usernames})["users"]
+
+    @connection_required
+    def check_groups_exist(self, groupnames):
+        """
+        Check groups exist. Returns sets of found and missing names
+        """
+        return self._check_exist({"groups": groupnames})["groups"]
+
+    @connection_required
+    def check_hosts_exist(self, hostnames):
+        """
+        Check hosts exist. Returns sets of found and missing names
+        """
+        return self._check_exist({"hosts": hostnames})["hosts"]
+
+    @connection_required
+    def check_hostgroups_exist(self, groupnames):
+        """
+        Check hostgroups exist. Returns sets of found and missing names
+        """
+        return self._check_exist({"hostgroups": groupnames})["hostgroups"]
+
+    @connection_required
+    def check_applies(self, applies):
+        """
+        Check users, groups, hosts and hostgroups of profile applies exist
+        in a single call. Returns (found, missing) sets by applies key
+        """
+        return self._check_exist(
+            {key: applies.get(key, []) for key in self.APPLIES_SHOW_COMMANDS}
+        )
+
     @connection_required
     def check_profile_exists(self, name):
         try:
@@ -351,7 +544,7 @@ class FreeIPAConnector:
         policydata = api.Command.deskprofileconfig_show()
         return int(policydata["result"]["ipadeskprofilepriority"][0])
 
-    @connection_required
+    @connection_required(retry=False)
     def set_global_policy(self, policy):
         try:
             api.Command.deskprofileconfig_mod(ipadeskprofilepriority=policy)
@@ -363,7 +556,7 @@ class FreeIPAConnector:
             )
             raise e
 
-    @connection_required
+    @connection_required(retry=False)
     def save_profile(self, profile):
         name = profile["name"]
         # Check if profile has an "oldname" field so we need to rename it
@@ -400,7 +593,7 @@ class FreeIPAConnector:
         logger.debug("FreeIPAConnector: Profile %s does not exist. Creating", name)
         return self._create_profile(profile)
 
-    @connection_required
+    @connection_required(retry=False)
     def del_profile(self, name):
         name = str(name)
         logger.debug("FreeIPAConnector: Deleting profile %s", name)
@@ -447,12 +640,19 @@ class FreeIPAConnector:
     def get_profile(self, name):
         name = str(name)
         try:
-            result = api.Command.deskprofile_show(name, all=True)
+            results = self._batch(
+                [
+                    ("deskprofile_show", (name,), {"all": True}),
+                    ("deskprofilerule_show", (name,), {"all": True}),
+                ]
+            )
         except Exception as e:
             logger.error("Error getting profile %s: %s. %s", name, e, e.__class__)
             raise e
-        rule = self.get_profile_rule(name)
-        data = result["result"]
+        rule = results[1]["result"]
+        logger.debug("FreeIPAConnector: Obtained rule data: %s", rule)
+
+        data = results[0]["result"]
 
         logger.debug("Decoding ipadeskdata")
 
@@ -460,7 +660,7 @@ class FreeIPAConnector:
             "name": data["cn"][0],
             "description": data.get("description", ("",))[0],
             "priority": int(rule["ipadeskprofilepriority"][0]),
-            "settings": json.loads(data["ipadeskdata"][0]),
+            "settings": self._load_profile_settings(data["ipadeskdata"][0]),
         }
         applies = self._get_profile_applies_from_rule(rule)
         profile.update(applies)
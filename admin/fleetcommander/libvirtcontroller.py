@@ -20,12 +20,15 @@
 #          Oliver Gutiérrez <ogutierrez@redhat.com>
 
 from __future__ import absolute_import
-from __future__ import print_function
 
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import binascii
+import hashlib
+import io
 import os
+import threading
 import time
 import uuid
 import xml.etree.ElementTree as ET
@@ -34,6 +37,7 @@ import logging
 import libvirt
 
 from . import sshcontroller
+from . import sshtunnel
 
 logger = logging.getLogger(__name__)
 
@@ -51,10 +55,12 @@ class LibVirtController:
     DEFAULT_LIBVIRTD_SOCKET = "$XDG_RUNTIME_DIR/libvirt/libvirt-sock"
     DEFAULT_LIBVIRT_VIDEO_DRIVER = "virtio"
     LIBVIRT_URL_TEMPLATE = "qemu+ssh://%s@%s/%s"
-    MAX_SESSION_START_TRIES = 3
-    SESSION_START_TRIES_DELAY = 0.1
+    SPICE_READY_TIMEOUT = 10
+    SPICE_READY_POLL_INTERVAL = 0.05
+    SPICE_READY_MAX_POLL_INTERVAL = 0.5
     MAX_DOMAIN_UNDEFINE_TRIES = 3
     DOMAIN_UNDEFINE_TRIES_DELAY = 0.1
+    MAX_TEARDOWN_WORKERS = 4
     channel = None
     viewer = None
     _VIDEO_DRIVER_CMD = (
@@ -69,6 +75,32 @@ class LibVirtController:
     )
     _XDG_RUNTIMEDIR_CMD = 'echo "$XDG_RUNTIME_DIR"'
 
+    # libvirt event loop is shared by all controllers
+    _event_loop_lock = threading.Lock()
+    _event_loop_thread = None
+    # Delay between failed event loop iterations doubles up to the maximum
+    EVENT_LOOP_ERROR_DELAY = 0.1
+    EVENT_LOOP_MAX_ERROR_DELAY = 5
+
+    # Prepared template domains XML shared by all controllers
+    TEMPLATE_CACHE_SIZE = 32
+    _template_cache = OrderedDict()
+    _template_cache_lock = threading.Lock()
+    _TEMPLATE_UUID_MARK = "@FC_SESSION_UUID@"
+    _TEMPLATE_NAME_MARK = "@FC_SESSION_NAME@"
+    _TEMPLATE_TICKET_MARK = "@FC_SESSION_TICKET@"
+    _TEMPLATE_CHANNELS_TAG = "fc-session-channels"
+
+    # Domain titles shared by all controllers to save metadata requests
+    TITLE_CACHE_TTL = 300
+    TITLE_CACHE_SIZE = 1024
+    _title_cache = OrderedDict()
+    _title_cache_lock = threading.Lock()
+
+    # Supervised SSH tunnels shared by all controllers
+    _tunnel_manager = None
+    _tunnel_manager_lock = threading.Lock()
+
     def __init__(self, data_path, username, hostname, mode):
         """
         Class initialization
@@ -115,6 +147,11 @@ class LibVirtController:
         self._last_started_domain = None
         self._last_stopped_domain = None
 
+        # Operational statistics
+        self.stats = {
+            "spice_wait_time": None,
+        }
+
         self.session_params = namedtuple(
             "session_params",
             [
@@ -123,6 +160,23 @@ class LibVirtController:
             ],
         )
 
+        self.pool_params = namedtuple(
+            "pool_params",
+            [
+                "domain",
+                "ticket",
+            ],
+        )
+
+        self.spice_params = namedtuple(
+            "spice_params",
+            [
+                "port",
+                "tls_port",
+                "passwd",
+            ],
+        )
+
     def add_notifier_channel(self, parent, name, domain_name, alias=None):
         raise NotImplementedError
 
@@ -132,6 +186,18 @@ class LibVirtController:
     def add_spice_secure(self, elem):
         raise NotImplementedError
 
+    def get_session_name(self, identifier):
+        """
+        Get temporary domain name for given session UUID
+        """
+        return "fc-{}".format(identifier[:8])
+
+    def _get_local_socket_path(self, session_name, kind):
+        local_runtime_dir = os.environ["XDG_RUNTIME_DIR"]
+        return os.path.join(
+            local_runtime_dir, "{}-{}.socket".format(session_name, kind)
+        )
+
     def generate_spice_ticket(self):
         # taken from token_hex (Python3.6+)
         return binascii.hexlify(os.urandom(16)).decode("ascii")
@@ -226,6 +292,93 @@ class LibVirtController:
         self._get_libvirt_video_driver()
         logger.debug("Ended checking remote environment.")
 
+    @classmethod
+    def start_event_loop(cls):
+        """
+        Runs libvirt default event loop in a background thread.
+        It must be registered before opening connections to get events
+        """
+        with cls._event_loop_lock:
+            if cls._event_loop_thread is not None:
+                return
+
+            libvirt.virEventRegisterDefaultImpl()
+
+            def run_event_loop():
+                delay = cls.EVENT_LOOP_ERROR_DELAY
+                while True:
+                    try:
+                        if libvirt.virEventRunDefaultImpl() != -1:
+                            delay = cls.EVENT_LOOP_ERROR_DELAY
+                            continue
+                        error = "unknown error"
+                    except libvirt.libvirtError as e:
+                        error = e
+                    # Do not spin while the event loop keeps failing
+                    logger.error(
+                        "libvirt event loop failed (retrying in %ss): %s", delay, error
+                    )
+                    time.sleep(delay)
+                    delay = min(delay * 2, cls.EVENT_LOOP_MAX_ERROR_DELAY)
+
+            cls._event_loop_thread = threading.Thread(
+                target=run_event_loop, name="libvirt-event-loop", daemon=True
+            )
+            cls._event_loop_thread.start()
+            logger.debug("Started libvirt event loop")
+
+    @classmethod
+    def get_tunnel_manager(cls):
+        """
+        Get SSH tunnel manager shared by all controllers
+        """
+        with cls._tunnel_manager_lock:
+            if LibVirtController._tunnel_manager is None:
+                LibVirtController._tunnel_manager = sshtunnel.SSHTunnelManager(
+                    sshcontroller.SSHController()
+                )
+            return LibVirtController._tunnel_manager
+
+    def tunnel_stats(self, identifier):
+        """
+        Get SSH tunnel statistics for given session UUID
+        """
+        return self.get_tunnel_manager().get_stats(
+            self.ssh.get_control_socket(self.get_session_name(identifier))
+        )
+
+    def tunnel_forwards(self, identifier):
+        """
+        Get SSH tunnel local forwards for given session UUID
+        """
+        return self.get_tunnel_manager().get_forwards(
+            self.ssh.get_control_socket(self.get_session_name(identifier))
+        )
+
+    @classmethod
+    def close_tunnels(cls):
+        """
+        Stop all SSH tunnels of this process
+        """
+        with cls._tunnel_manager_lock:
+            manager = LibVirtController._tunnel_manager
+        if manager is not None:
+            manager.close_all()
+
+    def session_restore_tunnel(self, identifier, local_forwards):
+        """
+        Opens again SSH tunnel of a session started by a previous process
+        """
+        session_name = self.get_session_name(identifier)
+        # Tunnel can be still running if previous process was killed
+        try:
+            self._close_ssh_tunnel(session_name)
+        except LibVirtControllerException:
+            pass
+        self._open_ssh_tunnel(
+            local_forwards, session_name=session_name, StreamLocalBindUnlink="yes"
+        )
+
     def _connect(self):
         """
         Makes a connection to a host using libvirt qemu+ssh
@@ -233,6 +386,9 @@ class LibVirtController:
         logger.debug("Connecting to libvirt")
         if self.conn is None:
 
+            # Domain events need the event loop before connecting
+            self.start_event_loop()
+
             # Prepare remote environment
             self._prepare_remote_env()
 
@@ -264,42 +420,61 @@ class LibVirtController:
         else:
             logger.debug("Already connected. Reusing connection.")
 
-    def _get_spice_parms(self, domain):
+    def _read_spice_parms(self, domain):
         """
-        Obtain spice connection parameters for specified domain
+        Read spice parameters of specified domain if its port is allocated
         """
-        # Get SPICE uri
-        tries = 0
-        spice_params = namedtuple(
-            "spice_params",
-            [
-                "port",
-                "tls_port",
-                "passwd",
-            ],
+        xmldata = domain.XMLDesc(libvirt.VIR_DOMAIN_XML_SECURE)
+        # Stop parsing at the graphics element instead of parsing whole XML
+        graphics = None
+        for _event, elem in ET.iterparse(io.StringIO(xmldata)):
+            if elem.tag == "graphics":
+                graphics = elem
+                break
+
+        if graphics is None or graphics.get("type") != "spice":
+            raise LibVirtControllerException(
+                "Can not obtain SPICE URI for virtual session"
+            )
+
+        port = graphics.get("port")
+        tls_port = graphics.get("tlsPort")
+        if port in (None, "-1") and tls_port in (None, "-1"):
+            return None
+
+        return self.spice_params(
+            port=port,
+            tls_port=tls_port,
+            passwd=graphics.get("passwd"),
         )
 
-        while True:
-            root = ET.fromstring(domain.XMLDesc(libvirt.VIR_DOMAIN_XML_SECURE))
-            devs = root.find("devices")
-            graphics = devs.find("graphics")
-            try:
-                if graphics.get("type") == "spice":
-                    return spice_params(
-                        port=graphics.get("port"),
-                        tls_port=graphics.get("tlsPort"),
-                        passwd=graphics.get("passwd"),
-                    )
-            except Exception:
-                pass
+    def _get_spice_parms(self, domain):
+        """
+        Obtain spice connection parameters for specified domain, polling until
+        its port is allocated. Libvirt has no event for port allocation
+        """
+        started = time.monotonic()
+        deadline = started + self.SPICE_READY_TIMEOUT
+        delay = self.SPICE_READY_POLL_INTERVAL
 
-            if tries < self.MAX_SESSION_START_TRIES:
-                time.sleep(self.SESSION_START_TRIES_DELAY)
-                tries += 1
-            else:
+        while True:
+            spice_params = self._read_spice_parms(domain)
+            if spice_params is not None:
+                break
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
                 raise LibVirtControllerException(
-                    "Can not obtain SPICE URI for virtual session"
+                    "Timed out waiting for SPICE port of virtual session"
                 )
+            time.sleep(min(remaining, delay))
+            # Port is usually allocated right away, so start polling quickly
+            delay = min(delay * 2, self.SPICE_READY_MAX_POLL_INTERVAL)
+
+        self.stats["spice_wait_time"] = time.monotonic() - started
+        logger.debug(
+            "SPICE port ready after %.3f seconds", self.stats["spice_wait_time"]
+        )
+        return spice_params
 
     def add_logger_channel(self, parent, name, domain_name):
         channel = ET.SubElement(parent, "channel")
@@ -311,9 +486,10 @@ class LibVirtController:
         target.set("type", "virtio")
         target.set("name", name)
 
-    def _generate_new_domain_xml(self, xmldata, spice_ticket, enable_logger):
+    def _prepare_template_xml(self, xmldata):
         """
-        Generates new domain XML from given XML data
+        Applies session independent changes to given domain XML data.
+        Session fields are left as marks to be filled for each session
         """
         # Parse XML
         root = ET.fromstring(xmldata)
@@ -327,12 +503,9 @@ class LibVirtController:
         cpbline = ET.SubElement(root, "qemu:capabilities")
         cpbarg = ET.SubElement(cpbline, "qemu:del")
         cpbarg.set("capability", "blockdev")
-        # Change domain UUID
-        newuuid = str(uuid.uuid4())
-        root.find("uuid").text = newuuid
-        # Change domain name
-        domain_name = "fc-{}".format(newuuid[:8])
-        root.find("name").text = domain_name
+        # Domain UUID and name are set per session
+        root.find("uuid").text = self._TEMPLATE_UUID_MARK
+        root.find("name").text = self._TEMPLATE_NAME_MARK
         # Change domain title
         try:
             title = root.find("title").text
@@ -360,19 +533,69 @@ class LibVirtController:
         graphics = ET.SubElement(devs, "graphics")
         graphics.set("type", "spice")
         graphics.set("autoport", "yes")
-        graphics.set("passwd", spice_ticket)
+        graphics.set("passwd", self._TEMPLATE_TICKET_MARK)
         self.add_spice_secure(graphics)
         self.add_spice_listen(graphics)
+        # Session channels go after graphics
+        ET.SubElement(devs, self._TEMPLATE_CHANNELS_TAG)
+        return ET.tostring(root).decode()
+
+    def _get_template_xml(self, identifier, xmldata):
+        """
+        Get prepared template XML for given domain from cache if its XML
+        has not changed
+        """
+        xmlhash = hashlib.sha256(xmldata.encode()).hexdigest()
+        key = (identifier, type(self).__name__, self._libvirt_video_driver)
+        with self._template_cache_lock:
+            cached = self._template_cache.get(key)
+            if cached is not None and cached[0] == xmlhash:
+                self._template_cache.move_to_end(key)
+                return cached[1]
+
+        logger.debug("Preparing template XML for domain %s", identifier)
+        template = self._prepare_template_xml(xmldata)
+        with self._template_cache_lock:
+            self._template_cache[key] = (xmlhash, template)
+            self._template_cache.move_to_end(key)
+            while len(self._template_cache) > self.TEMPLATE_CACHE_SIZE:
+                self._template_cache.popitem(last=False)
+        return template
+
+    def _generate_new_domain_xml(
+        self, xmldata, spice_ticket, enable_logger, identifier=None
+    ):
+        """
+        Generates new domain XML from given XML data
+        """
+        if identifier is not None:
+            template = self._get_template_xml(identifier, xmldata)
+        else:
+            template = self._prepare_template_xml(xmldata)
+
+        newuuid = str(uuid.uuid4())
+        domain_name = self.get_session_name(newuuid)
+
+        # Build session channels
+        channels = ET.Element(self._TEMPLATE_CHANNELS_TAG)
         self.add_notifier_channel(
-            devs, "org.freedesktop.FleetCommander.0", domain_name, "fc0"
+            channels, "org.freedesktop.FleetCommander.0", domain_name, "fc0"
         )
         if enable_logger:
             self.add_logger_channel(
-                devs, "org.freedesktop.FleetCommander.1", domain_name
+                channels, "org.freedesktop.FleetCommander.1", domain_name
             )
-        return ET.tostring(root).decode()
+        channels_mark = ET.tostring(ET.Element(self._TEMPLATE_CHANNELS_TAG)).decode()
+        channels_xml = "".join(ET.tostring(elem).decode() for elem in channels)
+
+        return (
+            template.replace(self._TEMPLATE_UUID_MARK, newuuid)
+            .replace(self._TEMPLATE_NAME_MARK, domain_name)
+            .replace(self._TEMPLATE_TICKET_MARK, spice_ticket)
+            .replace(channels_mark, channels_xml)
+        )
 
-    def _close_ssh_tunnel(self):
+    def _close_ssh_tunnel(self, session_name=None):
         """
         Close SSH tunnel
         """
@@ -380,18 +603,19 @@ class LibVirtController:
 
         # Execute SSH and close tunnel
         try:
-            self.ssh.close_tunnel(
+            self.get_tunnel_manager().close_tunnel(
                 self.private_key_file,
                 self.username,
                 self.ssh_host,
                 self.ssh_port,
+                control_socket=self.ssh.get_control_socket(session_name),
                 UserKnownHostsFile=self.known_hosts_file,
             )
             logger.debug("Tunnel closed")
         except Exception as e:
             raise LibVirtControllerException("Error closing tunnel: %s" % e)
 
-    def _open_ssh_tunnel(self, local_forwards, **kwargs):
+    def _open_ssh_tunnel(self, local_forwards, session_name=None, **kwargs):
         """
         Open SSH tunnel for spice port
         """
@@ -400,12 +624,13 @@ class LibVirtController:
 
         # Execute SSH and bring up tunnel
         try:
-            self.ssh.open_tunnel(
+            self.get_tunnel_manager().open_tunnel(
                 local_forwards=local_forwards,
                 private_key_file=self.private_key_file,
                 username=self.username,
                 hostname=self.ssh_host,
                 port=self.ssh_port,
+                control_socket=self.ssh.get_control_socket(session_name),
                 **kwargs,
             )
             logger.debug("Tunnel opened with local forward: %s", local_forwards)
@@ -435,6 +660,37 @@ class LibVirtController:
                 else:
                     break
 
+    def _get_domain_titles(self, domains):
+        """
+        Get domain titles using cached ones when possible
+        """
+        now = time.monotonic()
+        titles = {}
+        for domain in domains:
+            key = (self.hostname, domain.UUIDString())
+            with self._title_cache_lock:
+                cached = self._title_cache.get(key)
+            if cached is not None and now - cached[0] < self.TITLE_CACHE_TTL:
+                titles[key[1]] = cached[1]
+                continue
+            try:
+                title = domain.metadata(libvirt.VIR_DOMAIN_METADATA_TITLE, None)
+            except Exception as e:
+                logger.debug("Domain %s has no title: %s", domain.name(), e)
+                title = domain.name()
+            with self._title_cache_lock:
+                # Keep entries ordered by fetch time to evict oldest first
+                self._title_cache[key] = (now, title)
+                self._title_cache.move_to_end(key)
+                while self._title_cache and (
+                    len(self._title_cache) > self.TITLE_CACHE_SIZE
+                    or now - next(iter(self._title_cache.values()))[0]
+                    >= self.TITLE_CACHE_TTL
+                ):
+                    self._title_cache.popitem(last=False)
+            titles[key[1]] = title
+        return titles
+
     def list_domains(self):
         """
         Returns a dict with uuid and domain name
@@ -442,20 +698,22 @@ class LibVirtController:
         logger.debug("Listing domains")
         self._connect()
         logger.debug("Retrieving LibVirt domains")
-        domains = self.conn.listAllDomains()
-
-        def domain_name(dom):
-            try:
-                return dom.metadata(libvirt.VIR_DOMAIN_METADATA_TITLE, None)
-            except Exception as e:
-                print(e)
-                return dom.name()
+        # Domain UUIDs and names come along with the domain list, so
+        # active state is obtained listing active domains only once
+        domains = self.conn.listAllDomains(0)
+        active = {
+            domain.UUIDString()
+            for domain in self.conn.listAllDomains(
+                libvirt.VIR_CONNECT_LIST_DOMAINS_ACTIVE
+            )
+        }
+        titles = self._get_domain_titles(domains)
 
         domainlist = [
             {
                 "uuid": domain.UUIDString(),
-                "name": domain_name(domain),
-                "active": domain.isActive(),
+                "name": titles[domain.UUIDString()],
+                "active": domain.UUIDString() in active,
                 "temporary": domain.name().startswith("fc-"),
             }
             for domain in domains
@@ -463,29 +721,152 @@ class LibVirtController:
         logger.debug("Domains list: %s", domainlist)
         return domainlist
 
-    def session_start(self, identifier, debug_logger=False):
+    def get_load(self):
+        """
+        Returns hypervisor free memory in bytes and running sessions count
+        """
+        self._connect()
+        active = self.conn.listAllDomains(libvirt.VIR_CONNECT_LIST_DOMAINS_ACTIVE)
+        return {
+            "free_memory": self.conn.getFreeMemory(),
+            "sessions": len([d for d in active if d.name().startswith("fc-")]),
+        }
+
+    def register_domain_events(self, callback, close_callback):
+        """
+        Registers callbacks for lifecycle events of all domains and for
+        connection close
+        """
+        self._connect()
+        self.conn.registerCloseCallback(close_callback, None)
+        return self.conn.domainEventRegisterAny(
+            None, libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE, callback, None
+        )
+
+    def _start_domain(self, identifier, debug_logger=False):
+        """
+        Start a new temporary domain from the given template domain
+        """
+        self._connect()
+        # Get machine by its identifier
+        origdomain = self.conn.lookupByUUIDString(identifier)
+        spice_ticket = self.generate_spice_ticket()
+
+        # Generate new domain description modifying original XML to use qemu
+        # -snapshot command line
+        newxml = self._generate_new_domain_xml(
+            origdomain.XMLDesc(),
+            spice_ticket=spice_ticket,
+            enable_logger=debug_logger,
+            identifier=identifier,
+        )
+
+        # Create and run new domain from new XML definition
+        domain = self.conn.createXML(newxml)
+
+        # Get spice host and port
+        spice_params = self._get_spice_parms(domain)
+
+        # Make sure spice ticket was properly set,
+        # for example, 'passwd' field has enough length
+        if spice_params.passwd != spice_ticket:
+            raise LibVirtControllerException("Error processing spice ticket")
+
+        return domain, spice_ticket, spice_params
+
+    def _claim_pooled_domain(self, pooled):
+        """
+        Get an already running pooled domain ready for a session
+        """
+        self._connect()
+        domain = self.conn.lookupByUUIDString(pooled.domain)
+        if domain is None or not domain.isActive():
+            raise LibVirtControllerException(
+                "Pooled domain %s is not running" % pooled.domain
+            )
+
+        spice_params = self._get_spice_parms(domain)
+        if spice_params.passwd != pooled.ticket:
+            raise LibVirtControllerException("Error processing spice ticket")
+
+        return domain, pooled.ticket, spice_params
+
+    def _prepare_session_domain(self, identifier, debug_logger=False, pooled=None):
+        """
+        Start a new domain for a session or claim a pooled one
+        """
+        if pooled is not None:
+            logger.debug("Claiming pooled domain %s", pooled.domain)
+            domain, spice_ticket, spice_params = self._claim_pooled_domain(pooled)
+        else:
+            domain, spice_ticket, spice_params = self._start_domain(
+                identifier, debug_logger
+            )
+        self._last_started_domain = domain
+        return spice_ticket, spice_params
+
+    def pool_domain_start(self, identifier, debug_logger=False):
+        """
+        Start a temporary domain to be kept in the session pool
+        """
+        logger.debug("Starting pooled domain from %s", identifier)
+        domain, spice_ticket, _spice_params = self._start_domain(
+            identifier, debug_logger
+        )
+        # Pooled domains are transient from the beginning
+        self._undefine_domain(domain)
+        return self.pool_params(domain=domain.UUIDString(), ticket=spice_ticket)
+
+    def session_start(self, identifier, debug_logger=False, pooled=None):
         """
         Start session in virtual machine
         """
         raise NotImplementedError
 
-    def session_stop(self, identifier):
+    def _stop_domain(self, identifier):
         """
-        Stops session in virtual machine
+        Destroys session domain and its SSH tunnel
         """
-        logger.debug("Stopping session")
         # Kill ssh tunnel
         try:
-            self._close_ssh_tunnel()
+            self._close_ssh_tunnel(self.get_session_name(identifier))
         except Exception:
             pass
-        self._connect()
         # Get machine by its uuid
-        self._last_stopped_domain = self.conn.lookupByUUIDString(identifier)
+        domain = self.conn.lookupByUUIDString(identifier)
         # Destroy domain
-        self._last_stopped_domain.destroy()
+        domain.destroy()
         # Undefine domain
-        self._undefine_domain(self._last_stopped_domain)
+        self._undefine_domain(domain)
+        return domain
+
+    def session_stop(self, identifier):
+        """
+        Stops session in virtual machine
+        """
+        logger.debug("Stopping session %s", identifier)
+        self._connect()
+        self._last_stopped_domain = self._stop_domain(identifier)
+
+    def sessions_stop(self, identifiers):
+        """
+        Stops several sessions concurrently using a single connection.
+        Returns a dict with errors by session UUID
+        """
+        logger.debug("Stopping sessions %s", identifiers)
+        self._connect()
+        errors = {}
+        with ThreadPoolExecutor(max_workers=self.MAX_TEARDOWN_WORKERS) as executor:
+            futures = {
+                executor.submit(self._stop_domain, identifier): identifier
+                for identifier in identifiers
+            }
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    errors[futures[future]] = e
+        return errors
 
 
 class LibVirtTlsSpice(LibVirtController):
@@ -534,42 +915,23 @@ class LibVirtTlsSpice(LibVirtController):
     def add_spice_secure(self, elem):
         elem.set("defaultMode", "secure")
 
-    def session_start(self, identifier, debug_logger=False):
+    def session_start(self, identifier, debug_logger=False, pooled=None):
         """
         Start session in virtual machine
         """
         logger.debug("Starting session")
-        self._connect()
-        # Get machine by its identifier
-        origdomain = self.conn.lookupByUUIDString(identifier)
-        spice_ticket = self.generate_spice_ticket()
-
-        # Generate new domain description modifying original XML to use qemu -snapshot command line
-        newxml = self._generate_new_domain_xml(
-            origdomain.XMLDesc(), spice_ticket=spice_ticket, enable_logger=debug_logger
+        spice_ticket, spice_params = self._prepare_session_domain(
+            identifier, debug_logger, pooled
         )
 
-        # Create and run new domain from new XML definition
-        self._last_started_domain = self.conn.createXML(newxml)
-
-        # Get spice host and port
-        spice_params = self._get_spice_parms(self._last_started_domain)
-
-        # Make sure spice ticket was properly set,
-        # for example, 'passwd' field has enough length
-        if spice_params.passwd != spice_ticket:
-            raise LibVirtControllerException("Error processing spice ticket")
-
         ca_cert = self._get_spice_ca_cert()
         cert_subject = self._get_spice_cert_subject()
 
-        local_runtime_dir = os.environ["XDG_RUNTIME_DIR"]
+        session_name = self._last_started_domain.name()
         # cockpit will read from
-        local_socket = os.path.join(local_runtime_dir, "fc-notifier.socket")
+        local_socket = self._get_local_socket_path(session_name, "notifier")
         # fc logger will write to
-        remote_socket = self._notify_socket_path.format(
-            self._last_started_domain.name()
-        )
+        remote_socket = self._notify_socket_path.format(session_name)
         logger.debug("Local user notify socket path: %s", local_socket)
         local_forwards = [
             "{local_socket}:{remote_socket}".format(
@@ -580,12 +942,10 @@ class LibVirtTlsSpice(LibVirtController):
 
         if debug_logger:
             # cockpit will read from
-            local_socket_logger = os.path.join(local_runtime_dir, "fc-logger.socket")
+            local_socket_logger = self._get_local_socket_path(session_name, "logger")
             logger.debug("Local user logger socket path: %s", local_socket_logger)
             # fc logger will write to
-            remote_socket_logger = self._logger_socket_path.format(
-                self._last_started_domain.name()
-            )
+            remote_socket_logger = self._logger_socket_path.format(session_name)
             local_forwards.extend(
                 [
                     "{local_socket_logger}:{remote_socket_logger}".format(
@@ -595,7 +955,9 @@ class LibVirtTlsSpice(LibVirtController):
                 ]
             )
 
-        self._open_ssh_tunnel(local_forwards, StreamLocalBindUnlink="yes")
+        self._open_ssh_tunnel(
+            local_forwards, session_name=session_name, StreamLocalBindUnlink="yes"
+        )
 
         # Make it transient inmediately after started it
         self._undefine_domain(self._last_started_domain)
@@ -689,40 +1051,20 @@ class LibVirtPlainSpice(LibVirtController):
     def add_spice_secure(self, elem):
         elem.set("defaultMode", "insecure")
 
-    def session_start(self, identifier, debug_logger=False):
+    def session_start(self, identifier, debug_logger=False, pooled=None):
         """
         Start session in virtual machine
         """
         logger.debug("Starting session")
-        self._connect()
-        # Get machine by its identifier
-        origdomain = self.conn.lookupByUUIDString(identifier)
-        spice_ticket = self.generate_spice_ticket()
-
-        # Generate new domain description modifying original XML to use qemu
-        # -snapshot command line
-        newxml = self._generate_new_domain_xml(
-            origdomain.XMLDesc(), spice_ticket=spice_ticket, enable_logger=debug_logger
+        spice_ticket, spice_params = self._prepare_session_domain(
+            identifier, debug_logger, pooled
         )
 
-        # Create and run new domain from new XML definition
-        self._last_started_domain = self.conn.createXML(newxml)
-
-        # Get spice host and port
-        spice_params = self._get_spice_parms(self._last_started_domain)
-
-        # Make sure spice ticket was properly set,
-        # for example, 'passwd' field has enough length
-        if spice_params.passwd != spice_ticket:
-            raise LibVirtControllerException("Error processing spice ticket")
-
-        local_runtime_dir = os.environ["XDG_RUNTIME_DIR"]
+        session_name = self._last_started_domain.name()
         # cockpit will read from
-        local_socket = os.path.join(local_runtime_dir, "fc-notifier.socket")
+        local_socket = self._get_local_socket_path(session_name, "notifier")
         # fc logger will write to
-        remote_socket = self._notify_socket_path.format(
-            self._last_started_domain.name()
-        )
+        remote_socket = self._notify_socket_path.format(session_name)
         logger.debug("Local user notify socket path: %s", local_socket)
         local_forwards = [
             "{local_socket}:{remote_socket}".format(
@@ -733,12 +1075,10 @@ class LibVirtPlainSpice(LibVirtController):
 
         if debug_logger:
             # cockpit will read from
-            local_socket_logger = os.path.join(local_runtime_dir, "fc-logger.socket")
+            local_socket_logger = self._get_local_socket_path(session_name, "logger")
             logger.debug("Local user logger socket path: %s", local_socket_logger)
             # fc logger will write to
-            remote_socket_logger = self._logger_socket_path.format(
-                self._last_started_domain.name()
-            )
+            remote_socket_logger = self._logger_socket_path.format(session_name)
             local_forwards.extend(
                 [
                     "{local_socket_logger}:{remote_socket_logger}".format(
@@ -748,7 +1088,9 @@ class LibVirtPlainSpice(LibVirtController):
                 ]
             )
 
-        self._open_ssh_tunnel(local_forwards, StreamLocalBindUnlink="yes")
+        self._open_ssh_tunnel(
+            local_forwards, session_name=session_name, StreamLocalBindUnlink="yes"
+        )
 
         # Make it transient immediately after started it
         self._undefine_domain(self._last_started_domain)
@@ -795,31 +1137,18 @@ class LibVirtTunnelSpice(LibVirtController):
     def add_spice_secure(self, elem):
         elem.set("defaultMode", "insecure")
 
-    def session_start(self, identifier, debug_logger=False):
+    def session_start(self, identifier, debug_logger=False, pooled=None):
         """
         Start session in virtual machine
         """
         logger.debug("Starting session")
-        self._connect()
-        # Get machine by its identifier
-        origdomain = self.conn.lookupByUUIDString(identifier)
-        spice_ticket = self.generate_spice_ticket()
-
-        # Generate new domain description modifying original XML to use qemu
-        # -snapshot command line
-        newxml = self._generate_new_domain_xml(
-            origdomain.XMLDesc(), spice_ticket=spice_ticket, enable_logger=debug_logger
+        spice_ticket, spice_params = self._prepare_session_domain(
+            identifier, debug_logger, pooled
         )
 
-        # Create and run new domain from new XML definition
-        self._last_started_domain = self.conn.createXML(newxml)
-
-        # Get spice host and port
-        spice_params = self._get_spice_parms(self._last_started_domain)
-
-        local_runtime_dir = os.environ["XDG_RUNTIME_DIR"]
+        session_name = self._last_started_domain.name()
         # cockpit will read from
-        local_socket = os.path.join(local_runtime_dir, "fc-notifier.socket")
+        local_socket = self._get_local_socket_path(session_name, "notifier")
         logger.debug("Local user notify socket path: %s", local_socket)
 
         local_forwards = [
@@ -832,13 +1161,11 @@ class LibVirtTunnelSpice(LibVirtController):
 
         if debug_logger:
             # cockpit will read from
-            local_socket_logger = os.path.join(local_runtime_dir, "fc-logger.socket")
+            local_socket_logger = self._get_local_socket_path(session_name, "logger")
             logger.debug("Local user logger socket path: %s", local_socket_logger)
 
             # fc logger will write to
-            remote_socket_logger = self._logger_socket_path.format(
-                self._last_started_domain.name()
-            )
+            remote_socket_logger = self._logger_socket_path.format(session_name)
 
             local_forwards.extend(
                 [
@@ -849,7 +1176,9 @@ class LibVirtTunnelSpice(LibVirtController):
                 ]
             )
 
-        self._open_ssh_tunnel(local_forwards, StreamLocalBindUnlink="yes")
+        self._open_ssh_tunnel(
+            local_forwards, session_name=session_name, StreamLocalBindUnlink="yes"
+        )
 
         # Make it transient inmediately after started it
         self._undefine_domain(self._last_started_domain)
@@ -868,6 +1197,155 @@ class LibVirtTunnelSpice(LibVirtController):
         )
 
 
+class DomainInventory:
+    """
+    In-memory domains inventory kept up to date by libvirt domain events
+    """
+
+    RESYNC_INTERVAL = 300
+
+    def __init__(self, ctrlr):
+        """
+        Class initialization
+        """
+        self.ctrlr = ctrlr
+        self._lock = threading.Lock()
+        self._domains = OrderedDict()
+        # Active domains that have been undefined, removed when stopped
+        self._transient = set()
+        self._synced = None
+        self._events = False
+        self._reconnect = False
+        # Domain events callback registered in controller connection
+        self._callback_id = None
+
+    def _needs_sync(self):
+        with self._lock:
+            # Without events inventory can not be trusted between calls
+            return (
+                not self._events
+                or self._synced is None
+                or time.monotonic() - self._synced > self.RESYNC_INTERVAL
+            )
+
+    def sync(self):
+        """
+        Populates inventory with a full domain listing
+        """
+        with self._lock:
+            events = self._events
+            if self._reconnect:
+                self.ctrlr.conn = None
+                self._callback_id = None
+                self._reconnect = False
+
+        if not events:
+            # Register before listing to not miss changes in between
+            try:
+                callback_id = self.ctrlr.register_domain_events(
+                    self._on_lifecycle_event, self._on_connection_closed
+                )
+                with self._lock:
+                    self._callback_id = callback_id
+                events = True
+            except Exception as e:
+                logger.debug("Domain events not available: %s", e)
+
+        domains = self.ctrlr.list_domains()
+        with self._lock:
+            self._domains = OrderedDict((d["uuid"], d) for d in domains)
+            self._transient = set()
+            self._synced = time.monotonic()
+            self._events = events
+        logger.debug("Domain inventory synced with %s domains", len(domains))
+
+    def invalidate(self):
+        """
+        Forces a full resync on next use
+        """
+        with self._lock:
+            self._synced = None
+
+    def close(self):
+        """
+        Deregisters domain event callbacks and closes libvirt connection
+        """
+        with self._lock:
+            conn = self.ctrlr.conn
+            callback_id = self._callback_id
+            self.ctrlr.conn = None
+            self._callback_id = None
+            self._events = False
+            self._synced = None
+        if conn is None:
+            return
+
+        try:
+            if callback_id is not None:
+                conn.domainEventDeregisterAny(callback_id)
+                conn.unregisterCloseCallback()
+        except Exception as e:
+            logger.debug("Error deregistering domain events: %s", e)
+        try:
+            conn.close()
+        except Exception as e:
+            logger.debug("Error closing libvirt connection: %s", e)
+
+    def domains(self):
+        """
+        Returns a list of dicts with domains data
+        """
+        if self._needs_sync():
+            self.sync()
+        with self._lock:
+            return [dict(domain) for domain in self._domains.values()]
+
+    def is_active(self, identifier):
+        """
+        Checks if domain with given UUID is active
+        """
+        if self._needs_sync():
+            self.sync()
+        with self._lock:
+            domain = self._domains.get(identifier)
+            return domain is not None and domain["active"]
+
+    def _on_lifecycle_event(self, _conn, dom, event, _detail, _opaque):
+        identifier = dom.UUIDString()
+        with self._lock:
+            domain = self._domains.get(identifier)
+            if domain is None:
+                if event != libvirt.VIR_DOMAIN_EVENT_UNDEFINED:
+                    # New domain title is fetched with a full resync
+                    self._synced = None
+                return
+
+            if event in (
+                libvirt.VIR_DOMAIN_EVENT_STARTED,
+                libvirt.VIR_DOMAIN_EVENT_RESUMED,
+            ):
+                domain["active"] = True
+            elif event == libvirt.VIR_DOMAIN_EVENT_STOPPED:
+                # Temporary session domains are transient
+                if domain["temporary"] or identifier in self._transient:
+                    del self._domains[identifier]
+                    self._transient.discard(identifier)
+                else:
+                    domain["active"] = False
+            elif event == libvirt.VIR_DOMAIN_EVENT_UNDEFINED:
+                if domain["active"]:
+                    self._transient.add(identifier)
+                else:
+                    del self._domains[identifier]
+
+    def _on_connection_closed(self, _conn, reason, _opaque):
+        logger.debug("Libvirt connection closed: %s", reason)
+        with self._lock:
+            self._events = False
+            self._reconnect = True
+            self._synced = None
+
+
 VIEWERS = {
     "spice_html5": LibVirtTunnelSpice,
     "spice_remote_viewer": LibVirtTlsSpice,
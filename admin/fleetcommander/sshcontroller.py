@@ -20,9 +20,16 @@
 #          Oliver Gutiérrez <ogutierrez@redhat.com>
 
 from __future__ import absolute_import
+from concurrent.futures import ThreadPoolExecutor
+
+import base64
+import hashlib
+import hmac
 import os
+import re
+import struct
 import subprocess
-import tempfile
+import threading
 import logging
 import pexpect
 
@@ -33,6 +40,142 @@ class SSHControllerException(Exception):
     pass
 
 
+class KnownHostsIndex:
+    """
+    Index of hosts in a known hosts file.
+
+    File is parsed once and reloaded only when it changes. Appended lines
+    are parsed incrementally.
+    """
+
+    HASHED_HOST_MAGIC = "|1|"
+
+    def __init__(self, path):
+        """
+        Class initialization
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._file_id = None
+        self._mtime = None
+        self._size = 0
+        self._offset = 0
+        self._hosts = set()
+        self._hashed_hosts = []
+        self._patterns = []
+        self._lookups = {}
+        self.entries = 0
+
+    @staticmethod
+    def _compile_pattern(pattern):
+        # Only * and ? are wildcards in known hosts patterns
+        regex = re.escape(pattern).replace(r"\*", ".*").replace(r"\?", ".")
+        return re.compile(regex + r"\Z")
+
+    def _add_line(self, line):
+        fields = line.split()
+        if not fields or fields[0].startswith("#"):
+            return
+        if fields[0].startswith("@"):
+            # @cert-authority and @revoked lines are not host keys
+            return
+        if len(fields) < 3:
+            logger.debug("Ignoring invalid known hosts line: %s", line)
+            return
+
+        hosts = fields[0].lower()
+        self.entries += 1
+        if hosts.startswith(self.HASHED_HOST_MAGIC):
+            try:
+                _empty, _magic, salt, digest = fields[0].split("|")
+                self._hashed_hosts.append(
+                    (base64.b64decode(salt), base64.b64decode(digest))
+                )
+            except ValueError:
+                logger.debug("Ignoring invalid hashed known host: %s", fields[0])
+            return
+
+        patterns = hosts.split(",")
+        if any("*" in p or "?" in p or p.startswith("!") for p in patterns):
+            positive = [self._compile_pattern(p) for p in patterns if p[:1] != "!"]
+            negative = [self._compile_pattern(p[1:]) for p in patterns if p[:1] == "!"]
+            self._patterns.append((positive, negative))
+        else:
+            self._hosts.update(patterns)
+
+    def refresh(self):
+        """
+        Reload index if known hosts file changed
+        """
+        with self._lock:
+            self._refresh()
+
+    def _refresh(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            self._reset()
+            return
+
+        file_id = (st.st_dev, st.st_ino)
+        if (file_id, st.st_mtime_ns, st.st_size) == (
+            self._file_id,
+            self._mtime,
+            self._size,
+        ):
+            return
+
+        # Parse only appended data unless file was replaced or rewritten
+        if file_id != self._file_id or st.st_size <= self._size:
+            self._reset()
+
+        with open(self.path, "rb") as fd:
+            fd.seek(self._offset)
+            data = fd.read()
+        # Leave last line for later if it is not complete yet
+        end = data.rfind(b"\n") + 1
+        for line in data[:end].decode("utf-8", errors="replace").splitlines():
+            self._add_line(line)
+        if end:
+            self._lookups.clear()
+
+        self._offset += end
+        self._file_id = file_id
+        self._mtime = st.st_mtime_ns
+        self._size = st.st_size
+
+    def _match(self, name):
+        if name in self._hosts:
+            return True
+        for salt, digest in self._hashed_hosts:
+            if hmac.compare_digest(
+                hmac.new(salt, name.encode(), hashlib.sha1).digest(), digest
+            ):
+                return True
+        for positive, negative in self._patterns:
+            if any(p.match(name) for p in negative):
+                continue
+            if any(p.match(name) for p in positive):
+                return True
+        return False
+
+    def lookup(self, hostname, port=None):
+        """
+        Checks if a host is in the index
+        """
+        name = hostname.lower()
+        if port is not None and int(port) != SSHController.DEFAULT_SSH_PORT:
+            name = "[{}]:{}".format(name, port)
+        with self._lock:
+            self._refresh()
+            if name not in self._lookups:
+                self._lookups[name] = self._match(name)
+            return self._lookups[name]
+
+
 class SSHController:
     """
     SSH controller class for common SSH operations
@@ -40,12 +183,32 @@ class SSHController:
 
     RSA_KEY_SIZE = 2048
     DEFAULT_SSH_PORT = 22
+    MAX_KEYSCAN_WORKERS = 8
     SSH_COMMAND = "ssh"
     SSH_KEYGEN_COMMAND = "ssh-keygen"
     SSH_KEYSCAN_COMMAND = "ssh-keyscan"
     CONTROL_SOCKET = os.path.join(
         os.path.expanduser("~"), ".ssh", "fc-control-ssh-tunnel.socket"
     )
+    SESSION_CONTROL_SOCKET = os.path.join(
+        os.path.expanduser("~"), ".ssh", "{}-control-ssh-tunnel.socket"
+    )
+
+    # Key type names as shown by ssh-keygen
+    KEY_TYPE_NAMES = {
+        "ssh-rsa": "RSA",
+        "ssh-dss": "DSA",
+        "ecdsa-sha2-nistp256": "ECDSA",
+        "ecdsa-sha2-nistp384": "ECDSA",
+        "ecdsa-sha2-nistp521": "ECDSA",
+        "sk-ecdsa-sha2-nistp256@openssh.com": "ECDSA-SK",
+        "ssh-ed25519": "ED25519",
+        "sk-ssh-ed25519@openssh.com": "ED25519-SK",
+    }
+
+    # Known hosts indexes by file path shared by all controllers
+    _known_hosts_indexes = {}
+    _known_hosts_indexes_lock = threading.Lock()
 
     def __init__(self):
         """
@@ -53,6 +216,14 @@ class SSHController:
         """
         self._tunnel_prog = None
 
+    def get_control_socket(self, session_name=None):
+        """
+        Get SSH control socket path for given session name
+        """
+        if session_name is None:
+            return self.CONTROL_SOCKET
+        return self.SESSION_CONTROL_SOCKET.format(session_name)
+
     def generate_ssh_keypair(self, private_key_file, key_size=RSA_KEY_SIZE):
         """
         Generates SSH private and public keys
@@ -77,23 +248,52 @@ class SSHController:
         if prog.returncode != 0:
             raise SSHControllerException("Error generating keypair: %s" % error)
 
-    def scan_host_keys(self, hostname, port=DEFAULT_SSH_PORT):
+    def scan_host_keys(self, hostname, port=DEFAULT_SSH_PORT, timeout=None):
+        command = [self.SSH_KEYSCAN_COMMAND, "-p", str(port)]
+        if timeout is not None:
+            command.extend(["-T", str(timeout)])
+        command.append(hostname)
         prog = subprocess.Popen(
-            [
-                self.SSH_KEYSCAN_COMMAND,
-                "-p",
-                str(port),
-                hostname,
-            ],
+            command,
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
         )
-        out, error = prog.communicate()
-        prog.wait()
+        try:
+            # ssh-keyscan timeout applies to each connection step
+            out, error = prog.communicate(
+                timeout=timeout * 2 if timeout is not None else None
+            )
+        except subprocess.TimeoutExpired:
+            prog.kill()
+            prog.communicate()
+            raise SSHControllerException("Timed out getting host keys")
         if prog.returncode == 0:
             return out.decode()
         raise SSHControllerException("Error getting host keys: %s" % error)
 
+    def scan_hosts_keys(self, hosts, timeout=None, max_workers=None):
+        """
+        Scans keys of several (hostname, port) pairs concurrently.
+        Returns dicts with key data and errors by host
+        """
+        keys = {}
+        errors = {}
+        if not hosts:
+            return keys, errors
+        with ThreadPoolExecutor(
+            max_workers=max_workers or self.MAX_KEYSCAN_WORKERS
+        ) as executor:
+            futures = {
+                host: executor.submit(self.scan_host_keys, host[0], host[1], timeout)
+                for host in hosts
+            }
+            for host, future in futures.items():
+                try:
+                    keys[host] = future.result()
+                except Exception as e:
+                    errors[host] = e
+        return keys, errors
+
     def add_keys_to_known_hosts(self, known_hosts_file, key_data):
         # First create path if does not exists
         directory = os.path.dirname(known_hosts_file)
@@ -101,52 +301,111 @@ class SSHController:
             os.makedirs(directory)
         with open(known_hosts_file, "a", encoding="utf-8") as fd:
             fd.write(key_data)
+        # Index new lines
+        self.get_known_hosts_index(known_hosts_file).refresh()
 
     def add_to_known_hosts(self, known_hosts_file, hostname, port=DEFAULT_SSH_PORT):
         key_data = self.scan_host_keys(hostname, port)
         self.add_keys_to_known_hosts(known_hosts_file, key_data)
 
-    def check_known_host(self, known_hosts_file, hostname):
+    def get_known_hosts_index(self, known_hosts_file):
+        """
+        Get index for given known hosts file
+        """
+        with self._known_hosts_indexes_lock:
+            index = self._known_hosts_indexes.get(known_hosts_file)
+            if index is None:
+                index = KnownHostsIndex(known_hosts_file)
+                self._known_hosts_indexes[known_hosts_file] = index
+            return index
+
+    def check_known_host(self, known_hosts_file, hostname, port=DEFAULT_SSH_PORT):
         """
         Checks if a host is in given known hosts file
         """
-        if os.path.exists(known_hosts_file):
-            # Check if host exists in file
-            with open(known_hosts_file, encoding="utf-8") as fd:
-                lines = fd.readlines()
+        return self.get_known_hosts_index(known_hosts_file).lookup(hostname, port)
 
-            for line in lines:
-                hosts, _keytype, _key = line.split()
-                if hostname in hosts.split(","):
-                    return True
-        return False
+    @staticmethod
+    def _read_key_string(blob, offset):
+        """
+        Reads a length prefixed string from SSH key blob
+        """
+        (length,) = struct.unpack_from(">I", blob, offset)
+        offset += 4
+        if offset + length > len(blob):
+            raise ValueError("Truncated key data")
+        return blob[offset : offset + length], offset + length
 
-    def get_fingerprint_from_key_data(self, key_data):
+    def get_key_bits(self, blob):
         """
-        Get host SSH fingerprint
+        Get key size in bits from SSH public key blob
         """
-        tmpfile = tempfile.mktemp(prefix="fc-ssh-keydata")
-        with open(tmpfile, "w", encoding="utf-8") as fd:
-            fd.write(key_data)
+        keytype, offset = self._read_key_string(blob, 0)
+        keytype = keytype.decode("ascii")
+        if keytype in ("ssh-rsa", "ssh-dss"):
+            # RSA exponent comes before modulus, DSA starts with p
+            if keytype == "ssh-rsa":
+                _e, offset = self._read_key_string(blob, offset)
+            value, offset = self._read_key_string(blob, offset)
+            return int.from_bytes(value, "big").bit_length()
+        if "ecdsa-sha2-" in keytype:
+            curve, offset = self._read_key_string(blob, offset)
+            return int(curve.decode("ascii")[len("nistp") :])
+        if "ed25519" in keytype:
+            return 256
+        raise ValueError("Unsupported key type %s" % keytype)
+
+    def get_key_fingerprint(self, blob, hash_type="sha256"):
+        """
+        Get fingerprint of SSH public key blob as shown by ssh-keygen
+        """
+        if hash_type == "md5":
+            digest = hashlib.md5(blob).hexdigest()
+            return "MD5:" + ":".join(digest[i : i + 2] for i in range(0, 32, 2))
+        digest = base64.b64encode(hashlib.sha256(blob).digest()).decode()
+        return "SHA256:" + digest.rstrip("=")
 
-        prog = subprocess.Popen(
-            [
-                self.SSH_KEYGEN_COMMAND,
-                "-l",
-                "-f",
-                tmpfile,
-            ],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-        )
-        out, error = prog.communicate()
-        prog.wait()
-        os.remove(tmpfile)
-        if prog.returncode == 0:
-            return out.decode()
-        raise SSHControllerException(
-            "Error generating fingerprint from key data: %s" % error
-        )
+    def get_fingerprint_from_key_data(self, key_data, hash_type="sha256"):
+        """
+        Get fingerprints for public keys in known hosts or public key format.
+        Output matches ssh-keygen -l
+        """
+        fprints = []
+        try:
+            for line in key_data.splitlines():
+                fields = line.split()
+                if not fields or fields[0].startswith(("#", "@")):
+                    continue
+                if fields[0] in self.KEY_TYPE_NAMES:
+                    # Public key format
+                    keytype, key = fields[:2]
+                    comment = " ".join(fields[2:]) or "no comment"
+                else:
+                    # Known hosts format
+                    comment, keytype, key = fields[:3]
+                if keytype not in self.KEY_TYPE_NAMES:
+                    raise ValueError("Unsupported key type %s" % keytype)
+                blob = base64.b64decode(key, validate=True)
+                blob_keytype, _offset = self._read_key_string(blob, 0)
+                if blob_keytype.decode("ascii") != keytype:
+                    raise ValueError("Key type mismatch for %s key" % keytype)
+                fprints.append(
+                    "{} {} {} ({})\n".format(
+                        self.get_key_bits(blob),
+                        self.get_key_fingerprint(blob, hash_type),
+                        comment,
+                        self.KEY_TYPE_NAMES[keytype],
+                    )
+                )
+        except Exception as e:
+            raise SSHControllerException(
+                "Error generating fingerprint from key data: %s" % e
+            )
+        if not fprints:
+            raise SSHControllerException(
+                "Error generating fingerprint from key data: No public keys found"
+            )
+        return "".join(fprints)
 
     def get_host_fingerprint(self, hostname, port=DEFAULT_SSH_PORT):
         """
@@ -199,21 +458,22 @@ class SSHController:
             return out
         raise SSHControllerException("Error executing remote command: %s" % error)
 
-    def open_tunnel(
+    def get_tunnel_command(
         self,
         local_forwards,
         private_key_file,
         username,
         hostname,
         port=DEFAULT_SSH_PORT,
+        control_socket=None,
+        background=True,
         **kwargs
     ):
         """
-        Open a tunnel with given ports and return SSH tunnel cookie
+        Get SSH command for a tunnel with given local forwards
         """
-        # cleanup stale socket if exists otherwise ssh will attempt to use it
-        if os.path.exists(self.CONTROL_SOCKET):
-            os.remove(self.CONTROL_SOCKET)
+        if control_socket is None:
+            control_socket = self.CONTROL_SOCKET
 
         ssh_command = [self.SSH_COMMAND]
         # Options
@@ -233,18 +493,46 @@ class SSHController:
                 "-o",
                 "ControlMaster=yes",
                 "-S",
-                self.CONTROL_SOCKET,
+                control_socket,
                 "{user}@{host}".format(user=username, host=hostname),
                 "-p",
                 str(port),
             ]
         )
         ssh_command.extend([v for lf in local_forwards for v in ("-L", lf)])
-        ssh_command.extend(
-            [
-                "-N",
-                "-f",
-            ]
+        ssh_command.append("-N")
+        if background:
+            ssh_command.append("-f")
+        return ssh_command
+
+    def open_tunnel(
+        self,
+        local_forwards,
+        private_key_file,
+        username,
+        hostname,
+        port=DEFAULT_SSH_PORT,
+        control_socket=None,
+        **kwargs
+    ):
+        """
+        Open a tunnel with given ports and return SSH tunnel cookie
+        """
+        if control_socket is None:
+            control_socket = self.CONTROL_SOCKET
+
+        # cleanup stale socket if exists otherwise ssh will attempt to use it
+        if os.path.exists(control_socket):
+            os.remove(control_socket)
+
+        ssh_command = self.get_tunnel_command(
+            local_forwards,
+            private_key_file,
+            username,
+            hostname,
+            port,
+            control_socket=control_socket,
+            **kwargs,
         )
 
         # Execute SSH and bring up tunnel
@@ -254,11 +542,20 @@ class SSHController:
             raise SSHControllerException(e)
 
     def close_tunnel(
-        self, private_key_file, username, hostname, port=DEFAULT_SSH_PORT, **kwargs
+        self,
+        private_key_file,
+        username,
+        hostname,
+        port=DEFAULT_SSH_PORT,
+        control_socket=None,
+        **kwargs
     ):
         """
         Close SSH tunnel via the given SSH control socket
         """
+        if control_socket is None:
+            control_socket = self.CONTROL_SOCKET
+
         ssh_command = [self.SSH_COMMAND]
         # Options
         for k, v in kwargs.items():
@@ -276,7 +573,7 @@ class SSHController:
                 "-p",
                 str(port),
                 "-S",
-                self.CONTROL_SOCKET,
+                control_socket,
                 "-O",
                 "exit",
             ]
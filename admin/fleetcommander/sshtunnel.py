@@ -0,0 +1,457 @@
+# -*- coding: utf-8 -*-
+# vi:ts=4 sw=4 sts=4
+
+# Copyright (C) 2021 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the licence, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program; if not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import
+import os
+import subprocess
+import tempfile
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class SSHTunnelException(Exception):
+    pass
+
+
+class SSHTunnel:
+    """
+    SSH tunnel running in a supervised SSH process.
+
+    SSH binds local UNIX sockets of forwards by itself, so traffic does not
+    go through this process. Traffic is counted from the I/O of SSH processes,
+    and latency by running a no-op remote command through the SSH connection
+    """
+
+    READY_TIMEOUT = 20
+    READY_POLL_INTERVAL = 0.05
+    CLOSE_TIMEOUT = 5
+    PROBE_TIMEOUT = 10
+
+    def __init__(
+        self,
+        ssh,
+        local_forwards,
+        private_key_file,
+        username,
+        hostname,
+        port,
+        control_socket,
+        **kwargs
+    ):
+        """
+        Class initialization
+        """
+        self.ssh = ssh
+        self.forwards = list(local_forwards)
+        self.private_key_file = private_key_file
+        self.username = username
+        self.hostname = hostname
+        self.port = port
+        self.control_socket = control_socket
+        self.options = kwargs
+        self.restarts = 0
+        self.failures = 0
+        self.started = None
+        self.closing = False
+        self.next_restart = 0
+        self.next_probe = 0
+        self.latency = None
+        self.probed = None
+        self.probe_failures = 0
+        # I/O counters of previous SSH processes and last read of current one
+        self._io_base = (0, 0)
+        self._io_last = (0, 0)
+        # Statistics must not wait for restarts holding the main lock
+        self._io_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._prog = None
+        self._stderr = None
+
+    @property
+    def pid(self):
+        return self._prog.pid if self._prog is not None else None
+
+    def is_alive(self):
+        return self._prog is not None and self._prog.poll() is None
+
+    @property
+    def local_paths(self):
+        return [forward.split(":", 1)[0] for forward in self.forwards]
+
+    def get_error(self):
+        """
+        Get SSH error output of current or last SSH process
+        """
+        with self._lock:
+            if self._stderr is None:
+                return ""
+            return self._read_error()
+
+    def _read_error(self):
+        self._stderr.seek(0)
+        return self._stderr.read().decode(errors="replace").strip()
+
+    def _read_io(self):
+        """
+        Update I/O counters of current SSH process. Both its local sockets and
+        SSH connection are counted, so forwarded data is counted once on each
+        """
+        # Dead process PID could be reused already
+        if not self.is_alive():
+            return
+        try:
+            with open("/proc/%d/io" % self._prog.pid, encoding="ascii") as fd:
+                counters = dict(line.split(":", 1) for line in fd)
+        except OSError:
+            # Process is already gone, keep last counters
+            return
+        self._io_last = (int(counters["rchar"]), int(counters["wchar"]))
+
+    def get_traffic(self):
+        """
+        Get bytes read and written by SSH processes of this tunnel
+        """
+        with self._io_lock:
+            self._read_io()
+            return tuple(b + l for b, l in zip(self._io_base, self._io_last))
+
+    def probe(self):
+        """
+        Measure round trip time of SSH connection by running a no-op remote
+        command through it
+        """
+        command = [
+            self.ssh.SSH_COMMAND,
+            "-o",
+            "ControlMaster=no",
+            "-o",
+            "BatchMode=yes",
+            "-S",
+            self.control_socket,
+            "{user}@{host}".format(user=self.username, host=self.hostname),
+            "-p",
+            str(self.port),
+            "true",
+        ]
+        start = time.monotonic()
+        try:
+            subprocess.run(
+                command,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+                timeout=self.PROBE_TIMEOUT,
+                check=True,
+            )
+        except (OSError, subprocess.SubprocessError) as e:
+            self.probe_failures += 1
+            logger.warning("SSH tunnel %s probe failed: %s", self.control_socket, e)
+            return False
+        self.latency = time.monotonic() - start
+        self.probed = time.time()
+        return True
+
+    def _spawn(self):
+        # Stale control socket makes SSH fail to become master
+        if os.path.exists(self.control_socket):
+            os.remove(self.control_socket)
+
+        command = self.ssh.get_tunnel_command(
+            self.forwards,
+            self.private_key_file,
+            self.username,
+            self.hostname,
+            self.port,
+            control_socket=self.control_socket,
+            background=False,
+            **self.options,
+        )
+        if self._stderr is not None:
+            self._stderr.close()
+        # SSH can write warnings for the whole session, so use a file
+        self._stderr = tempfile.TemporaryFile(prefix="fc-ssh-tunnel")
+        self._prog = subprocess.Popen(
+            command,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=self._stderr,
+        )
+
+        # SSH creates control socket once forwardings are established
+        deadline = time.monotonic() + self.READY_TIMEOUT
+        while not os.path.exists(self.control_socket):
+            if self._prog.poll() is not None:
+                raise SSHTunnelException(
+                    "SSH tunnel exited with code %s: %s"
+                    % (self._prog.returncode, self._read_error())
+                )
+            if time.monotonic() >= deadline:
+                self._terminate()
+                raise SSHTunnelException("Timed out waiting for SSH tunnel")
+            time.sleep(self.READY_POLL_INTERVAL)
+        self.started = time.time()
+
+    def _terminate(self):
+        with self._io_lock:
+            self._read_io()
+            self._io_base = tuple(b + l for b, l in zip(self._io_base, self._io_last))
+            self._io_last = (0, 0)
+        if self.is_alive():
+            self._prog.terminate()
+            try:
+                self._prog.wait(self.CLOSE_TIMEOUT)
+            except subprocess.TimeoutExpired:
+                self._prog.kill()
+                self._prog.wait()
+
+    def start(self):
+        """
+        Start SSH process
+        """
+        with self._lock:
+            try:
+                self._spawn()
+            except Exception:
+                self._cleanup()
+                raise
+
+    def restart(self):
+        """
+        Restart SSH process
+        """
+        with self._lock:
+            if self.closing:
+                return
+            self.restarts += 1
+            self._terminate()
+            self._spawn()
+
+    def stop(self):
+        """
+        Stop SSH process
+        """
+        self.closing = True
+        with self._lock:
+            self._cleanup()
+
+    def _cleanup(self):
+        self._terminate()
+        # SSH does not remove local sockets when killed
+        for path in self.local_paths:
+            if os.path.exists(path):
+                os.remove(path)
+        if self._stderr is not None:
+            self._stderr.close()
+            self._stderr = None
+
+    def get_stats(self):
+        bytes_read, bytes_written = self.get_traffic()
+        return {
+            "pid": self.pid,
+            "alive": self.is_alive(),
+            "started": self.started,
+            "restarts": self.restarts,
+            "failures": self.failures,
+            "forwards": self.local_paths,
+            "bytes_read": bytes_read,
+            "bytes_written": bytes_written,
+            "latency": self.latency,
+            "probed": self.probed,
+            "probe_failures": self.probe_failures,
+        }
+
+
+class SSHTunnelManager:
+    """
+    Keeps SSH tunnels running, restarting them if they die
+    """
+
+    WATCHDOG_INTERVAL = 2
+    PROBE_INTERVAL = 30
+    RESTART_DELAY = 1
+    MAX_RESTART_DELAY = 60
+    # Make SSH exit on dead connections so tunnel gets restarted
+    DEFAULT_OPTIONS = {
+        "ServerAliveInterval": 15,
+        "ServerAliveCountMax": 3,
+        # Restarted SSH replaces local sockets left by the dead one
+        "StreamLocalBindUnlink": "yes",
+    }
+
+    def __init__(self, ssh):
+        """
+        Class initialization
+        """
+        self.ssh = ssh
+        self._lock = threading.Lock()
+        self._tunnels = {}
+        self._watchdog = None
+
+    def open_tunnel(
+        self,
+        local_forwards,
+        private_key_file,
+        username,
+        hostname,
+        port,
+        control_socket,
+        **kwargs
+    ):
+        """
+        Open a supervised tunnel identified by its control socket
+        """
+        for k, v in self.DEFAULT_OPTIONS.items():
+            kwargs.setdefault(k, v)
+
+        with self._lock:
+            previous = self._tunnels.pop(control_socket, None)
+        if previous is not None:
+            previous.stop()
+
+        tunnel = SSHTunnel(
+            self.ssh,
+            local_forwards,
+            private_key_file,
+            username,
+            hostname,
+            port,
+            control_socket=control_socket,
+            **kwargs,
+        )
+        try:
+            tunnel.start()
+        except Exception as e:
+            raise SSHTunnelException("Error opening tunnel: %s" % e)
+
+        with self._lock:
+            self._tunnels[control_socket] = tunnel
+            if self._watchdog is None:
+                self._watchdog = threading.Thread(
+                    target=self._watchdog_loop, name="fc-ssh-tunnel-watchdog"
+                )
+                self._watchdog.daemon = True
+                self._watchdog.start()
+
+    def close_tunnel(
+        self, private_key_file, username, hostname, port, control_socket, **kwargs
+    ):
+        """
+        Close tunnel identified by its control socket
+        """
+        with self._lock:
+            tunnel = self._tunnels.pop(control_socket, None)
+        if tunnel is not None:
+            tunnel.closing = True
+
+        # Ask SSH to exit gracefully. This also closes tunnels opened by
+        # previous service instances
+        try:
+            self.ssh.close_tunnel(
+                private_key_file,
+                username,
+                hostname,
+                port,
+                control_socket=control_socket,
+                **kwargs,
+            )
+        except Exception:
+            if tunnel is None:
+                raise
+        if tunnel is not None:
+            tunnel.stop()
+
+    def close_all(self):
+        """
+        Stop all tunnels
+        """
+        with self._lock:
+            tunnels = list(self._tunnels.values())
+            self._tunnels.clear()
+        for tunnel in tunnels:
+            tunnel.stop()
+
+    def get_stats(self, control_socket):
+        """
+        Get tunnel statistics or None if tunnel is not managed
+        """
+        with self._lock:
+            tunnel = self._tunnels.get(control_socket)
+        if tunnel is None:
+            return None
+        return tunnel.get_stats()
+
+    def get_forwards(self, control_socket):
+        """
+        Get local forwards of tunnel or None if tunnel is not managed
+        """
+        with self._lock:
+            tunnel = self._tunnels.get(control_socket)
+        if tunnel is None:
+            return None
+        return list(tunnel.forwards)
+
+    def check_tunnels(self):
+        """
+        Restart dead tunnels and measure latency of alive ones
+        """
+        with self._lock:
+            tunnels = list(self._tunnels.values())
+
+        now = time.monotonic()
+        for tunnel in tunnels:
+            if tunnel.closing:
+                continue
+            if tunnel.is_alive():
+                if now >= tunnel.next_probe:
+                    tunnel.next_probe = now + self.PROBE_INTERVAL
+                    tunnel.probe()
+                continue
+            if now < tunnel.next_restart:
+                continue
+            logger.warning(
+                "SSH tunnel %s died, restarting: %s",
+                tunnel.control_socket,
+                tunnel.get_error(),
+            )
+            try:
+                tunnel.restart()
+                tunnel.failures = 0
+            except Exception as e:
+                # Back off exponentially while remote host is unreachable
+                delay = min(
+                    self.RESTART_DELAY * 2**tunnel.failures, self.MAX_RESTART_DELAY
+                )
+                tunnel.failures += 1
+                tunnel.next_restart = time.monotonic() + delay
+                logger.error(
+                    "Error restarting SSH tunnel %s, retrying in %ss: %s",
+                    tunnel.control_socket,
+                    delay,
+                    e,
+                )
+
+    def _watchdog_loop(self):
+        while True:
+            time.sleep(self.WATCHDOG_INTERVAL)
+            try:
+                self.check_tunnels()
+            except Exception as e:
+                logger.error("Error checking SSH tunnels: %s", e)
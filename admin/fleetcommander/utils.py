@@ -68,6 +68,9 @@ def parse_config(config_file=None):
         "debug_protocol": section.getboolean(
             "debug_protocol", constants.DEFAULT_DEBUG_PROTOCOL
         ),
+        "compress_profiles": section.getboolean(
+            "compress_profiles", constants.DEFAULT_COMPRESS_PROFILES
+        ),
     }
 
     return args
@@ -3,29 +3,42 @@
 #
 """Common tests' assumptions."""
 
-SSH_TUNNEL_OPEN_PARMS = " ".join(
-    [
-        "{optional_args}",
-        "-i",
-        "{private_key_file}",
-        "-o",
-        "PreferredAuthentications=publickey",
-        "-o",
-        "PasswordAuthentication=no",
-        "-o",
-        "ExitOnForwardFailure=yes",
-        "-o",
-        "ControlMaster=yes",
-        "-S",
-        "{user_home}/.ssh/fc-control-ssh-tunnel.socket",
-        "{username}@{hostname}",
-        "-p",
-        "{port}",
-        "-L {local_forward}",
-        "-N",
-        "-f",
-    ]
+# Key returned by ssh-keyscan tool mock and its ssh-keygen -l fingerprint
+SSH_TEST_PUBLIC_KEY = (
+    "ssh-rsa AAAAB3NzaC1yc2EAAAADAQABAAABAQDFUjPOw5/FpId8oS1VGuqsAHl5MTTVUm"
+    "re6Th1mWxxLpXOS52L+4gdto0IeUSWQ7gTagllhGB9tXSlW7s77CRC8HWoiTAKYK7QPcRg"
+    "LdzD4oXs9J/C14BwD8wy7DcUfqRZ8MBpNvt0nD1p2a1qG3IYsxJnUrr0pfPMRMNE1TO/uO"
+    "QNgcwpNa2O+M0R3ryyvme9dvRV7U0ezIMien/Zk5NiJvbe+ZjoE/Kg75dOO9asRTJtAj8D"
+    "XvHYmp6ld6mia27/8lJAre79nK7oy2ZmxmmnzRbtevgi3OMv7YOWagD0ohfhhQdYVeeG4k"
+    "riJ/yd5tcqHJtJ/f9BLKjSQXM7CIgN"
 )
+SSH_TEST_FINGERPRINT = "2048 SHA256:0f90rmB1xev2/iJJcoiui7d1XCY2gqAaXKbskf/IIYg"
+
+_SSH_TUNNEL_PARMS = [
+    "{optional_args}",
+    "-i",
+    "{private_key_file}",
+    "-o",
+    "PreferredAuthentications=publickey",
+    "-o",
+    "PasswordAuthentication=no",
+    "-o",
+    "ExitOnForwardFailure=yes",
+    "-o",
+    "ControlMaster=yes",
+    "-S",
+    "{control_socket}",
+    "{username}@{hostname}",
+    "-p",
+    "{port}",
+    "-L {local_forward}",
+    "-N",
+]
+
+SSH_TUNNEL_OPEN_PARMS = " ".join(_SSH_TUNNEL_PARMS + ["-f"])
+
+# Tunnels kept in foreground by the tunnel manager
+SSH_TUNNEL_SUPERVISED_PARMS = " ".join(_SSH_TUNNEL_PARMS)
 
 SSH_REMOTE_COMMAND_PARMS = " ".join(
     [
@@ -55,7 +68,7 @@ SSH_TUNNEL_CLOSE_PARMS = " ".join(
         "-p",
         "{port}",
         "-S",
-        "{user_home}/.ssh/fc-control-ssh-tunnel.socket",
+        "{control_socket}",
         "-O",
         "exit",
     ]
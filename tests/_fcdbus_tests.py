@@ -34,6 +34,7 @@ import logging
 from fleetcommander import sshcontroller
 
 # Tests imports
+from tests import SSH_TEST_PUBLIC_KEY, SSH_TEST_FINGERPRINT
 from tests.test_fcdbus_service import MockLibVirtController
 from tests.fcdbusclient import FleetCommanderDbusClient
 
@@ -273,13 +274,11 @@ class TestDbusService(unittest.TestCase):
         # Check not known host
         resp = self.c.check_known_host("localhost")
         self.assertFalse(resp["status"])
-        self.assertEqual(resp["fprint"], "2048 SHA256:HASH localhost (RSA)\n")
-        self.assertEqual(resp["keys"], "localhost ssh-rsa KEY\n")
+        self.assertEqual(resp["fprint"], SSH_TEST_FINGERPRINT + " localhost (RSA)\n")
+        self.assertEqual(resp["keys"], "localhost " + SSH_TEST_PUBLIC_KEY + "\n")
 
         # Add host to known hosts
-        self.ssh.add_keys_to_known_hosts(
-            self.known_hosts_file, "localhost ssh-rsa KEY\n"
-        )
+        self.ssh.add_keys_to_known_hosts(self.known_hosts_file, resp["keys"])
 
         # Check already known host
         resp = self.c.check_known_host("localhost")
@@ -297,6 +296,42 @@ class TestDbusService(unittest.TestCase):
         resp = self.c.check_known_host("localhost")
         self.assertTrue(resp["status"])
 
+    def test_07_check_known_hosts(self):
+        # Same host given with and without default port
+        hostnames = ["localhost", "localhost:22", "otherhost:2022"]
+        resp = self.c.check_known_hosts(hostnames)
+        self.assertTrue(resp["status"])
+        self.assertEqual(
+            resp["hosts"],
+            {
+                hostname: {
+                    "status": False,
+                    "fprint": SSH_TEST_FINGERPRINT + " %s (RSA)\n" % host,
+                    "keys": "%s %s\n" % (host, SSH_TEST_PUBLIC_KEY),
+                }
+                for hostname, host in zip(
+                    hostnames, ["localhost", "localhost", "otherhost"]
+                )
+            },
+        )
+
+        # Add accepted host keys
+        keys = resp["hosts"]["localhost"]["keys"]
+        resp = self.c.add_known_hosts(
+            {"localhost": keys, "otherhost:2022": "anotherhost ssh-rsa KEY\n"}
+        )
+        self.assertFalse(resp["status"])
+        self.assertEqual(resp["errors"], {"otherhost:2022": "Invalid key data"})
+
+        resp = self.c.check_known_hosts(hostnames)
+        self.assertEqual(resp["hosts"]["localhost"], {"status": True})
+        self.assertEqual(resp["hosts"]["localhost:22"], {"status": True})
+        self.assertFalse(resp["hosts"]["otherhost:2022"]["status"])
+
+        # Invalid data
+        resp = self.c.check_known_hosts("localhost")
+        self.assertFalse(resp["status"])
+
     def test_08_install_public_key(self):
         # Test install with bad credentials
         resp = self.c.install_pubkey(
@@ -347,7 +382,13 @@ class TestDbusService(unittest.TestCase):
         # Get domains
         resp = self.c.list_domains()
         self.assertTrue(resp["status"])
-        self.assertEqual(resp["domains"], MockLibVirtController.DOMAINS_LIST)
+        self.assertEqual(
+            resp["domains"],
+            [
+                dict(domain, hypervisors=["myhost"])
+                for domain in MockLibVirtController.DOMAINS_LIST
+            ],
+        )
 
     def test_12_session_start(self):
         # Configure hypervisor
@@ -363,26 +404,43 @@ class TestDbusService(unittest.TestCase):
                 "ticket": "spice_ticket",
             },
         )
-        # Try to start another session
-        resp = self.c.session_start(self.TEMPLATE_UUID)
-        self.assertFalse(resp["status"])
-        self.assertEqual(resp["error"], "Session already started")
+        self.assertIn("uuid", resp)
+        # Start another concurrent session from the same template
+        resp2 = self.c.session_start(self.TEMPLATE_UUID)
+        self.assertTrue(resp2["status"])
+        self.assertNotEqual(resp["uuid"], resp2["uuid"])
+        # Both sessions are listed
+        resp = self.c.list_sessions()
+        self.assertTrue(resp["status"])
+        self.assertEqual(len(resp["sessions"]), 2)
+        for session in resp["sessions"]:
+            self.assertEqual(session["template"], self.TEMPLATE_UUID)
+            self.assertEqual(session["spice_wait_time"], 0.5)
+            # Mocked sessions have no SSH tunnel
+            self.assertIsNone(session["tunnel"])
 
     def test_13_session_stop(self):
         # Configure hypervisor
         self.configure_hypervisor()
         # Stop without previous session start
-        resp = self.c.session_stop()
+        resp = self.c.session_stop("unknown")
         self.assertFalse(resp["status"])
         self.assertEqual(resp["error"], "There was no session started")
-        # Stop previous started session
-        self.c.session_start(self.TEMPLATE_UUID)
-        resp = self.c.session_stop()
+        # Stop previous started sessions
+        session1 = self.c.session_start(self.TEMPLATE_UUID)["uuid"]
+        session2 = self.c.session_start(self.TEMPLATE_UUID)["uuid"]
+        resp = self.c.session_stop(session1)
         self.assertTrue(resp["status"])
+        # Second session keeps running
+        self.assertTrue(self.c.is_session_active(session2))
+        self.assertTrue(self.c.heartbeat(session2))
+        self.assertFalse(self.c.heartbeat(session1))
         # Stop again
-        resp = self.c.session_stop()
+        resp = self.c.session_stop(session1)
         self.assertFalse(resp["status"])
         self.assertEqual(resp["error"], "There was no session started")
+        resp = self.c.session_stop(session2)
+        self.assertTrue(resp["status"])
 
     def test_14_empty_session_save(self):
         # Create a profile
@@ -464,22 +522,126 @@ class TestDbusService(unittest.TestCase):
         # Configure hypervisor
         self.configure_hypervisor()
 
-        # Check current session active without starting any
+        # Check session active without giving its uuid
         resp = self.c.is_session_active()
         self.assertFalse(resp)
 
-        # Check current session active after started current session
-        self.c.session_start(self.TEMPLATE_UUID)
-        resp = self.c.is_session_active()
+        # Check session active after started
+        session_uuid = self.c.session_start(self.TEMPLATE_UUID)["uuid"]
+        resp = self.c.is_session_active(session_uuid)
         self.assertTrue(resp)
 
         # Check non existent session by its uuid
         resp = self.c.is_session_active("unknown")
         self.assertFalse(resp)
 
-        # Check existent session by its uuid
-        resp = self.c.is_session_active("")
-        self.assertTrue(resp)
+        # Check stopped session by its uuid
+        self.c.session_stop(session_uuid)
+        resp = self.c.is_session_active(session_uuid)
+        self.assertFalse(resp)
+
+    def test_20_session_pool(self):
+        # Check invalid pool settings
+        data = {
+            "host": "myhost",
+            "username": "valid_user",
+            "mode": "session",
+            "viewer": "spice_html5",
+            "pool_size": 100,
+            "pool_templates": "invalid",
+        }
+        resp = self.c.check_hypervisor_config(data)
+        self.assertFalse(resp["status"])
+        self.assertEqual(
+            resp["errors"],
+            {
+                "pool_size": "Invalid session pool size",
+                "pool_templates": "Invalid session pool templates",
+            },
+        )
+
+        # Configure hypervisor with a session pool
+        data["pool_size"] = 1
+        data["pool_templates"] = [self.TEMPLATE_UUID]
+        resp = self.c.check_hypervisor_config(data)
+        self.assertTrue(resp["status"])
+        self.c.set_hypervisor_config(data)
+
+        # Wait for pooled domain to be started in background
+        checks = 0
+        while True:
+            domains = [d for d in self.c.list_domains()["domains"] if d["temporary"]]
+            if domains or checks >= self.MAX_DBUS_CHECKS:
+                break
+            checks += 1
+            time.sleep(0.5)
+        self.assertEqual(len(domains), 1)
+        pooled_uuid = domains[0]["uuid"]
+
+        # Session start claims the pooled domain
+        resp = self.c.session_start(self.TEMPLATE_UUID)
+        self.assertTrue(resp["status"])
+        self.assertEqual(resp["uuid"], pooled_uuid)
+
+    def test_21_multiple_hypervisors(self):
+        data = {
+            "host": "myhost",
+            "username": "valid_user",
+            "mode": "session",
+            "viewer": "spice_html5",
+            "hypervisors": [
+                {
+                    "host": "otherhost",
+                    "username": "valid_user",
+                    "mode": "session",
+                    "viewer": "spice_html5",
+                    "max_sessions": -1,
+                }
+            ],
+        }
+        # Check invalid capacity hints
+        resp = self.c.check_hypervisor_config(data)
+        self.assertFalse(resp["status"])
+        self.assertEqual(
+            resp["errors"], {"hypervisors": "Invalid additional hypervisors"}
+        )
+
+        data["hypervisors"][0]["max_sessions"] = 1
+        resp = self.c.check_hypervisor_config(data)
+        self.assertTrue(resp["status"])
+        self.c.set_hypervisor_config(data)
+
+        # Template available in both hypervisors is listed once
+        resp = self.c.list_domains()
+        self.assertTrue(resp["status"])
+        templates = [d for d in resp["domains"] if not d["temporary"]]
+        self.assertEqual(len(templates), 1)
+        self.assertEqual(templates[0]["hypervisors"], ["myhost", "otherhost"])
+
+        # Sessions are spread across hypervisors
+        hosts = []
+        for _i in range(3):
+            resp = self.c.session_start(self.TEMPLATE_UUID)
+            self.assertTrue(resp["status"])
+        for session in self.c.list_sessions()["sessions"]:
+            hosts.append(session["hypervisor"])
+        # Other host is limited to one session
+        self.assertEqual(sorted(hosts), ["myhost", "myhost", "otherhost"])
+
+    def test_22_validate_applies(self):
+        resp = self.c.validate_applies(
+            {"users": ["admin", "fake"], "hosts": ["client1"], "hostgroups": []}
+        )
+        self.assertTrue(resp["status"])
+        self.assertEqual(
+            resp["data"],
+            {
+                "users": {"found": ["admin"], "missing": ["fake"]},
+                "groups": {"found": [], "missing": []},
+                "hosts": {"found": ["client1"], "missing": []},
+                "hostgroups": {"found": [], "missing": []},
+            },
+        )
 
 
 if __name__ == "__main__":
@@ -32,6 +32,12 @@ class DirectoryData:
         # Data storage
         self.global_policy = 1
         self.profiles = {}
+        self.applies = {
+            "users": ["admin", "guest"],
+            "groups": ["admins", "editors"],
+            "hosts": ["client1"],
+            "hostgroups": ["ipaservers"],
+        }
 
     def get_json(self):
         data = {
@@ -73,7 +79,7 @@ class DirectoryConnector:
 
     data = None
 
-    def __init__(self, domain=None):
+    def __init__(self, domain=None, **kwargs):
         pass
 
     def connect(self, sanity_check=True):
@@ -126,3 +132,11 @@ class DirectoryConnector:
     def get_profile(self, cn):
         logging.debug("Directory Mock: Getting profile %s", cn)
         return self.data.profiles.get(cn, {})
+
+    def check_applies(self, applies):
+        logging.debug("Directory Mock: Checking applies %s", applies)
+        result = {}
+        for key, existing in self.data.applies.items():
+            names = set(applies.get(key, []))
+            result[key] = (names & set(existing), names - set(existing))
+        return result
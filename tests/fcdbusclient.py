@@ -68,8 +68,8 @@ class FleetCommanderDbusClient:
     def do_domain_connection(self):
         return self.iface.DoDomainConnection()
 
-    def heartbeat(self):
-        return self.iface.HeartBeat()
+    def heartbeat(self, session_uuid=""):
+        return self.iface.HeartBeat(session_uuid)
 
     def check_needs_configuration(self):
         return self.iface.CheckNeedsConfiguration()
@@ -92,6 +92,12 @@ class FleetCommanderDbusClient:
     def add_known_host(self, host):
         return json.loads(self.iface.AddKnownHost(host))
 
+    def check_known_hosts(self, hosts):
+        return json.loads(self.iface.CheckKnownHosts(json.dumps(hosts)))
+
+    def add_known_hosts(self, hosts):
+        return json.loads(self.iface.AddKnownHosts(json.dumps(hosts)))
+
     def install_pubkey(self, host, user, passwd):
         return json.loads(self.iface.InstallPubkey(host, user, passwd))
 
@@ -113,14 +119,20 @@ class FleetCommanderDbusClient:
     def delete_profile(self, uid):
         return json.loads(self.iface.DeleteProfile(uid))
 
+    def validate_applies(self, applies):
+        return json.loads(self.iface.ValidateApplies(json.dumps(applies)))
+
     def list_domains(self):
         return json.loads(self.iface.ListDomains())
 
     def session_start(self, domain_uuid):
         return json.loads(self.iface.SessionStart(domain_uuid))
 
-    def session_stop(self):
-        return json.loads(self.iface.SessionStop())
+    def session_stop(self, session_uuid=""):
+        return json.loads(self.iface.SessionStop(session_uuid))
+
+    def list_sessions(self):
+        return json.loads(self.iface.ListSessions())
 
     def session_save(self, uid, data):
         return json.loads(self.iface.SessionSave(uid, json.dumps(data)))
@@ -49,6 +49,14 @@ class FreeIPAData:
         self.profilerules = {}
         self.global_policy = 1
 
+    @staticmethod
+    def store_data(ipadeskdata):
+        # Compressed data is binary
+        try:
+            return ipadeskdata.decode()
+        except UnicodeDecodeError:
+            return ipadeskdata
+
     def get_json(self):
         data = {
             "users": self.users,
@@ -103,15 +111,34 @@ class FreeIPAErrors:
     class ValidationError(Exception):
         pass
 
+    class NetworkError(Exception):
+        pass
+
+    class KerberosError(Exception):
+        pass
+
+    class SessionError(Exception):
+        pass
+
 
 class FreeIPARPCClient:
-    @staticmethod
-    def isconnected():
-        return True
 
-    @staticmethod
-    def connect():
+    connected = False
+
+    @classmethod
+    def isconnected(cls):
+        return cls.connected
+
+    @classmethod
+    def connect(cls):
         logger.debug("Mocking IPA connection")
+        if cls.connected:
+            raise RuntimeError("IPAMock: already connected")
+        cls.connected = True
+
+    @classmethod
+    def disconnect(cls):
+        cls.connected = False
 
 
 class FreeIPABackend:
@@ -125,6 +152,17 @@ class FreeIPACommand:
     def ping(self):
         return
 
+    def batch(self, *methods):
+        results = []
+        for method in methods:
+            args, options = method["params"]
+            try:
+                result = getattr(self, method["method"])(*args, **options)
+                results.append(dict(result or {}, error=None))
+            except Exception as e:
+                results.append({"error": str(e), "error_name": e.__class__.__name__})
+        return {"count": len(results), "results": results}
+
     def deskprofileconfig_show(self):
         return {"result": {"ipadeskprofilepriority": (self.data.global_policy,)}}
 
@@ -211,7 +249,7 @@ class FreeIPACommand:
         self.data.profiles[cn] = {
             "cn": (cn,),
             "description": (description,),
-            "ipadeskdata": (ipadeskdata.decode(),),
+            "ipadeskdata": (self.data.store_data(ipadeskdata),),
         }
         logger.debug("IPAMock: Stored data: %s", self.data.profiles[cn])
 
@@ -219,7 +257,7 @@ class FreeIPACommand:
     def deskprofile_mod(self, cn, description, ipadeskdata):
         if cn in self.data.profiles:
             self.data.profiles[cn]["description"] = (description,)
-            self.data.profiles[cn]["ipadeskdata"] = (ipadeskdata.decode(),)
+            self.data.profiles[cn]["ipadeskdata"] = (self.data.store_data(ipadeskdata),)
         else:
             raise FreeIPAErrors.NotFound()
 
@@ -278,6 +316,16 @@ class FreeIPACommand:
                 host,
                 hostgroup,
             )
+            failed = {
+                "host": [
+                    (x, "no such entry") for x in host if x not in self.data.hosts
+                ],
+                "hostgroup": [
+                    (x, "no such entry")
+                    for x in hostgroup
+                    if x not in self.data.hostgroups
+                ],
+            }
             host = list(set(host).intersection(set(self.data.hosts)))
             self.data.profilerules[name]["hosts"].extend(host)
             self.data.profilerules[name]["hosts"] = sorted(
@@ -288,8 +336,8 @@ class FreeIPACommand:
             self.data.profilerules[name]["hostgroups"] = sorted(
                 list(set(self.data.profilerules[name]["hostgroups"]))
             )
-        else:
-            raise FreeIPAErrors.NotFound()
+            return {"result": {}, "failed": {"memberhost": failed}}
+        raise FreeIPAErrors.NotFound()
 
     @FreeIPAData.export_data
     def deskprofilerule_remove_user(self, name, user, group):
@@ -21,6 +21,7 @@
 
 # Python imports
 import logging
+import re
 
 
 DOMAIN_DATA = {}
@@ -44,7 +45,11 @@ class LDAPConnectionMock:
         logging.debug("LDAPMock initializing connection: %s", server_address)
         self.server_address = server_address
         self.options = {}
-        self._domain_data = DOMAIN_DATA
+
+    @property
+    def _domain_data(self):
+        # Connections outlive domain data resets between tests
+        return DOMAIN_DATA
 
     def _ldif_to_ldap_data(self, ldif):
         data = {}
@@ -63,6 +68,12 @@ class LDAPConnectionMock:
             "SASLMock: Incorrect parameters for SASL binding: %s, %s" % (who, sasl_auth)
         )
 
+    def whoami_s(self):
+        return "u:FC\\admin"
+
+    def unbind_s(self):
+        logging.debug("LDAPMock: unbind_s")
+
     def search_s(
         self,
         base,
@@ -73,42 +84,55 @@ class LDAPConnectionMock:
         timeout=-1,
     ):
         logging.debug("LDAPMock search_s: %s - %s", base, filterstr)
+        # Names and SIDs can be ORed in a single filter
+        names = re.findall(r"\(CN=([^)]*)\)", filterstr)
         if base == "DC=FC,DC=AD":
-            groupfilter = "(&(objectclass=group)(CN="
-            sidfilter = "(&(|(objectclass=computer)(objectclass=user)(objectclass=group))(objectSid="
+            groupfilter = "(&(objectclass=group)"
+            sidfilter = "(&(|(objectclass=computer)(objectclass=user)(objectclass=group))"
             if filterstr == "(objectClass=*)" and attrlist == ["objectSid"]:
                 return (("cn", self._domain_data["domain"]),)
-            if sidfilter in filterstr:
-                filtersid = filterstr[len(sidfilter) : -2]
+            if filterstr.startswith(sidfilter):
+                filtersids = re.findall(r"\(objectSid=([^)]*)\)", filterstr)
+                results = []
                 for objclass in ["users", "groups", "hosts"]:
                     for _key, elem in self._domain_data[objclass].items():
                         # Use unpacked object sid to avoid use of ndr_unpack
-                        if filtersid == elem["unpackedObjectSid"]:
-                            return [
-                                (elem["cn"], elem),
-                            ]
-            elif groupfilter in filterstr:
-                groupname = filterstr[len(groupfilter) : -2]
-                if groupname in self._domain_data["groups"].keys():
-                    return (("cn", self._domain_data["groups"][groupname]),)
+                        if elem["unpackedObjectSid"] in filtersids:
+                            results.append((elem["cn"], elem))
+                return results
+            if filterstr.startswith(groupfilter):
+                return [
+                    ("cn", self._domain_data["groups"][name])
+                    for name in names
+                    if name in self._domain_data["groups"]
+                ]
         elif base == "CN=Users,DC=FC,DC=AD":
-            userfilter = "(&(objectclass=user)(CN="
-            if userfilter in filterstr:
-                username = filterstr[len(userfilter) : -2]
-                if username in self._domain_data["users"].keys():
-                    return (("cn", self._domain_data["users"][username]),)
+            if filterstr.startswith("(&(objectclass=user)"):
+                return [
+                    ("cn", self._domain_data["users"][name])
+                    for name in names
+                    if name in self._domain_data["users"]
+                ]
         elif base == "CN=Computers,DC=FC,DC=AD":
-            hostfilter = "(&(objectclass=computer)(CN="
-            if hostfilter in filterstr:
-                hostname = filterstr[len(hostfilter) : -2]
-                if hostname in self._domain_data["hosts"].keys():
-                    return (("cn", self._domain_data["hosts"][hostname]),)
+            if filterstr.startswith("(&(objectclass=computer)"):
+                return [
+                    ("cn", self._domain_data["hosts"][name])
+                    for name in names
+                    if name in self._domain_data["hosts"]
+                ]
         elif base == "CN=Policies,CN=System,DC=FC,DC=AD":
             if filterstr == "(objectclass=groupPolicyContainer)":
                 profile_list = []
                 for cn, _profile in self._domain_data["profiles"].items():
                     profile_list.append((cn, self._domain_data["profiles"][cn]))
                 return profile_list
+            if filterstr.startswith("(|"):
+                results = []
+                for name in names:
+                    cn = "CN=%s,CN=Policies,CN=System,DC=FC,DC=AD" % name
+                    if cn in self._domain_data["profiles"]:
+                        results.append((cn, self._domain_data["profiles"][cn]))
+                return results
             if "(displayName=" in filterstr:
                 displayname = filterstr[len("(displayName=") : -1]
                 # Trying to get a profile by its display name
@@ -121,6 +145,43 @@ class LDAPConnectionMock:
                     return [(cn, self._domain_data["profiles"][cn])]
         return []
 
+    def search_ext(
+        self,
+        base,
+        scope,
+        filterstr="(objectClass=*)",
+        attrlist=None,
+        attrsonly=0,
+        serverctrls=None,
+    ):
+        logging.debug("LDAPMock search_ext: %s - %s", base, filterstr)
+        results = []
+        if base == "CN=Policies,CN=System,DC=FC,DC=AD":
+            match = re.match(
+                r"\(&\(objectclass=groupPolicyContainer\)"
+                r"\(displayName=([^)*]*)\*\)\(!\(displayName=([^)]*)\)\)\)",
+                filterstr,
+            )
+            if match:
+                prefix, excluded = match.groups()
+                for cn, profile in self._domain_data["profiles"].items():
+                    displayname = profile["displayName"][0].decode()
+                    if displayname.startswith(prefix) and displayname != excluded:
+                        results.append((cn, profile))
+        # Return results in pages as requested by paged results control
+        control = serverctrls[0]
+        offset = int(control.cookie or 0)
+        end = offset + control.size
+        cookie = str(end).encode() if end < len(results) else b""
+        self._pending = (results[offset:end], cookie)
+        self.pages = getattr(self, "pages", 0) + 1
+        return 1
+
+    def result3(self, msgid):
+        results, cookie = self._pending
+        control = PagedResultsControlMock(cookie)
+        return (RES_SEARCH_RESULT, results, msgid, [control])
+
     def add_s(self, dn, ldif):
         self._domain_data["profiles"][dn] = self._ldif_to_ldap_data(ldif)
 
@@ -138,15 +199,25 @@ class LDAPConnectionMock:
             del self._domain_data["profiles"][dn]
 
 
+class PagedResultsControlMock:
+
+    controlType = "1.2.840.113556.1.4.319"
+
+    def __init__(self, cookie):
+        self.cookie = cookie
+
+
 # Mock sasl module
 sasl = SASLMock
 
 
 # Constants
 OPT_REFERRALS = 1
+OPT_NETWORK_TIMEOUT = 5
 SCOPE_SUBTREE = 2
 SCOPE_BASE = 3
 MOD_REPLACE = 4
+RES_SEARCH_RESULT = 101
 
 
 # Functions
@@ -20,8 +20,12 @@
 #          Oliver Gutiérrez <ogutierrez@redhat.com>
 
 from __future__ import absolute_import
+from collections import Counter
 import os
 import pickle
+import sqlite3
+import threading
+import time
 import xml.etree.ElementTree as ET
 
 import libvirt
@@ -105,6 +109,9 @@ UUID_TEMPORARY_SPICE_DIRECT_DEBUG = "222debug-722d-45d9-b66c-fefb33235a98"
 UUID_TEMPORARY_SPICE_DIRECT_PLAIN = "33333333-722d-45d9-b66c-fefb33235a98"
 UUID_TEMPORARY_SPICE_DIRECT_PLAIN_DEBUG = "333debug-722d-45d9-b66c-fefb33235a98"
 
+# Remote calls done to libvirt by method name
+RPC_CALLS = Counter()
+
 
 class State(SQLiteDict):
     """
@@ -114,17 +121,44 @@ class State(SQLiteDict):
     TABLE_NAME = "libvirtmockstate"
 
 
+class ThreadedDBManager(BaseDBManager):
+    """
+    Database manager usable from controller worker threads
+    """
+
+    def __init__(self, database):
+        self.conn = sqlite3.connect(database, uri=True, check_same_thread=False)
+        self.cursor = self.conn.cursor()
+
+
 class LibvirtModuleMocker:
 
     db_path = ":memory:"
 
     VIR_DOMAIN_METADATA_TITLE = 1
     VIR_DOMAIN_XML_SECURE = 1
+    VIR_DOMAIN_EVENT_ID_LIFECYCLE = 0
+    VIR_DOMAIN_EVENT_DEFINED = 0
+    VIR_DOMAIN_EVENT_UNDEFINED = 1
+    VIR_DOMAIN_EVENT_STARTED = 2
+    VIR_DOMAIN_EVENT_SUSPENDED = 3
+    VIR_DOMAIN_EVENT_RESUMED = 4
+    VIR_DOMAIN_EVENT_STOPPED = 5
+    VIR_CONNECT_LIST_DOMAINS_ACTIVE = 1
+    VIR_CONNECT_LIST_DOMAINS_INACTIVE = 2
+
+    @classmethod
+    def virEventRegisterDefaultImpl(cls):
+        pass
+
+    @classmethod
+    def virEventRunDefaultImpl(cls):
+        time.sleep(0.1)
 
     @classmethod
     def open(cls, connection_uri):
         # Return a LibvirtConnectionMocker
-        LibvirtConnectionMocker.state = State(BaseDBManager(cls.db_path))
+        LibvirtConnectionMocker.state = State(ThreadedDBManager(cls.db_path))
         conn = LibvirtConnectionMocker(connection_uri)
         return conn
 
@@ -134,6 +168,8 @@ class LibvirtConnectionMocker(libvirt.virConnect):
     Class for mocking libvirt connection
     """
 
+    state_lock = threading.Lock()
+
     def __init__(self, connection_uri):
         self.connection_uri = connection_uri
 
@@ -194,16 +230,26 @@ class LibvirtConnectionMocker(libvirt.virConnect):
 
     @property
     def domains(self):
-        return pickle.loads(self.state["domains"])
+        with self.state_lock:
+            return pickle.loads(self.state["domains"])
 
     def listAllDomains(self, flags=0):
-        return self.domains
+        RPC_CALLS["listAllDomains"] += 1
+        domains = self.domains
+        active = flags & LibvirtModuleMocker.VIR_CONNECT_LIST_DOMAINS_ACTIVE
+        inactive = flags & LibvirtModuleMocker.VIR_CONNECT_LIST_DOMAINS_INACTIVE
+        if active and not inactive:
+            domains = [d for d in domains if d.active]
+        elif inactive and not active:
+            domains = [d for d in domains if not d.active]
+        return domains
 
     def createXML(self, xmlDesc, flags=0):
         newdomain = LibvirtDomainMocker(xmlDesc)
-        domains = self.domains
-        domains.append(newdomain)
-        self.state["domains"] = pickle.dumps(domains)
+        with self.state_lock:
+            domains = pickle.loads(self.state["domains"])
+            domains.append(newdomain)
+            self.state["domains"] = pickle.dumps(domains)
         return newdomain
 
     def lookupByUUIDString(self, uuidstr):
@@ -215,6 +261,38 @@ class LibvirtConnectionMocker(libvirt.virConnect):
     def getHostname(self):
         return "localhost"
 
+    def getFreeMemory(self):
+        RPC_CALLS["getFreeMemory"] += 1
+        return 8 * 1024 * 1024 * 1024
+
+    def domainEventRegisterAny(self, dom, eventID, cb, opaque):
+        self.event_callbacks = getattr(self, "event_callbacks", {})
+        callback_id = max(self.event_callbacks, default=-1) + 1
+        self.event_callbacks[callback_id] = (dom, eventID, cb, opaque)
+        return callback_id
+
+    def domainEventDeregisterAny(self, callbackID):
+        del self.event_callbacks[callbackID]
+
+    def emit_domain_event(self, dom, event, detail=0):
+        for cbdom, _event_id, cb, opaque in self.event_callbacks.values():
+            if cbdom is None or cbdom.UUIDString() == dom.UUIDString():
+                cb(self, dom, event, detail, opaque)
+
+    def registerCloseCallback(self, cb, opaque):
+        self.close_callback = (cb, opaque)
+
+    def unregisterCloseCallback(self):
+        self.close_callback = None
+
+    def close(self):
+        self.closed = True
+        return 0
+
+    def emit_close(self, reason=0):
+        cb, opaque = self.close_callback
+        cb(self, reason, opaque)
+
     def __del__(self):
         pass
 
@@ -276,12 +354,14 @@ class LibvirtDomainMocker:
         return self.xmldata
 
     def isActive(self):
+        RPC_CALLS["isActive"] += 1
         return self.active
 
     def isPersistent(self):
         return not self.transient
 
     def metadata(self, element, namespace):
+        RPC_CALLS["metadata"] += 1
         if (
             namespace is None
             and element == LibvirtModuleMocker.VIR_DOMAIN_METADATA_TITLE
@@ -24,6 +24,9 @@ import shutil
 import json
 import logging
 
+import samba
+from samba import ntstatus
+
 # Temporary directory. Set on each test run at setUp()
 TEMP_DIR = None
 
@@ -31,11 +34,12 @@ TEMP_DIR = None
 class SMBMock:
     def __init__(self, servername, service, lp, creds):
         logging.debug("SMBMock: Mocking SMB at \\\\%s\\%s", servername, service)
-        self.tempdir = TEMP_DIR
-        logging.debug("Using temporary directory at %s", self.tempdir)
-        self.profilesdir = os.path.join(self.tempdir, "%s/Policies" % servername)
-        if not os.path.exists(self.profilesdir):
-            os.makedirs(self.profilesdir)
+        self.servername = servername
+
+    @property
+    def tempdir(self):
+        # Pooled connections outlive temporary directory resets between tests
+        return TEMP_DIR
 
     def _translate_path(self, uri):
         return os.path.join(self.tempdir, uri.replace("\\", "/"))
@@ -43,6 +47,10 @@ class SMBMock:
     def loadfile(self, furi):
         logging.debug("SMBMock: LOADFILE %s", furi)
         path = self._translate_path(furi)
+        if not os.path.isfile(path):
+            raise samba.NTSTATUSError(
+                ntstatus.NT_STATUS_OBJECT_NAME_NOT_FOUND, "Object name not found"
+            )
         with open(path, "rb") as fd:
             data = fd.read()
 
@@ -0,0 +1,136 @@
+#!/usr/bin/env python-wrapper.sh
+# -*- coding: utf-8 -*-
+# vi:ts=2 sw=2 sts=2
+
+# Copyright (C) 2021 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the licence, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program; if not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import
+import os
+import logging
+import unittest
+
+from fleetcommander.connection import connection_required
+
+logger = logging.getLogger(os.path.basename(__file__))
+
+
+class ConnectionLost(Exception):
+    pass
+
+
+class Connector:
+    """
+    Connector failing its calls as many times as requested
+    """
+
+    def __init__(self):
+        self._in_call = False
+        self.stats = {"connects": 0, "reconnects": 0, "used": 0}
+        self.calls = []
+        self.failures = 0
+        self.connected = False
+
+    def connect(self):
+        if not self.connected:
+            self.stats["connects"] += 1
+            self.connected = True
+
+    def disconnect(self):
+        self.connected = False
+
+    def _connection_used(self):
+        self.stats["used"] += 1
+
+    @staticmethod
+    def _connection_errors():
+        return (ConnectionLost,)
+
+    def _call(self, name, error=ConnectionLost):
+        self.calls.append(name)
+        if self.failures:
+            self.failures -= 1
+            raise error()
+        return name
+
+    @connection_required
+    def read(self, error=ConnectionLost):
+        return self._call("read", error)
+
+    @connection_required(retry=False)
+    def write(self):
+        return self._call("write")
+
+    @connection_required
+    def read_twice(self):
+        return [self.read(), self.read()]
+
+
+class TestConnectionRequired(unittest.TestCase):
+    def setUp(self):
+        self.connector = Connector()
+
+    def test_00_connect(self):
+        self.assertEqual(self.connector.read(), "read")
+        self.assertEqual(self.connector.read(), "read")
+        self.assertEqual(
+            self.connector.stats, {"connects": 1, "reconnects": 0, "used": 2}
+        )
+
+    def test_01_read_retried(self):
+        self.connector.failures = 1
+        self.assertEqual(self.connector.read(), "read")
+        self.assertEqual(self.connector.calls, ["read", "read"])
+        self.assertEqual(
+            self.connector.stats, {"connects": 2, "reconnects": 1, "used": 1}
+        )
+
+        # Call is only retried once
+        self.connector.failures = 2
+        with self.assertRaises(ConnectionLost):
+            self.connector.read()
+        self.assertFalse(self.connector.connected)
+
+    def test_02_write_not_retried(self):
+        self.connector.failures = 1
+        with self.assertRaises(ConnectionLost):
+            self.connector.write()
+        self.assertEqual(self.connector.calls, ["write"])
+        # Connection is replaced for next calls
+        self.assertTrue(self.connector.connected)
+        self.assertEqual(
+            self.connector.stats, {"connects": 2, "reconnects": 1, "used": 0}
+        )
+
+    def test_03_nested_calls(self):
+        # Outermost call is retried as a whole
+        self.connector.failures = 1
+        self.assertEqual(self.connector.read_twice(), ["read", "read"])
+        self.assertEqual(self.connector.calls, ["read", "read", "read"])
+        self.assertEqual(self.connector.stats["reconnects"], 1)
+        self.assertFalse(self.connector._in_call)
+
+    def test_04_other_errors(self):
+        self.connector.failures = 1
+        with self.assertRaises(ValueError):
+            self.connector.read(ValueError)
+        self.assertEqual(self.connector.calls, ["read"])
+        self.assertTrue(self.connector.connected)
+        self.assertFalse(self.connector._in_call)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.DEBUG)
+    unittest.main(verbosity=2)
@@ -108,7 +108,7 @@ class TestDBManager(unittest.TestCase):
 
     def test_07_update_schema(self):
         """Test an upgrade of sqlite db schema."""
-        tables = ["config", "profiles"]
+        tables = ["config", "profiles", "sessions", "pool"]
         upgrade_db = "file:mem_upgrade?mode=memory&cache=shared"
         old_db = DBManager(upgrade_db)
         old_schema_version = 1
@@ -28,11 +28,17 @@ import tempfile
 import logging
 import copy
 import json
+import time
+
+from unittest.mock import patch
 
 from ldap import modlist
 from ldap import LDAPError
+from ldap import SERVER_DOWN
 
 # Samba imports
+import samba
+from samba import ntstatus
 from samba.ndr import ndr_pack
 from samba.dcerpc import security
 
@@ -48,16 +54,30 @@ logger = logging.getLogger(os.path.basename(__file__))
 fcad.ldap = ldapmock
 fcad.ldap.modlist = modlist
 fcad.ldap.LDAPError = LDAPError
+fcad.ldap.SERVER_DOWN = SERVER_DOWN
 fcad.ldap.sasl = ldapmock.sasl
 
 
 # DNS resolver mock
 class DNSResolverMock:
-    class DNSResolverResult:
-        target = "FC.AD/"
+    class DNSResolverRecord:
+        def __init__(self, target, priority=0, weight=100, port=389):
+            self.target = target
+            self.priority = priority
+            self.weight = weight
+            self.port = port
+
+    class DNSResolverResult(list):
+        class rrset:
+            ttl = 600
+
+    def __init__(self):
+        self.records = [self.DNSResolverRecord("FC.AD.")]
+        self.queries = 0
 
     def query(self, name, querytype):
-        return (self.DNSResolverResult,)
+        self.queries += 1
+        return self.DNSResolverResult(self.records)
 
 
 fcad.dns.resolver = DNSResolverMock()
@@ -274,12 +294,16 @@ class TestFCAD(unittest.TestCase):
         return data
 
     def setUp(self):
+        fcad.dns.resolver = DNSResolverMock()
+        fcad.ADConnector._srv_cache.clear()
+        fcad.ADConnector._dc_health.clear()
         self.ad = fcad.ADConnector(self.DOMAIN)
         self.ad.connect()
         # Reset domain data for each test
         fcad.ldap.DOMAIN_DATA = copy.deepcopy(self.BASE_DOMAIN_DATA)
         # Reset temporary directory for each new test
         smbmock.TEMP_DIR = tempfile.mkdtemp()
+        fcad.ADConnector._smb_connections.clear()
 
     def test_01_save_profile(self):
         cn = self.ad.save_profile(self.TEST_PROFILE)
@@ -295,16 +319,40 @@ class TestFCAD(unittest.TestCase):
         self.assertEqual(data["settings"], self.TEST_PROFILE["settings"])
 
     def test_02_get_profiles(self):
-        profiles = self.ad.get_profiles()
+        profiles = list(self.ad.get_profiles())
         self.assertEqual(profiles, [])
         # Add some profile
         cn = self.ad.save_profile(self.TEST_PROFILE)
-        profiles = self.ad.get_profiles()
+        profiles = list(self.ad.get_profiles())
         self.assertEqual(
             profiles,
             [(cn, self.TEST_PROFILE["name"], self.TEST_PROFILE["description"])],
         )
 
+    def test_02_get_profiles_paged(self):
+        self.ad.SEARCH_PAGE_SIZE = 2
+        cns = [self.ad.save_profile(self.TEST_PROFILE) for _i in range(5)]
+        # Global policy is not listed
+        self.ad.set_global_policy(22)
+
+        self.ad.connection.pages = 0
+        profiles = self.ad.get_profiles()
+        # Results are streamed
+        self.assertEqual(next(profiles)[0], cns[0])
+        self.assertEqual(self.ad.connection.pages, 1)
+        self.assertEqual([p[0] for p in profiles], cns[1:])
+        self.assertEqual(self.ad.connection.pages, 3)
+
+        # Connection lost while iterating is not retried
+        profiles = self.ad.get_profiles()
+        next(profiles)
+        with patch.object(self.ad.connection, "result3", side_effect=SERVER_DOWN):
+            with self.assertRaises(SERVER_DOWN):
+                list(profiles)
+        self.assertIsNone(self.ad.connection)
+        # Next call reconnects
+        self.assertEqual([p[0] for p in self.ad.get_profiles()], cns)
+
     def test_03_get_profile(self):
         cn = self.ad.save_profile(self.TEST_PROFILE)
         profile = self.ad.get_profile(cn)
@@ -342,6 +390,381 @@ class TestFCAD(unittest.TestCase):
         policy = self.ad.get_global_policy()
         self.assertEqual(policy, 22)
 
+    def test_08_connection_reuse(self):
+        cn = self.ad.save_profile(self.TEST_PROFILE)
+        self.ad.get_profile(cn)
+        self.ad.get_global_policy()
+        # Connection bound on setUp is used by every call
+        self.assertEqual(self.ad.stats["binds"], 1)
+        self.assertEqual(self.ad.stats["health_checks"], 0)
+
+        # Idle connections are checked before use
+        self.ad._last_used -= self.ad.HEALTH_CHECK_INTERVAL
+        self.ad.get_profile(cn)
+        self.assertEqual(self.ad.stats["binds"], 1)
+        self.assertEqual(self.ad.stats["health_checks"], 1)
+
+        # Dead connection found by health check is replaced
+        self.ad._last_used -= self.ad.HEALTH_CHECK_INTERVAL
+        with patch.object(self.ad.connection, "whoami_s", side_effect=SERVER_DOWN):
+            self.ad.get_profile(cn)
+        self.assertEqual(self.ad.stats["binds"], 2)
+
+        # Writes are not replayed, but next call gets a new connection
+        with patch.object(self.ad.connection, "modify_s", side_effect=SERVER_DOWN):
+            with self.assertRaises(SERVER_DOWN):
+                self.ad.save_profile(dict(self.TEST_PROFILE, cn=cn, name="Renamed"))
+        self.assertEqual(self.ad.stats["binds"], 3)
+        self.assertEqual(self.ad.stats["reconnects"], 2)
+        self.assertEqual(self.ad.get_profile(cn)["name"], self.TEST_PROFILE["name"])
+
+    def _count_searches(self, base, text):
+        return len(
+            [
+                c
+                for c in self.ad.connection.search_s.call_args_list
+                if c.args[0] == base and text in c.args[2]
+            ]
+        )
+
+    def test_09_batched_sid_resolution(self):
+        cn = self.ad.save_profile(self.TEST_PROFILE)
+        test_profile = self._get_test_profile(cn)
+        connection = self.ad.connection
+        self.ad._sid_cache.clear()
+
+        with patch.object(connection, "search_s", wraps=connection.search_s):
+            # All principals resolved in one search
+            self.assertEqual(self.ad.get_profile(cn), test_profile)
+            self.assertEqual(self._count_searches("DC=FC,DC=AD", "objectSid="), 1)
+            # Then cached
+            self.assertEqual(self.ad.get_profile(cn), test_profile)
+            self.assertEqual(self._count_searches("DC=FC,DC=AD", "objectSid="), 1)
+
+            # Names resolved with one search per object type
+            self.ad._name_cache.clear()
+            self.ad.save_profile(test_profile)
+            self.assertEqual(self._count_searches("CN=Users,DC=FC,DC=AD", "CN="), 1)
+            self.assertEqual(
+                self._count_searches("DC=FC,DC=AD", "(&(objectclass=group)"), 1
+            )
+            # Domain SID already known for this connection
+            self.assertEqual(self._count_searches("DC=FC,DC=AD", "(objectClass=*)"), 0)
+
+        # Resolutions expire
+        for key, (_expires, obj) in list(self.ad._sid_cache.items()):
+            self.ad._sid_cache[key] = (0, obj)
+        with patch.object(connection, "search_s", wraps=connection.search_s):
+            self.ad.get_profile(cn)
+            self.assertEqual(self._count_searches("DC=FC,DC=AD", "objectSid="), 1)
+
+    def test_10_load_profiles(self):
+        cns = [self.ad.save_profile(self.TEST_PROFILE) for _i in range(3)]
+        connection = self.ad.connection
+
+        with patch.object(connection, "search_s", wraps=connection.search_s):
+            profiles = self.ad.load_profiles(cns + ["{UNKNOWN}"])
+            self.assertEqual(
+                self._count_searches("CN=Policies,CN=System,DC=FC,DC=AD", "CN="), 1
+            )
+        self.assertEqual(profiles, {cn: self._get_test_profile(cn) for cn in cns})
+        # All SMB transfers used the same connection
+        self.assertEqual(self.ad.stats["smb_connects"], 1)
+
+    def test_11_gpo_data_upload(self):
+        cn = self.ad.save_profile(self.TEST_PROFILE)
+        gpodir = os.path.join(smbmock.TEMP_DIR, "%s/Policies" % self.DOMAIN, cn)
+        self.assertEqual(
+            sorted(os.listdir(gpodir)),
+            ["GPT.INI", "Machine", "User", "__acldata__.json", "fleet-commander.json"],
+        )
+        self.assertEqual(self.ad.stats["smb_writes"], 2)
+
+        # Unchanged files are not written again
+        profile = self._get_test_profile(cn)
+        self.ad.save_profile(profile)
+        self.assertEqual(self.ad.stats["smb_writes"], 2)
+
+        # Files changed remotely are written again
+        with open(os.path.join(gpodir, "fleet-commander.json"), "w") as fd:
+            fd.write("{}")
+        self.ad.save_profile(profile)
+        self.assertEqual(self.ad.stats["smb_writes"], 3)
+        self.assertEqual(self._get_cifs_data(cn)["priority"], profile["priority"])
+
+        # Errors other than missing files are raised
+        error = samba.NTSTATUSError(ntstatus.NT_STATUS_ACCESS_DENIED, "Access denied")
+        with patch.object(smbmock.SMBMock, "loadfile", side_effect=error):
+            with self.assertRaises(samba.NTSTATUSError):
+                self.ad.save_profile(profile)
+        self.assertEqual(self.ad.stats["smb_writes"], 3)
+
+        # Only changed settings file is written
+        profile["priority"] = 10
+        self.ad.save_profile(profile)
+        self.assertEqual(self.ad.stats["smb_writes"], 4)
+        self.assertEqual(self._get_cifs_data(cn)["priority"], 10)
+
+    def test_12_save_profile_changes_only(self):
+        cn = self.ad.save_profile(self.TEST_PROFILE)
+        profile = self._get_test_profile(cn)
+        connection = self.ad.connection
+        writes = self.ad.stats["smb_writes"]
+
+        # Settings only change
+        profile["settings"]["org.freedesktop.NetworkManager"] = [{"uuid": "1"}]
+        with patch.object(connection, "modify_s", wraps=connection.modify_s):
+            self.ad.save_profile(profile)
+            connection.modify_s.assert_not_called()
+        self.assertEqual(self.ad.stats["smb_writes"], writes + 1)
+        self.assertEqual(self.ad.get_profile(cn), profile)
+
+        # Description and applies change
+        profile["description"] = "Changed description"
+        profile["users"] = ["admin"]
+        with patch.object(connection, "modify_s", wraps=connection.modify_s):
+            self.ad.save_profile(profile)
+            connection.modify_s.assert_called_once()
+            ldif = connection.modify_s.call_args.args[1]
+        self.assertEqual(
+            [attr for _op, attr, _value in ldif],
+            ["nTSecurityDescriptor", "description"],
+        )
+        self.assertEqual(self.ad.stats["smb_writes"], writes + 1)
+        self.assertEqual(self.ad.get_profile(cn), profile)
+
+    def test_12_save_profile_security_changes(self):
+        cn = self.ad.save_profile(self.TEST_PROFILE)
+        profile = self._get_test_profile(cn)
+        connection = self.ad.connection
+        key = "CN=%s,CN=Policies,CN=System,DC=FC,DC=AD" % cn
+
+        def set_server_sd(sdh):
+            fcad.ldap.DOMAIN_DATA["profiles"][key]["nTSecurityDescriptor"] = (
+                ndr_pack(sdh.to_sd()),
+            )
+
+        def save():
+            with patch.object(
+                connection, "modify_s", wraps=connection.modify_s
+            ) as modify_s, patch.object(smbmock.SMBMock, "set_acl") as set_acl:
+                self.ad.save_profile(profile)
+            # Share permissions change along with the security descriptor
+            self.assertEqual(set_acl.called, modify_s.called)
+            if not modify_s.called:
+                return []
+            return [attr for _op, attr, _value in modify_s.call_args.args[1]]
+
+        sdh = fcad.SecurityDescriptorHelper(
+            self._get_domain_profile(cn)["nTSecurityDescriptor"][0], self.ad
+        )
+
+        # Inherited ACEs added by the server are not a change
+        sdh.add_dacl_ace("(A;CIID;RPLCLORC;;;AU)")
+        set_server_sd(sdh)
+        self.assertEqual(save(), [])
+
+        # Owner, group and DACL flags changes are written back
+        for attr, value in (
+            ("owner_sid", "S-1-5-21-1754900228-1619607556-2970117160-500"),
+            ("group_sid", "S-1-5-21-1754900228-1619607556-2970117160-500"),
+            ("dacl_flags", "AI"),
+        ):
+            changed = copy.copy(sdh)
+            setattr(changed, attr, value)
+            set_server_sd(changed)
+            self.assertEqual(save(), ["nTSecurityDescriptor"])
+            self.assertEqual(save(), [])
+
+    def test_13_server_failover(self):
+        record = fcad.dns.resolver.DNSResolverRecord
+        fcad.dns.resolver.records = [
+            record("dc3.fc.ad.", priority=10),
+            record("dc1.fc.ad."),
+            # Zero weight servers go last within their priority
+            record("dc2.fc.ad.", weight=0),
+        ]
+        fcad.dns.resolver.queries = 0
+        fcad.ADConnector._srv_cache.clear()
+        self.ad.disconnect()
+        self.ad._server_name = None
+        latencies = {"dc1.fc.ad": 0.05, "dc2.fc.ad": 0.01, "dc3.fc.ad": 0.001}
+
+        # Fastest reachable server with best priority is selected
+        with patch.object(
+            self.ad, "_probe_server", side_effect=lambda host, port: latencies[host]
+        ):
+            self.assertEqual(self.ad._get_server_name(), "dc2.fc.ad")
+            self.assertEqual(self.ad._get_server_name(), "dc2.fc.ad")
+        # SRV results are cached for their TTL
+        self.assertEqual(fcad.dns.resolver.queries, 1)
+        self.assertEqual(
+            [host for _p, _w, host, _port in fcad.ADConnector._srv_cache["FC.AD"][1]],
+            ["dc1.fc.ad", "dc2.fc.ad", "dc3.fc.ad"],
+        )
+
+        # Connection fails over to next server when selected one is down
+        bind = ldapmock.LDAPConnectionMock.sasl_interactive_bind_s
+
+        def bind_mock(conn, who, sasl_auth):
+            if conn.server_address == "ldap://dc2.fc.ad":
+                raise SERVER_DOWN
+            return bind(conn, who, sasl_auth)
+
+        with patch.object(
+            ldapmock.LDAPConnectionMock,
+            "sasl_interactive_bind_s",
+            autospec=True,
+            side_effect=bind_mock,
+        ), patch.object(
+            self.ad, "_probe_server", side_effect=lambda host, port: latencies[host]
+        ):
+            cn = self.ad.save_profile(self.TEST_PROFILE)
+        self.assertEqual(self.ad.connection.server_address, "ldap://dc1.fc.ad")
+        self.assertEqual(self.ad.get_profile(cn), self._get_test_profile(cn))
+        stats = self.ad.get_server_stats()
+        self.assertEqual(stats["dc2.fc.ad"]["failures"], 1)
+        self.assertEqual(stats["dc2.fc.ad"]["connects"], 0)
+        self.assertEqual(stats["dc1.fc.ad"]["connects"], 1)
+        self.assertEqual(stats["dc1.fc.ad"]["latency"], 0.05)
+
+        # Expired SRV results are resolved again
+        fcad.ADConnector._srv_cache["FC.AD"] = (0, [])
+        self.ad._server_expires = 0
+        with patch.object(
+            self.ad, "_probe_server", side_effect=lambda host, port: latencies[host]
+        ):
+            self.assertEqual(self.ad._get_server_name(), "dc1.fc.ad")
+        self.assertEqual(fcad.dns.resolver.queries, 2)
+
+    def test_14_check_applies(self):
+        connection = self.ad.connection
+        with patch.object(connection, "search_s", wraps=connection.search_s):
+            result = self.ad.check_applies(
+                {
+                    "users": ["admin", "fake"],
+                    "groups": ["admins"],
+                    "hosts": ["client1", "fakehost"],
+                    "hostgroups": ["ipaservers"],
+                }
+            )
+            # One search per object class
+            self.assertEqual(connection.search_s.call_count, 3)
+        self.assertEqual(
+            result,
+            {
+                "users": ({"admin"}, {"fake"}),
+                "groups": ({"admins"}, set()),
+                "hosts": ({"client1"}, {"fakehost"}),
+                "hostgroups": (set(), {"ipaservers"}),
+            },
+        )
+
+    def test_15_smb_connection_pool(self):
+        cn = self.ad.save_profile(self.TEST_PROFILE)
+        self.assertEqual(self.ad.stats["smb_connects"], 1)
+
+        # Expired sessions are opened again
+        loadfile = smbmock.SMBMock.loadfile
+        errors = [
+            samba.NTSTATUSError(
+                ntstatus.NT_STATUS_NETWORK_SESSION_EXPIRED, "Session expired"
+            )
+        ]
+
+        def loadfile_mock(conn, furi):
+            if errors:
+                raise errors.pop()
+            return loadfile(conn, furi)
+
+        with patch.object(
+            smbmock.SMBMock, "loadfile", autospec=True, side_effect=loadfile_mock
+        ):
+            self.assertEqual(
+                self.ad._load_smb_data(cn)["priority"], self.TEST_PROFILE["priority"]
+            )
+        self.assertEqual(self.ad.stats["smb_connects"], 2)
+
+        # Connections are replaced when they get too old
+        for key, (_expires, conn) in fcad.ADConnector._smb_connections.items():
+            fcad.ADConnector._smb_connections[key] = (0, conn)
+        self.ad._load_smb_data(cn)
+        self.assertEqual(self.ad.stats["smb_connects"], 3)
+        self.ad._load_smb_data(cn)
+        self.assertEqual(self.ad.stats["smb_connects"], 3)
+
+        # Connections to failed servers are dropped
+        server_name = self.ad._get_server_name()
+        self.ad._server_failed(server_name, "Server down")
+        self.assertNotIn(
+            server_name,
+            [host for host, _service in fcad.ADConnector._smb_connections],
+        )
+
+
+class TestSecurityDescriptorHelper(unittest.TestCase):
+    """SDDL parsing and DACL handling."""
+
+    BENCHMARK_ACES = 5000
+
+    def get_large_sddl(self):
+        aces = "".join(
+            fcad.GPO_DACL_ACE % ("S-1-5-21-1-2-3-%d" % i)
+            for i in range(self.BENCHMARK_ACES)
+        )
+        return "O:DAG:DAD:PAI%sS:AI(AU;SA;CR;;;WD)" % aces
+
+    def test_parse_sddl(self):
+        sddl = (
+            "O:DAG:DDD:PAI(A;CI;RPLC;;;DA)"
+            '(XA;;CR;;;WD;(@User.Title=="PM"))'
+            "(A;ID;RP;;;S-1-5-11)S:AI(AU;SA;CR;;;WD)"
+        )
+        sdh = fcad.SecurityDescriptorHelper(sddl, None)
+        self.assertEqual(sdh.owner_sid, "DA")
+        self.assertEqual(sdh.group_sid, "DD")
+        self.assertEqual(sdh.dacl_flags, "PAI")
+        self.assertEqual(len(sdh.dacls), 3)
+        self.assertEqual(sdh.dacls[1].resource_attribute, '(@User.Title=="PM")')
+        self.assertEqual(sdh.sacl_flags, "AI")
+        self.assertEqual(sdh.sacls, ["(AU;SA;CR;;;WD)"])
+        self.assertEqual(sdh.to_sddl(), sddl)
+        self.assertEqual(
+            sdh.get_explicit_dacl(),
+            {"(A;CI;RPLC;;;DA)", '(XA;;CR;;;WD;(@User.Title=="PM"))'},
+        )
+        with self.assertRaises(ValueError):
+            fcad.ACEHelper("(A;CI;RPLC)")
+
+    def test_ace_equality(self):
+        ace = fcad.ACEHelper("(A;CI;RPLC;;;DA)")
+        self.assertEqual(ace, fcad.ACEHelper("A;CI;RPLC;;;DA"))
+        self.assertEqual(hash(ace), hash(fcad.ACEHelper("A;CI;RPLC;;;DA")))
+        self.assertNotEqual(ace, fcad.ACEHelper("(A;CI;RPLC;;;DU)"))
+        self.assertEqual(len({ace, fcad.ACEHelper("(A;CI;RPLC;;;DA)")}), 1)
+
+    def test_large_sddl_benchmark(self):
+        sddl = self.get_large_sddl()
+
+        started = time.perf_counter()
+        sdh = fcad.SecurityDescriptorHelper(sddl, None)
+        parse_time = time.perf_counter() - started
+
+        started = time.perf_counter()
+        for ace in list(sdh.dacls):
+            sdh.add_dacl_ace(ace)
+            sdh.add_dacl_ace(str(ace))
+        dedup_time = time.perf_counter() - started
+
+        logger.info(
+            "SDDL with %s ACEs: parse %.4fs, dedup %.4fs",
+            self.BENCHMARK_ACES,
+            parse_time,
+            dedup_time,
+        )
+        self.assertEqual(len(sdh.dacls), self.BENCHMARK_ACES)
+        self.assertEqual(sdh.to_sddl(), sddl)
+
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.DEBUG)
@@ -27,6 +27,7 @@ from collections import namedtuple
 import os
 import sys
 import logging
+import uuid
 
 from gi.repository import Gio
 
@@ -59,7 +60,6 @@ fcdbus.libvirtcontroller.controller = controller
 class MockLibVirtController(libvirtcontroller.LibVirtTunnelSpice):
 
     TEMPLATE_UUID = "e2e3ad2a-7c2d-45d9-b7bc-fefb33925a81"
-    SESSION_UUID = "fefb45d9-5a81-3392-b7bc-e2e37c2d"
 
     DOMAINS_LIST = [
         {
@@ -70,8 +70,15 @@ class MockLibVirtController(libvirtcontroller.LibVirtTunnelSpice):
         }
     ]
 
+    # Domains of additional hypervisors by host
+    HOSTS_DOMAINS = {}
+
+    FREE_MEMORY = 8 * 1024 * 1024 * 1024
+
     def __init__(self, data_path, username, hostname, mode):
 
+        self.hostname = hostname
+
         self.data_dir = os.path.abspath(data_path)
         if not os.path.exists(self.data_dir):
             os.makedirs(self.data_dir)
@@ -89,19 +96,55 @@ class MockLibVirtController(libvirtcontroller.LibVirtTunnelSpice):
             ],
         )
 
+        self.stats = {
+            "spice_wait_time": 0.5,
+        }
+
+        self.pool_params = namedtuple(
+            "pool_params",
+            [
+                "domain",
+                "ticket",
+            ],
+        )
+
+    @property
+    def domains(self):
+        return self.HOSTS_DOMAINS.get(self.hostname, self.DOMAINS_LIST)
+
     def list_domains(self):
-        return self.DOMAINS_LIST
+        return self.domains
 
-    def session_start(self, identifier, debug_logger=False):
-        """Return abstract session cookie."""
-        self.DOMAINS_LIST.append(
+    def get_load(self):
+        return {
+            "free_memory": self.FREE_MEMORY,
+            "sessions": len([d for d in self.domains if d["temporary"]]),
+        }
+
+    def _add_temporary_domain(self):
+        session_uuid = str(uuid.uuid4())
+        self.domains.append(
             {
-                "uuid": self.SESSION_UUID,
-                "name": "fc-",
+                "uuid": session_uuid,
+                "name": self.get_session_name(session_uuid),
                 "active": True,
                 "temporary": True,
             }
         )
+        return session_uuid
+
+    def pool_domain_start(self, identifier, debug_logger=False):
+        return self.pool_params(
+            domain=self._add_temporary_domain(),
+            ticket="spice_ticket",
+        )
+
+    def session_start(self, identifier, debug_logger=False, pooled=None):
+        """Return abstract session cookie."""
+        if pooled is not None:
+            session_uuid = pooled.domain
+        else:
+            session_uuid = self._add_temporary_domain()
         details = {
             "host": "localhost",
             "viewer": "spice_html5",
@@ -109,14 +152,25 @@ class MockLibVirtController(libvirtcontroller.LibVirtTunnelSpice):
         }
 
         return self.session_params(
-            domain=self.SESSION_UUID,
+            domain=session_uuid,
             details=details,
         )
 
+    def tunnel_stats(self, identifier):
+        return None
+
+    def tunnel_forwards(self, identifier):
+        return None
+
     def session_stop(self, identifier):
-        for d in self.DOMAINS_LIST:
+        for d in list(self.domains):
             if d["uuid"] == identifier:
-                self.DOMAINS_LIST.remove(d)
+                self.domains.remove(d)
+
+    def sessions_stop(self, identifiers):
+        for identifier in identifiers:
+            self.session_stop(identifier)
+        return {}
 
 
 class TestFleetCommanderDbusService(fcdbus.FleetCommanderDbusService):
@@ -131,6 +185,7 @@ class TestFleetCommanderDbusService(fcdbus.FleetCommanderDbusService):
             "tmp_session_destroy_timeout": 60,
             "auto_quit_timeout": 60,
             "default_profile_priority": 50,
+            "compress_profiles": False,
             # Force state directory
             "state_dir": test_directory,
         }
@@ -151,6 +206,15 @@ class TestFleetCommanderDbusService(fcdbus.FleetCommanderDbusService):
 
         self.ssh.install_pubkey = self.ssh_install_pubkey_mock
 
+        MockLibVirtController.HOSTS_DOMAINS["otherhost"] = [
+            {
+                "uuid": MockLibVirtController.TEMPLATE_UUID,
+                "name": "fedora-unkno",
+                "active": False,
+                "temporary": False,
+            }
+        ]
+
     def ssh_install_pubkey_mock(self, pubkey, user, password, host, port):
         """
         Just mock ssh command execution
@@ -21,11 +21,14 @@
 #          Oliver Gutiérrez <ogutierrez@redhat.com>
 
 from __future__ import absolute_import
+import copy
 import json
 import logging
 import os
 import unittest
 
+from unittest.mock import Mock, patch
+
 from tests import freeipamock
 from fleetcommander import fcfreeipa
 
@@ -156,6 +159,11 @@ class TestFreeIPA(unittest.TestCase):
     }
 
     def setUp(self):
+        # Reset process wide connection state
+        freeipamock.FreeIPARPCClient.connected = False
+        fcfreeipa.FreeIPAConnector._state.update(last_used=None, sanity_checked=False)
+        for key in fcfreeipa.FreeIPAConnector.stats:
+            fcfreeipa.FreeIPAConnector.stats[key] = 0
         self.ipa = fcfreeipa.FreeIPAConnector()
         freeipamock.FreeIPACommand.data = freeipamock.FreeIPAData()
         self.ipa.connect()
@@ -314,6 +322,194 @@ class TestFreeIPA(unittest.TestCase):
         profiledata = profilerules[self.TEST_PROFILE["name"]]
         self.assertEqual(profiledata["hostcategory"], "all")
 
+    def test_15_connection_reuse(self):
+        command = freeipamock.FreeIPAMock.Command
+        stats = self.ipa.stats
+        # Connection opened on setUp is used by every call without pinging
+        with patch.object(
+            self.ipa, "_do_sanity_check", wraps=self.ipa._do_sanity_check
+        ) as sanity_check:
+            self.ipa.get_global_policy()
+            self.assertTrue(self.ipa.check_user_exists("admin"))
+            # State is shared by all connectors in the process
+            fcfreeipa.FreeIPAConnector().get_global_policy()
+            sanity_check.assert_not_called()
+        self.assertEqual(stats, {"connects": 1, "reconnects": 0, "pings": 1})
+
+        # Idle connection is checked before use
+        self.ipa._state["last_used"] -= self.ipa.HEALTH_CHECK_INTERVAL
+        self.ipa.get_global_policy()
+        self.assertEqual(stats, {"connects": 1, "reconnects": 0, "pings": 2})
+
+        # Stale connection found by ping is replaced
+        self.ipa._state["last_used"] -= self.ipa.HEALTH_CHECK_INTERVAL
+        with patch.object(
+            command,
+            "ping",
+            side_effect=[freeipamock.FreeIPAErrors.SessionError(), None],
+        ):
+            self.ipa.get_global_policy()
+        self.assertEqual(stats, {"connects": 2, "reconnects": 1, "pings": 4})
+
+        # Writes are not replayed, but next call gets a new connection
+        with patch.object(
+            command,
+            "deskprofile_add",
+            side_effect=freeipamock.FreeIPAErrors.NetworkError(),
+        ) as deskprofile_add:
+            with self.assertRaises(freeipamock.FreeIPAErrors.NetworkError):
+                self.ipa.save_profile(self.TEST_PROFILE)
+            deskprofile_add.assert_called_once()
+        self.assertEqual(stats["reconnects"], 2)
+        self.assertFalse(self.ipa.check_profile_exists(self.TEST_PROFILE["name"]))
+
+    def _count_rpcs(self, func, *args):
+        """
+        Run function returning names of the IPA commands it sent
+        """
+        command = Mock(wraps=freeipamock.FreeIPAMock.Command)
+        with patch.object(fcfreeipa.api, "Command", command):
+            func(*args)
+        return [name for name, _args, _kwargs in command.mock_calls]
+
+    def test_16_update_profile_rules_batched(self):
+        name = self.TEST_PROFILE["name"]
+        self.ipa.save_profile(self.TEST_PROFILE)
+        profilerules = freeipamock.FreeIPACommand.data.profilerules
+
+        # Rule is updated and read in one call, and member changes in another
+        command = Mock(wraps=freeipamock.FreeIPAMock.Command)
+        with patch.object(fcfreeipa.api, "Command", command):
+            self.ipa._update_profile_rules(self.TEST_PROFILE_MOD)
+        self.assertEqual([c[0] for c in command.mock_calls], ["batch", "batch"])
+        # Only changed members are sent
+        self.assertEqual(
+            [m["method"] for m in command.batch.call_args.args],
+            ["deskprofilerule_remove_user"],
+        )
+        self.assertEqual(profilerules[name], self.SAVED_PROFILERULE_DATA_MOD)
+
+        # Nothing else is sent when members did not change
+        self.assertEqual(
+            self._count_rpcs(self.ipa._update_profile_rules, self.TEST_PROFILE_MOD),
+            ["batch"],
+        )
+        self.assertEqual(
+            self._count_rpcs(self.ipa.save_profile, self.TEST_PROFILE_MOD),
+            ["deskprofile_show", "deskprofile_mod", "batch"],
+        )
+
+        # Hostcategory is set when no host could be added
+        wrong_hosts_profile = self.TEST_PROFILE.copy()
+        wrong_hosts_profile["hosts"] = ["nonexisting"]
+        wrong_hosts_profile["hostgroups"] = []
+        self.assertEqual(
+            self._count_rpcs(self.ipa._update_profile_rules, wrong_hosts_profile),
+            ["batch", "batch", "deskprofilerule_mod"],
+        )
+        self.assertEqual(profilerules[name]["hostcategory"], "all")
+
+    def test_17_get_profile_batched(self):
+        name = self.TEST_PROFILE["name"]
+        self.ipa.save_profile(self.TEST_PROFILE)
+        # Profile and rule are read in one call
+        self.assertEqual(self._count_rpcs(self.ipa.get_profile, name), ["batch"])
+
+    def test_18_get_missing_profile(self):
+        name = self.TEST_PROFILE["name"]
+        self.ipa.save_profile(self.TEST_PROFILE)
+        self.ipa.del_profile(name)
+        with self.assertRaises(fcfreeipa.IPACommandError):
+            self.ipa.get_profile(name)
+
+    def test_19_check_applies(self):
+        applies = {
+            "users": ["admin", "guest", "fake"],
+            "groups": ["admins", "fakegroup"],
+            "hosts": ["client1", "fakehost"],
+            "hostgroups": ["ipaservers"],
+        }
+        command = Mock(wraps=freeipamock.FreeIPAMock.Command)
+        with patch.object(fcfreeipa.api, "Command", command):
+            result = self.ipa.check_applies(applies)
+        # All names are checked in a single call
+        self.assertEqual([c[0] for c in command.mock_calls], ["batch"])
+        self.assertEqual(
+            result,
+            {
+                "users": ({"admin", "guest"}, {"fake"}),
+                "groups": ({"admins"}, {"fakegroup"}),
+                "hosts": ({"client1"}, {"fakehost"}),
+                "hostgroups": ({"ipaservers"}, set()),
+            },
+        )
+
+        # Each object type check is a single call
+        self.assertEqual(
+            self._count_rpcs(self.ipa.check_users_exist, ["admin", "fake"]), ["batch"]
+        )
+        self.assertEqual(
+            self.ipa.check_users_exist(["admin", "fake"]), ({"admin"}, {"fake"})
+        )
+        self.assertEqual(
+            self.ipa.check_hostgroups_exist(["ipaservers", "fake"]),
+            ({"ipaservers"}, {"fake"}),
+        )
+        # Nothing is sent when there are no names
+        self.assertEqual(self._count_rpcs(self.ipa.check_groups_exist, []), [])
+
+    def get_big_profile(self):
+        profile = copy.deepcopy(self.TEST_PROFILE)
+        profile["settings"]["org.chromium.Policies"] = [
+            {
+                "key": "ManagedBookmarks",
+                "value": [
+                    {"name": "Bookmark %s" % i, "url": "https://intranet/%s" % i}
+                    for i in range(2000)
+                ],
+            }
+        ]
+        profile["settings"]["org.freedesktop.NetworkManager"] = [
+            {
+                "uuid": "00000000-0000-0000-0000-%012d" % i,
+                "type": "vpn",
+                "id": "VPN %s" % i,
+                "data": {"connection": {"id": "VPN %s" % i, "type": "vpn"}},
+            }
+            for i in range(200)
+        ]
+        return profile
+
+    def test_20_compressed_profile(self):
+        name = self.TEST_PROFILE["name"]
+        profiles = freeipamock.FreeIPACommand.data.profiles
+        ipa = fcfreeipa.FreeIPAConnector(compress_profiles=True)
+
+        # Small profiles are stored as plain JSON
+        ipa.save_profile(self.TEST_PROFILE)
+        self.assertEqual(profiles[name], self.SAVED_PROFILE_DATA)
+
+        # Big profiles are compressed
+        profile = self.get_big_profile()
+        ipa.save_profile(profile)
+        stored = profiles[name]["ipadeskdata"][0]
+        plain = json.dumps(profile["settings"]).encode()
+        logger.info(
+            "Profile settings of %s bytes stored in %s bytes",
+            len(plain),
+            len(stored),
+        )
+        self.assertTrue(stored.startswith(ipa.COMPRESS_MAGIC))
+        self.assertLess(len(stored), len(plain) / 4)
+        self.assertEqual(ipa.get_profile(name), profile)
+
+        # Compressed profiles are read when compression is disabled
+        self.assertEqual(self.ipa.get_profile(name), profile)
+        # But only plain JSON is written
+        self.ipa.save_profile(profile)
+        self.assertEqual(profiles[name]["ipadeskdata"][0], plain.decode())
+        self.assertEqual(ipa.get_profile(name), profile)
+
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.DEBUG)
@@ -24,6 +24,8 @@ from __future__ import absolute_import
 from unittest.mock import patch
 import os
 import tempfile
+import time
+import uuid
 import shutil
 import unittest
 import logging
@@ -33,7 +35,7 @@ from tests import libvirtmock
 from fleetcommander import libvirtcontroller
 from fleetcommander.libvirtcontroller import LibVirtControllerException
 from tests import (
-    SSH_TUNNEL_OPEN_PARMS,
+    SSH_TUNNEL_SUPERVISED_PARMS,
     SSH_TUNNEL_CLOSE_PARMS,
     SSH_REMOTE_COMMAND_PARMS,
 )
@@ -158,14 +160,21 @@ class TestLibVirtController:
         # Set to not use QXL by default in tests
         os.environ["FC_TEST_USE_QXL"] = "0"
 
+        # Keep local tunnel sockets in test directory
+        os.environ["XDG_RUNTIME_DIR"] = self.test_directory
+
     def tearDown(self):
+        libvirtcontroller.LibVirtController.get_tunnel_manager().close_all()
         # Remove test directory
         shutil.rmtree(self.test_directory)
 
     def get_controller(self, config):
         ctrlr = libvirtcontroller.controller(**config)
+        ctrlr.ssh.SESSION_CONTROL_SOCKET = os.path.join(
+            self.test_directory, "{}-control-ssh-tunnel.socket"
+        )
         # Set controller delays to 0  for faster testing
-        ctrlr.SESSION_START_TRIES_DELAY = 0
+        ctrlr.SPICE_READY_POLL_INTERVAL = 0
         ctrlr.DOMAIN_UNDEFINE_TRIES_DELAY = 0
         ctrlr.known_hosts_file = self.known_hosts_file
         return ctrlr
@@ -248,7 +257,9 @@ class TestLibVirtController:
             command,
             SSH_TUNNEL_CLOSE_PARMS.format(
                 username=self.config["username"],
-                user_home=os.path.expanduser("~"),
+                control_socket=ctrlr.ssh.get_control_socket(
+                    ctrlr.get_session_name(session_params.domain)
+                ),
                 hostname=self.config["hostname"],
                 port=ctrlr.ssh_port,
                 private_key_file=self.private_key_file,
@@ -261,6 +272,172 @@ class TestLibVirtController:
             ),
         )
 
+    def test_session_restore_tunnel(self):
+        ctrlr = self.get_controller(self.config)
+        session_params = ctrlr.session_start(libvirtmock.UUID_ORIGIN)
+        forwards = ctrlr.tunnel_forwards(session_params.domain)
+        self.assertEqual(len(forwards), 1)
+
+        # A new service instance knows nothing about running tunnels
+        libvirtcontroller.LibVirtController.close_tunnels()
+        self.assertIsNone(ctrlr.tunnel_stats(session_params.domain))
+
+        ctrlr.session_restore_tunnel(session_params.domain, forwards)
+        stats = ctrlr.tunnel_stats(session_params.domain)
+        self.assertTrue(stats["alive"])
+        self.assertEqual(ctrlr.tunnel_forwards(session_params.domain), forwards)
+
+    def test_sessions_stop(self):
+        ctrlr = self.get_controller(self.config)
+        domains = [
+            ctrlr.session_start(libvirtmock.UUID_ORIGIN).domain for _ in range(3)
+        ]
+        unknown = str(uuid.uuid4())
+
+        errors = ctrlr.sessions_stop(domains + [unknown])
+
+        # Only unknown domain failed to be destroyed
+        self.assertEqual(list(errors), [unknown])
+
+    def test_get_load(self):
+        ctrlr = self.get_controller(self.config)
+        sessions = ctrlr.get_load()["sessions"]
+
+        ctrlr.session_start(libvirtmock.UUID_ORIGIN)
+        ctrlr.session_start(libvirtmock.UUID_ORIGIN)
+
+        load = ctrlr.get_load()
+        self.assertEqual(load["sessions"], sessions + 2)
+        self.assertEqual(load["free_memory"], 8 * 1024 * 1024 * 1024)
+
+    def test_pool_domain_start(self):
+        ctrlr = self.get_controller(self.config)
+        ticket = "Secret123"
+
+        with patch.object(
+            libvirtcontroller.LibVirtController,
+            "generate_spice_ticket",
+            return_value=ticket,
+        ):
+            pooled = ctrlr.pool_domain_start(libvirtmock.UUID_ORIGIN)
+
+        self.assertEqual(pooled.ticket, ticket)
+        domain = ctrlr.conn.lookupByUUIDString(pooled.domain)
+        self.assertTrue(domain.active)
+        self.assertTrue(domain.name().startswith("fc-"))
+
+        # No tunnel is opened for pooled domains
+        with open(self.ssh_parms_file, encoding="utf-8") as fd:
+            command = fd.read().strip()
+        self.assertNotIn("ControlMaster=yes", command)
+
+    def test_session_start_pooled(self):
+        ctrlr = self.get_controller(self.config)
+        pooled = ctrlr.pool_domain_start(libvirtmock.UUID_ORIGIN)
+        domains_count = len(ctrlr.conn.domains)
+
+        session_params = ctrlr.session_start(libvirtmock.UUID_ORIGIN, pooled=pooled)
+
+        # Pooled domain is used and no new domain is created
+        self.assertEqual(session_params.domain, pooled.domain)
+        self.assertEqual(session_params.details["ticket"], pooled.ticket)
+        self.assertEqual(len(ctrlr.conn.domains), domains_count)
+        self.assertTrue(os.path.exists(self.ssh_parms_file))
+
+    def test_session_start_pooled_wrong_ticket(self):
+        ctrlr = self.get_controller(self.config)
+        pooled = ctrlr.pool_domain_start(libvirtmock.UUID_ORIGIN)
+
+        with self.assertRaisesRegex(
+            LibVirtControllerException, "Error processing spice ticket"
+        ):
+            ctrlr.session_start(
+                libvirtmock.UUID_ORIGIN,
+                pooled=ctrlr.pool_params(domain=pooled.domain, ticket="other"),
+            )
+
+    def test_list_domains_rpc_count(self):
+        ctrlr = self.get_controller(self.config)
+        ctrlr._connect()
+        libvirtcontroller.LibVirtController._title_cache.clear()
+
+        # First listing fetches titles once per domain
+        libvirtmock.RPC_CALLS.clear()
+        domains = ctrlr.list_domains()
+        self.assertListEqual(domains, EXPECTED_DOMAIN_LIST)
+        self.assertEqual(
+            libvirtmock.RPC_CALLS,
+            {"listAllDomains": 2, "metadata": len(EXPECTED_DOMAIN_LIST)},
+        )
+
+        # Next listings do not depend on the number of domains
+        libvirtmock.RPC_CALLS.clear()
+        domains = ctrlr.list_domains()
+        self.assertListEqual(domains, EXPECTED_DOMAIN_LIST)
+        self.assertEqual(libvirtmock.RPC_CALLS, {"listAllDomains": 2})
+
+    def test_title_cache_pruning(self):
+        ctrlr = self.get_controller(self.config)
+        ctrlr._connect()
+        cache = libvirtcontroller.LibVirtController._title_cache
+        cache.clear()
+        domains = ctrlr.conn.listAllDomains(0)
+
+        # Cache size is bounded
+        ctrlr.TITLE_CACHE_SIZE = 2
+        ctrlr._get_domain_titles(domains)
+        self.assertEqual(
+            list(cache), [("localhost", d.UUIDString()) for d in domains[-2:]]
+        )
+
+        # Expired entries are evicted
+        ctrlr.TITLE_CACHE_SIZE = 1024
+        ctrlr.TITLE_CACHE_TTL = 0
+        ctrlr._get_domain_titles(domains[:1])
+        self.assertEqual(len(cache), 0)
+
+    def test_spice_parms_wait(self):
+        ctrlr = self.get_controller(self.config)
+        ctrlr._connect()
+        domain = ctrlr.conn.lookupByUUIDString(libvirtmock.UUID_TEMPORARY_SPICE_HTML5)
+        xmldata = domain.XMLDesc()
+        unallocated = xmldata.replace('port="5900"', 'port="-1"')
+
+        # SPICE port is not allocated at first checks
+        with patch.object(
+            domain, "XMLDesc", side_effect=[unallocated, unallocated, xmldata]
+        ) as xmldesc:
+            spice_params = ctrlr._get_spice_parms(domain)
+
+        self.assertEqual(spice_params.port, "5900")
+        self.assertEqual(xmldesc.call_count, 3)
+        self.assertIsNotNone(ctrlr.stats["spice_wait_time"])
+        # No domain event is registered to wait for the port
+        self.assertFalse(getattr(ctrlr.conn, "event_callbacks", {}))
+
+    def test_spice_parms_timeout(self):
+        ctrlr = self.get_controller(self.config)
+        ctrlr.SPICE_READY_TIMEOUT = 0
+        ctrlr._connect()
+        domain = ctrlr.conn.lookupByUUIDString(libvirtmock.UUID_TEMPORARY_SPICE_HTML5)
+        unallocated = domain.XMLDesc().replace('port="5900"', 'port="-1"')
+
+        with patch.object(domain, "XMLDesc", return_value=unallocated):
+            with self.assertRaisesRegex(
+                LibVirtControllerException, "Timed out waiting for SPICE port"
+            ):
+                ctrlr._get_spice_parms(domain)
+
+    def test_spice_parms_no_spice(self):
+        ctrlr = self.get_controller(self.config)
+        ctrlr._connect()
+        domain = ctrlr.conn.lookupByUUIDString(libvirtmock.UUID_NO_SPICE)
+
+        with self.assertRaisesRegex(
+            LibVirtControllerException, "Can not obtain SPICE URI"
+        ):
+            ctrlr._get_spice_parms(domain)
+
     def test_remote_user_runtimedir(self):
         ctrlr = self.get_controller(self.config)
 
@@ -362,7 +539,6 @@ class TestLibVirtControllerHTML5(TestLibVirtController):
         ctrlr = self.get_controller(self.config)
 
         local_runtimedir = os.environ.setdefault("XDG_RUNTIME_DIR", "/run/user/1000")
-        local_socket = os.path.join(local_runtimedir, "fc-notifier.socket")
         ticket = "Secret123"
 
         # spice ticket is generated the only time
@@ -374,6 +550,9 @@ class TestLibVirtControllerHTML5(TestLibVirtController):
             session_params = ctrlr.session_start(libvirtmock.UUID_ORIGIN)
 
         self.assertEqual(session_params.domain, ctrlr._last_started_domain.UUIDString())
+
+        session_name = ctrlr._last_started_domain.name()
+        local_socket = os.path.join(local_runtimedir, f"{session_name}-notifier.socket")
         self.assertDictEqual(
             session_params.details,
             {
@@ -403,10 +582,10 @@ class TestLibVirtControllerHTML5(TestLibVirtController):
 
         self.assertEqual(
             command,
-            SSH_TUNNEL_OPEN_PARMS.format(
+            SSH_TUNNEL_SUPERVISED_PARMS.format(
                 local_forward=f"{local_socket}:localhost:5900",
                 username=self.config["username"],
-                user_home=os.path.expanduser("~"),
+                control_socket=ctrlr.ssh.get_control_socket(session_name),
                 hostname=self.config["hostname"],
                 port=ctrlr.ssh_port,
                 private_key_file=self.private_key_file,
@@ -416,6 +595,10 @@ class TestLibVirtControllerHTML5(TestLibVirtController):
                         "StreamLocalBindUnlink=yes",
                         "-o",
                         f"UserKnownHostsFile={self.known_hosts_file}",
+                        "-o",
+                        "ServerAliveInterval=15",
+                        "-o",
+                        "ServerAliveCountMax=3",
                     ]
                 ),
             ),
@@ -425,8 +608,6 @@ class TestLibVirtControllerHTML5(TestLibVirtController):
         ctrlr = self.get_controller(self.config)
 
         local_runtimedir = os.environ.setdefault("XDG_RUNTIME_DIR", "/run/user/1000")
-        local_socket = os.path.join(local_runtimedir, "fc-notifier.socket")
-        logger_socket = os.path.join(local_runtimedir, "fc-logger.socket")
         remote_runtimedir = "/run/user/1001"
         ticket = "Secret123"
 
@@ -441,6 +622,10 @@ class TestLibVirtControllerHTML5(TestLibVirtController):
             )
 
         self.assertEqual(session_params.domain, ctrlr._last_started_domain.UUIDString())
+
+        session_name = ctrlr._last_started_domain.name()
+        local_socket = os.path.join(local_runtimedir, f"{session_name}-notifier.socket")
+        logger_socket = os.path.join(local_runtimedir, f"{session_name}-logger.socket")
         self.assertDictEqual(
             session_params.details,
             {
@@ -476,13 +661,13 @@ class TestLibVirtControllerHTML5(TestLibVirtController):
         )
         self.assertEqual(
             command,
-            SSH_TUNNEL_OPEN_PARMS.format(
+            SSH_TUNNEL_SUPERVISED_PARMS.format(
                 local_forward=(
                     f"{local_socket}:localhost:5900"
                     f" -L {logger_socket}:{remote_socket_logger}"
                 ),
                 username=self.config["username"],
-                user_home=os.path.expanduser("~"),
+                control_socket=ctrlr.ssh.get_control_socket(session_name),
                 hostname=self.config["hostname"],
                 port=ctrlr.ssh_port,
                 private_key_file=self.private_key_file,
@@ -492,6 +677,10 @@ class TestLibVirtControllerHTML5(TestLibVirtController):
                         "StreamLocalBindUnlink=yes",
                         "-o",
                         f"UserKnownHostsFile={self.known_hosts_file}",
+                        "-o",
+                        "ServerAliveInterval=15",
+                        "-o",
+                        "ServerAliveCountMax=3",
                     ]
                 ),
             ),
@@ -506,7 +695,6 @@ class TestLibVirtControllerDirectTLS(TestLibVirtController):
 
         ticket = "Secret123"
         local_runtimedir = os.environ.setdefault("XDG_RUNTIME_DIR", "/run/user/1000")
-        local_socket = os.path.join(local_runtimedir, "fc-notifier.socket")
         remote_runtimedir = "/run/user/1001"
 
         # spice ticket is generated the only time
@@ -519,6 +707,9 @@ class TestLibVirtControllerDirectTLS(TestLibVirtController):
 
         self.assertEqual(session_params.domain, ctrlr._last_started_domain.UUIDString())
 
+        session_name = ctrlr._last_started_domain.name()
+        local_socket = os.path.join(local_runtimedir, f"{session_name}-notifier.socket")
+
         self.assertDictEqual(
             session_params.details,
             {
@@ -556,10 +747,10 @@ class TestLibVirtControllerDirectTLS(TestLibVirtController):
 
         self.assertEqual(
             command,
-            SSH_TUNNEL_OPEN_PARMS.format(
+            SSH_TUNNEL_SUPERVISED_PARMS.format(
                 local_forward=f"{local_socket}:{remote_socket}",
                 username=self.config["username"],
-                user_home=os.path.expanduser("~"),
+                control_socket=ctrlr.ssh.get_control_socket(session_name),
                 hostname=self.config["hostname"],
                 port=ctrlr.ssh_port,
                 private_key_file=self.private_key_file,
@@ -569,6 +760,10 @@ class TestLibVirtControllerDirectTLS(TestLibVirtController):
                         "StreamLocalBindUnlink=yes",
                         "-o",
                         f"UserKnownHostsFile={self.known_hosts_file}",
+                        "-o",
+                        "ServerAliveInterval=15",
+                        "-o",
+                        "ServerAliveCountMax=3",
                     ]
                 ),
             ),
@@ -579,9 +774,7 @@ class TestLibVirtControllerDirectTLS(TestLibVirtController):
 
         ticket = "Secret123"
         local_runtimedir = os.environ.setdefault("XDG_RUNTIME_DIR", "/run/user/1000")
-        local_socket = os.path.join(local_runtimedir, "fc-notifier.socket")
         remote_runtimedir = "/run/user/1001"
-        logger_socket = os.path.join(local_runtimedir, "fc-logger.socket")
 
         # spice ticket is generated the only time
         with patch.object(
@@ -595,6 +788,10 @@ class TestLibVirtControllerDirectTLS(TestLibVirtController):
 
         self.assertEqual(session_params.domain, ctrlr._last_started_domain.UUIDString())
 
+        session_name = ctrlr._last_started_domain.name()
+        local_socket = os.path.join(local_runtimedir, f"{session_name}-notifier.socket")
+        logger_socket = os.path.join(local_runtimedir, f"{session_name}-logger.socket")
+
         self.assertDictEqual(
             session_params.details,
             {
@@ -638,13 +835,13 @@ class TestLibVirtControllerDirectTLS(TestLibVirtController):
 
         self.assertEqual(
             command,
-            SSH_TUNNEL_OPEN_PARMS.format(
+            SSH_TUNNEL_SUPERVISED_PARMS.format(
                 local_forward=(
                     f"{local_socket}:{remote_socket}"
                     f" -L {logger_socket}:{remote_socket_logger}"
                 ),
                 username=self.config["username"],
-                user_home=os.path.expanduser("~"),
+                control_socket=ctrlr.ssh.get_control_socket(session_name),
                 hostname=self.config["hostname"],
                 port=ctrlr.ssh_port,
                 private_key_file=self.private_key_file,
@@ -654,6 +851,10 @@ class TestLibVirtControllerDirectTLS(TestLibVirtController):
                         "StreamLocalBindUnlink=yes",
                         "-o",
                         f"UserKnownHostsFile={self.known_hosts_file}",
+                        "-o",
+                        "ServerAliveInterval=15",
+                        "-o",
+                        "ServerAliveCountMax=3",
                     ]
                 ),
             ),
@@ -724,7 +925,6 @@ class TestLibVirtControllerDirectPlain(TestLibVirtController):
 
         ticket = "Secret123"
         local_runtimedir = os.environ.setdefault("XDG_RUNTIME_DIR", "/run/user/1000")
-        local_socket = os.path.join(local_runtimedir, "fc-notifier.socket")
         remote_runtimedir = "/run/user/1001"
 
         # spice ticket is generated the only time
@@ -737,6 +937,9 @@ class TestLibVirtControllerDirectPlain(TestLibVirtController):
 
         self.assertEqual(session_params.domain, ctrlr._last_started_domain.UUIDString())
 
+        session_name = ctrlr._last_started_domain.name()
+        local_socket = os.path.join(local_runtimedir, f"{session_name}-notifier.socket")
+
         self.assertDictEqual(
             session_params.details,
             {
@@ -772,10 +975,10 @@ class TestLibVirtControllerDirectPlain(TestLibVirtController):
 
         self.assertEqual(
             command,
-            SSH_TUNNEL_OPEN_PARMS.format(
+            SSH_TUNNEL_SUPERVISED_PARMS.format(
                 local_forward=f"{local_socket}:{remote_socket}",
                 username=self.config["username"],
-                user_home=os.path.expanduser("~"),
+                control_socket=ctrlr.ssh.get_control_socket(session_name),
                 hostname=self.config["hostname"],
                 port=ctrlr.ssh_port,
                 private_key_file=self.private_key_file,
@@ -785,6 +988,10 @@ class TestLibVirtControllerDirectPlain(TestLibVirtController):
                         "StreamLocalBindUnlink=yes",
                         "-o",
                         f"UserKnownHostsFile={self.known_hosts_file}",
+                        "-o",
+                        "ServerAliveInterval=15",
+                        "-o",
+                        "ServerAliveCountMax=3",
                     ]
                 ),
             ),
@@ -795,9 +1002,7 @@ class TestLibVirtControllerDirectPlain(TestLibVirtController):
 
         ticket = "Secret123"
         local_runtimedir = os.environ.setdefault("XDG_RUNTIME_DIR", "/run/user/1000")
-        local_socket = os.path.join(local_runtimedir, "fc-notifier.socket")
         remote_runtimedir = "/run/user/1001"
-        logger_socket = os.path.join(local_runtimedir, "fc-logger.socket")
 
         # spice ticket is generated the only time
         with patch.object(
@@ -811,6 +1016,10 @@ class TestLibVirtControllerDirectPlain(TestLibVirtController):
 
         self.assertEqual(session_params.domain, ctrlr._last_started_domain.UUIDString())
 
+        session_name = ctrlr._last_started_domain.name()
+        local_socket = os.path.join(local_runtimedir, f"{session_name}-notifier.socket")
+        logger_socket = os.path.join(local_runtimedir, f"{session_name}-logger.socket")
+
         self.assertDictEqual(
             session_params.details,
             {
@@ -852,13 +1061,13 @@ class TestLibVirtControllerDirectPlain(TestLibVirtController):
 
         self.assertEqual(
             command,
-            SSH_TUNNEL_OPEN_PARMS.format(
+            SSH_TUNNEL_SUPERVISED_PARMS.format(
                 local_forward=(
                     f"{local_socket}:{remote_socket}"
                     f" -L {logger_socket}:{remote_socket_logger}"
                 ),
                 username=self.config["username"],
-                user_home=os.path.expanduser("~"),
+                control_socket=ctrlr.ssh.get_control_socket(session_name),
                 hostname=self.config["hostname"],
                 port=ctrlr.ssh_port,
                 private_key_file=self.private_key_file,
@@ -868,6 +1077,10 @@ class TestLibVirtControllerDirectPlain(TestLibVirtController):
                         "StreamLocalBindUnlink=yes",
                         "-o",
                         f"UserKnownHostsFile={self.known_hosts_file}",
+                        "-o",
+                        "ServerAliveInterval=15",
+                        "-o",
+                        "ServerAliveCountMax=3",
                     ]
                 ),
             ),
@@ -910,6 +1123,243 @@ class TestLibVirtControllerSessionDirectPlain(
     """Test LibVirtController with spice_plain_remote_viewer viewer at session mode."""
 
 
+class TestLibVirtControllerTemplateCache(unittest.TestCase):
+    """Prepared template domain XML cache."""
+
+    BENCHMARK_DEVICES = 2000
+    BENCHMARK_ROUNDS = 20
+
+    def setUp(self):
+        self.test_directory = tempfile.mkdtemp(prefix="fc-libvirt-test-cache-")
+        os.environ["FC_TEST_DIRECTORY"] = self.test_directory
+        self.ctrlr = libvirtcontroller.controller(
+            viewer_type="spice_html5",
+            data_path=self.test_directory,
+            username="testuser",
+            hostname="localhost",
+            mode="system",
+        )
+        libvirtcontroller.LibVirtController._template_cache.clear()
+
+    def tearDown(self):
+        libvirtcontroller.LibVirtController._template_cache.clear()
+        shutil.rmtree(self.test_directory)
+
+    def generate(self, xmldata, identifier=None):
+        with patch.object(
+            libvirtcontroller.uuid, "uuid4", return_value=uuid.UUID(int=1)
+        ):
+            return self.ctrlr._generate_new_domain_xml(
+                xmldata,
+                spice_ticket="Secret123",
+                enable_logger=False,
+                identifier=identifier,
+            )
+
+    def get_large_domain_xml(self):
+        device = (
+            "<interface type='bridge'><mac address='52:54:00:fc:b6:d1'/>"
+            "<source bridge='virbr0'/><model type='virtio'/></interface>"
+            "<disk type='file' device='disk'><driver name='qemu' type='qcow2'/>"
+            "<source file='/var/lib/libvirt/images/disk.qcow2'/>"
+            "<target dev='vdb' bus='virtio'/></disk>"
+        )
+        return libvirtmock.XML_ORIG.replace(
+            "</devices>", device * self.BENCHMARK_DEVICES + "</devices>"
+        )
+
+    def test_template_cache(self):
+        xmldata = libvirtmock.XML_ORIG
+        with patch.object(
+            self.ctrlr,
+            "_prepare_template_xml",
+            wraps=self.ctrlr._prepare_template_xml,
+        ) as prepare:
+            uncached = self.generate(xmldata)
+            first = self.generate(xmldata, libvirtmock.UUID_ORIGIN)
+            second = self.generate(xmldata, libvirtmock.UUID_ORIGIN)
+            self.assertEqual(prepare.call_count, 2)
+
+            # Cached template generates same XML
+            self.assertEqual(first, uncached)
+            self.assertEqual(second, uncached)
+
+            # Template is prepared again when domain XML changes
+            changed = xmldata.replace("2097152", "4194304")
+            self.generate(changed, libvirtmock.UUID_ORIGIN)
+            self.assertEqual(prepare.call_count, 3)
+
+            # Template is prepared again when video driver changes
+            self.ctrlr._libvirt_video_driver = "qxl"
+            self.generate(changed, libvirtmock.UUID_ORIGIN)
+            self.assertEqual(prepare.call_count, 4)
+
+        self.assertNotIn("52:54:00:fc:b6:d1", first)
+        self.assertIn(str(uuid.UUID(int=1)), first)
+        self.assertIn('passwd="Secret123"', first)
+
+    def test_template_cache_size(self):
+        self.ctrlr.TEMPLATE_CACHE_SIZE = 2
+        for identifier in ("a", "b", "c"):
+            self.generate(libvirtmock.XML_ORIG, identifier)
+        cache = libvirtcontroller.LibVirtController._template_cache
+        self.assertEqual([key[0] for key in cache], ["b", "c"])
+
+    def test_benchmark_large_domain(self):
+        xmldata = self.get_large_domain_xml()
+
+        started = time.perf_counter()
+        for _i in range(self.BENCHMARK_ROUNDS):
+            uncached = self.generate(xmldata)
+        uncached_time = time.perf_counter() - started
+
+        # Warm cache
+        self.generate(xmldata, libvirtmock.UUID_ORIGIN)
+        started = time.perf_counter()
+        for _i in range(self.BENCHMARK_ROUNDS):
+            cached = self.generate(xmldata, libvirtmock.UUID_ORIGIN)
+        cached_time = time.perf_counter() - started
+
+        logger.info(
+            "Domain XML with %s devices, %s rounds: uncached %.4fs, cached %.4fs",
+            self.BENCHMARK_DEVICES * 2,
+            self.BENCHMARK_ROUNDS,
+            uncached_time,
+            cached_time,
+        )
+        self.assertEqual(cached, uncached)
+        self.assertLess(cached_time, uncached_time)
+
+
+class TestDomainInventory(unittest.TestCase):
+    """Domain inventory kept by libvirt events."""
+
+    maxDiff = None
+
+    def setUp(self):
+        self.test_directory = tempfile.mkdtemp(prefix="fc-libvirt-test-inventory-")
+        os.environ["FC_TEST_DIRECTORY"] = self.test_directory
+        os.environ["FC_TEST_USE_QXL"] = "0"
+        self.ctrlr = libvirtcontroller.controller(
+            viewer_type="spice_html5",
+            data_path=self.test_directory,
+            username="testuser",
+            hostname="localhost",
+            mode="system",
+        )
+        self.inventory = libvirtcontroller.DomainInventory(self.ctrlr)
+        libvirtcontroller.LibVirtController._title_cache.clear()
+
+    def tearDown(self):
+        shutil.rmtree(self.test_directory)
+
+    def get_domain(self, identifier):
+        return self.ctrlr.conn.lookupByUUIDString(identifier)
+
+    def test_inventory(self):
+        self.assertListEqual(self.inventory.domains(), EXPECTED_DOMAIN_LIST)
+
+        # Inventory is served from memory
+        libvirtmock.RPC_CALLS.clear()
+        self.assertListEqual(self.inventory.domains(), EXPECTED_DOMAIN_LIST)
+        self.assertTrue(
+            self.inventory.is_active(libvirtmock.UUID_TEMPORARY_SPICE_HTML5)
+        )
+        self.assertFalse(self.inventory.is_active("unknown"))
+        self.assertEqual(libvirtmock.RPC_CALLS, {})
+
+    def test_lifecycle_events(self):
+        self.inventory.domains()
+        conn = self.ctrlr.conn
+
+        # Stopped template domain is kept as inactive
+        conn.emit_domain_event(
+            self.get_domain(libvirtmock.UUID_ORIGIN),
+            libvirtmock.LibvirtModuleMocker.VIR_DOMAIN_EVENT_STOPPED,
+        )
+        self.assertFalse(self.inventory.is_active(libvirtmock.UUID_ORIGIN))
+        conn.emit_domain_event(
+            self.get_domain(libvirtmock.UUID_ORIGIN),
+            libvirtmock.LibvirtModuleMocker.VIR_DOMAIN_EVENT_STARTED,
+        )
+        self.assertTrue(self.inventory.is_active(libvirtmock.UUID_ORIGIN))
+
+        # Stopped temporary domain is removed
+        conn.emit_domain_event(
+            self.get_domain(libvirtmock.UUID_TEMPORARY_SPICE_HTML5),
+            libvirtmock.LibvirtModuleMocker.VIR_DOMAIN_EVENT_STOPPED,
+        )
+        self.assertFalse(
+            self.inventory.is_active(libvirtmock.UUID_TEMPORARY_SPICE_HTML5)
+        )
+        self.assertNotIn(
+            libvirtmock.UUID_TEMPORARY_SPICE_HTML5,
+            [d["uuid"] for d in self.inventory.domains()],
+        )
+
+        # Undefined active domain is removed once stopped
+        conn.emit_domain_event(
+            self.get_domain(libvirtmock.UUID_NO_SPICE),
+            libvirtmock.LibvirtModuleMocker.VIR_DOMAIN_EVENT_UNDEFINED,
+        )
+        self.assertTrue(self.inventory.is_active(libvirtmock.UUID_NO_SPICE))
+        conn.emit_domain_event(
+            self.get_domain(libvirtmock.UUID_NO_SPICE),
+            libvirtmock.LibvirtModuleMocker.VIR_DOMAIN_EVENT_STOPPED,
+        )
+        self.assertNotIn(
+            libvirtmock.UUID_NO_SPICE,
+            [d["uuid"] for d in self.inventory.domains()],
+        )
+
+    def test_new_domain_resync(self):
+        self.inventory.domains()
+        newdomain = self.ctrlr.conn.createXML(
+            libvirtmock.XML_MODIF_HTML5
+            % {"name-uuid": "44444444", "uuid": "44444444-722d-45d9-b66c-fefb33235a98"}
+        )
+        self.ctrlr.conn.emit_domain_event(
+            newdomain, libvirtmock.LibvirtModuleMocker.VIR_DOMAIN_EVENT_STARTED
+        )
+
+        libvirtmock.RPC_CALLS.clear()
+        self.assertTrue(self.inventory.is_active(newdomain.UUIDString()))
+        self.assertEqual(libvirtmock.RPC_CALLS, {"listAllDomains": 2, "metadata": 1})
+
+    def test_connection_closed(self):
+        self.inventory.domains()
+        conn = self.ctrlr.conn
+        conn.emit_close()
+
+        # Inventory reconnects and resyncs
+        libvirtmock.RPC_CALLS.clear()
+        self.assertListEqual(self.inventory.domains(), EXPECTED_DOMAIN_LIST)
+        self.assertIsNot(self.ctrlr.conn, conn)
+        self.assertEqual(libvirtmock.RPC_CALLS["listAllDomains"], 2)
+
+    def test_periodic_resync(self):
+        self.inventory.domains()
+        self.inventory.RESYNC_INTERVAL = 0
+        libvirtmock.RPC_CALLS.clear()
+        self.inventory.domains()
+        self.assertEqual(libvirtmock.RPC_CALLS["listAllDomains"], 2)
+
+    def test_close(self):
+        self.inventory.domains()
+        conn = self.ctrlr.conn
+        self.inventory.close()
+
+        # Callbacks are deregistered and connection is closed
+        self.assertEqual(conn.event_callbacks, {})
+        self.assertIsNone(conn.close_callback)
+        self.assertTrue(conn.closed)
+        self.assertIsNone(self.ctrlr.conn)
+
+        # Closed inventory reconnects on next use
+        self.assertListEqual(self.inventory.domains(), EXPECTED_DOMAIN_LIST)
+        self.assertIsNot(self.ctrlr.conn, conn)
+
+
 if __name__ == "__main__":
     logging.basicConfig(level=logging.DEBUG)
     unittest.main(verbosity=2)
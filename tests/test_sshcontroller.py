@@ -21,14 +21,20 @@
 #          Oliver Gutiérrez <ogutierrez@redhat.com>
 
 from __future__ import absolute_import
+import base64
+import hashlib
+import hmac
 import os
 import logging
 import tempfile
 import shutil
+import time
 import unittest
 
 from fleetcommander import sshcontroller
 from tests import (
+    SSH_TEST_PUBLIC_KEY,
+    SSH_TEST_FINGERPRINT,
     SSH_TUNNEL_OPEN_PARMS,
     SSH_TUNNEL_CLOSE_PARMS,
     SSH_REMOTE_COMMAND_PARMS,
@@ -41,8 +47,9 @@ class TestSSHController(unittest.TestCase):
 
     SSH_KEYGEN_PARMS = "-b 2048 -t rsa -f %s -q -N\n"
     SSH_KEYSCAN_PARMS = "-p %s %s\n"
-    SSH_KEYSCAN_OUTPUT = "%s ssh-rsa KEY\n"
-    SSH_KEYGEN_FINGERPRINT_OUTPUT = "2048 SHA256:HASH localhost (RSA)\n"
+    SSH_KEYSCAN_OUTPUT = "%s " + SSH_TEST_PUBLIC_KEY + "\n"
+    SSH_KEYGEN_FINGERPRINT_OUTPUT = SSH_TEST_FINGERPRINT + " localhost (RSA)\n"
+    BENCHMARK_KNOWN_HOSTS = 50000
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -99,6 +106,29 @@ class TestSSHController(unittest.TestCase):
 
         self.assertEqual(parms, self.SSH_KEYSCAN_PARMS % (port, hostname))
 
+    def test_01_scan_host_keys_timeout(self):
+        ssh = sshcontroller.SSHController()
+        keys = ssh.scan_host_keys("localhost", "2022", timeout=5)
+        self.assertEqual(keys, self.SSH_KEYSCAN_OUTPUT % "localhost")
+        with open(self.ssh_keyscan_parms_file, encoding="utf-8") as fd:
+            parms = fd.read()
+        self.assertEqual(parms, "-p 2022 -T 5 localhost\n")
+
+    def test_01_scan_hosts_keys(self):
+        ssh = sshcontroller.SSHController()
+        hosts = [("host%s" % i, 22) for i in range(10)]
+        keys, errors = ssh.scan_hosts_keys(hosts, timeout=5, max_workers=4)
+        self.assertEqual(errors, {})
+        self.assertEqual(
+            keys, {host: self.SSH_KEYSCAN_OUTPUT % host[0] for host in hosts}
+        )
+
+        # Scan errors are reported by host
+        ssh.SSH_KEYSCAN_COMMAND = "false"
+        keys, errors = ssh.scan_hosts_keys(hosts[:2])
+        self.assertEqual(keys, {})
+        self.assertEqual(list(errors), hosts[:2])
+
     def test_02_add_known_host(self):
         ssh = sshcontroller.SSHController()
         hostname = "localhost"
@@ -148,11 +178,172 @@ class TestSSHController(unittest.TestCase):
         result = ssh.check_known_host(self.known_hosts_file, hostname)
         self.assertTrue(result)
 
+    def hash_host(self, name):
+        salt = os.urandom(20)
+        digest = hmac.new(salt, name.encode(), hashlib.sha1).digest()
+        return "|1|{}|{}".format(
+            base64.b64encode(salt).decode(), base64.b64encode(digest).decode()
+        )
+
+    def test_03_check_known_host_formats(self):
+        ssh = sshcontroller.SSHController()
+        with open(self.known_hosts_file, "w", encoding="utf-8") as fd:
+            fd.write(
+                "\n".join(
+                    [
+                        "# Comment line",
+                        "",
+                        "invalidline ssh-rsa",
+                        "@cert-authority *.example.com ssh-rsa KEY",
+                        "@revoked revoked.example.com ssh-rsa KEY",
+                        "Host1,192.168.0.1 ssh-rsa KEY",
+                        "[porthost]:2022 ssh-ed25519 KEY comment",
+                        "%s ssh-rsa KEY" % self.hash_host("hashedhost"),
+                        "%s ssh-rsa KEY" % self.hash_host("[hashedhost]:2022"),
+                        "*.example.org,!bad.example.org ssh-rsa KEY",
+                        "incomplete",
+                    ]
+                )
+            )
+
+        def check(hostname, port=22):
+            return ssh.check_known_host(self.known_hosts_file, hostname, port)
+
+        self.assertTrue(check("host1"))
+        self.assertTrue(check("192.168.0.1"))
+        self.assertFalse(check("invalidline"))
+        self.assertFalse(check("www.example.com"))
+        self.assertFalse(check("revoked.example.com"))
+        # Ports
+        self.assertTrue(check("porthost", "2022"))
+        self.assertFalse(check("porthost"))
+        self.assertFalse(check("host1", 2022))
+        # Hashed hosts
+        self.assertTrue(check("hashedhost"))
+        self.assertTrue(check("hashedhost", 2022))
+        self.assertFalse(check("hashedhost", 2222))
+        # Patterns
+        self.assertTrue(check("www.example.org"))
+        self.assertFalse(check("bad.example.org"))
+        # Incomplete line is not parsed until finished
+        self.assertFalse(check("incomplete"))
+        ssh.add_keys_to_known_hosts(self.known_hosts_file, " ssh-rsa KEY\n")
+        self.assertTrue(check("incomplete"))
+
+    def test_03_check_known_host_incremental(self):
+        ssh = sshcontroller.SSHController()
+        ssh.add_keys_to_known_hosts(self.known_hosts_file, "host1 ssh-rsa KEY\n")
+        index = ssh.get_known_hosts_index(self.known_hosts_file)
+        self.assertTrue(ssh.check_known_host(self.known_hosts_file, "host1"))
+        self.assertEqual(index.entries, 1)
+
+        # Appended keys are indexed without parsing the file again
+        ssh.add_keys_to_known_hosts(self.known_hosts_file, "host2 ssh-rsa KEY\n")
+        self.assertEqual(index.entries, 2)
+        self.assertTrue(ssh.check_known_host(self.known_hosts_file, "host1"))
+        self.assertTrue(ssh.check_known_host(self.known_hosts_file, "host2"))
+
+        # Replaced file is parsed again
+        newfile = self.known_hosts_file + ".new"
+        with open(newfile, "w", encoding="utf-8") as fd:
+            fd.write("host3 ssh-rsa KEY\n")
+        os.replace(newfile, self.known_hosts_file)
+        self.assertFalse(ssh.check_known_host(self.known_hosts_file, "host1"))
+        self.assertTrue(ssh.check_known_host(self.known_hosts_file, "host3"))
+        self.assertEqual(index.entries, 1)
+
+        # Removed file
+        os.remove(self.known_hosts_file)
+        self.assertFalse(ssh.check_known_host(self.known_hosts_file, "host3"))
+
+    def test_03_check_known_host_benchmark(self):
+        ssh = sshcontroller.SSHController()
+        hashed = self.BENCHMARK_KNOWN_HOSTS // 10
+        with open(self.known_hosts_file, "w", encoding="utf-8") as fd:
+            for i in range(self.BENCHMARK_KNOWN_HOSTS - hashed):
+                fd.write("host%s.example.com,10.0.%s.%s ssh-rsa KEY\n" % (i, i, i))
+            for i in range(hashed):
+                fd.write("%s ssh-rsa KEY\n" % self.hash_host("hashed%s" % i))
+
+        started = time.perf_counter()
+        self.assertTrue(
+            ssh.check_known_host(self.known_hosts_file, "host49.example.com")
+        )
+        first_time = time.perf_counter() - started
+
+        started = time.perf_counter()
+        for i in range(1000):
+            self.assertTrue(
+                ssh.check_known_host(self.known_hosts_file, "host%s.example.com" % i)
+            )
+        cached_time = time.perf_counter() - started
+
+        started = time.perf_counter()
+        ssh.add_keys_to_known_hosts(self.known_hosts_file, "newhost ssh-rsa KEY\n")
+        self.assertTrue(ssh.check_known_host(self.known_hosts_file, "newhost"))
+        append_time = time.perf_counter() - started
+
+        logger.info(
+            "Known hosts with %s lines: first lookup %.4fs, "
+            "1000 lookups %.4fs, append and lookup %.4fs",
+            self.BENCHMARK_KNOWN_HOSTS,
+            first_time,
+            cached_time,
+            append_time,
+        )
+        index = ssh.get_known_hosts_index(self.known_hosts_file)
+        self.assertEqual(index.entries, self.BENCHMARK_KNOWN_HOSTS + 1)
+        self.assertLess(append_time, first_time)
+
     def test_04_get_fingerprint_from_key_data(self):
         ssh = sshcontroller.SSHController()
-        key_data = "KEY DATA"
+        key_data = self.SSH_KEYSCAN_OUTPUT % "localhost"
         fprints = ssh.get_fingerprint_from_key_data(key_data)
         self.assertEqual(fprints, self.SSH_KEYGEN_FINGERPRINT_OUTPUT)
+        # Public key format
+        fprints = ssh.get_fingerprint_from_key_data(SSH_TEST_PUBLIC_KEY)
+        self.assertEqual(fprints, SSH_TEST_FINGERPRINT + " no comment (RSA)\n")
+        fprints = ssh.get_fingerprint_from_key_data(SSH_TEST_PUBLIC_KEY + " me@host")
+        self.assertEqual(fprints, SSH_TEST_FINGERPRINT + " me@host (RSA)\n")
+        # MD5 hashes
+        fprints = ssh.get_fingerprint_from_key_data(key_data, hash_type="md5")
+        self.assertEqual(
+            fprints,
+            "2048 MD5:bf:c8:54:7b:5d:8f:47:87:c4:87:23:a1:d1:0f:2a:9d localhost (RSA)\n",
+        )
+
+    def test_04_get_fingerprint_from_key_data_types(self):
+        ssh = sshcontroller.SSHController()
+        key_data = "\n".join(
+            [
+                "# localhost:22 SSH-2.0-OpenSSH",
+                "localhost ssh-ed25519 "
+                "AAAAC3NzaC1lZDI1NTE5AAAAIINPFlnS4Vjptie9UG3RsPQaVf0IZHJ8wLptMluU5pqV",
+                "localhost ecdsa-sha2-nistp384 "
+                "AAAAE2VjZHNhLXNoYTItbmlzdHAzODQAAAAIbmlzdHAzODQAAABhBHVX5/IWx5h7ye+0"
+                "LH6zoLkQfhJpKpXbf5gWPXsBWhmBx/GYw2ICt2WRxRMGfOSIN8rDR9Pu05dXPF8k5PXd"
+                "TWA90WY5w1X7oXDgWquM4VIC/HIklOZ83vuRiOBkcz0lIQ==",
+            ]
+        )
+        fprints = ssh.get_fingerprint_from_key_data(key_data)
+        self.assertEqual(
+            fprints,
+            "256 SHA256:ubMhtkZQ0J5p++vDD9Wp6V071D9ClyU4tDWS3qIgQSE localhost (ED25519)\n"
+            "384 SHA256:4QjWixY4riP16O/yE0T4fEqyJ1toZyZN6M8vhS9HF6E localhost (ECDSA)\n",
+        )
+
+        # Invalid key data
+        for key_data in (
+            "",
+            "KEY DATA",
+            "localhost ssh-rsa KEY",
+            "localhost ssh-ed25519 " + SSH_TEST_PUBLIC_KEY.split()[1],
+        ):
+            with self.assertRaisesRegex(
+                sshcontroller.SSHControllerException,
+                "Error generating fingerprint from key data",
+            ):
+                ssh.get_fingerprint_from_key_data(key_data)
 
     def test_05_get_host_fingerprint(self):
         ssh = sshcontroller.SSHController()
@@ -233,7 +424,7 @@ class TestSSHController(unittest.TestCase):
             SSH_TUNNEL_OPEN_PARMS.format(
                 local_forward=f"{local_port}:{tunnel_host}:{tunnel_port}",
                 username=username,
-                user_home=os.path.expanduser("~"),
+                control_socket=ssh.CONTROL_SOCKET,
                 hostname=hostname,
                 port=port,
                 private_key_file=self.private_key_file,
@@ -270,7 +461,7 @@ class TestSSHController(unittest.TestCase):
             parms,
             SSH_TUNNEL_CLOSE_PARMS.format(
                 username=username,
-                user_home=os.path.expanduser("~"),
+                control_socket=ssh.CONTROL_SOCKET,
                 hostname=hostname,
                 port=port,
                 private_key_file=self.private_key_file,
@@ -291,10 +482,18 @@ class TestSSHController(unittest.TestCase):
         with self.assertRaisesRegex(
             sshcontroller.SSHControllerException, "Invalid credentials"
         ):
-            ssh.install_pubkey("PUBKEY", "username", "badpassword", "localhost", 22)
+            ssh.install_pubkey(
+                SSH_TEST_PUBLIC_KEY, "username", "badpassword", "localhost", 22
+            )
+
+        # Use invalid public key
+        with self.assertRaisesRegex(
+            sshcontroller.SSHControllerException, "Error generating fingerprint"
+        ):
+            ssh.install_pubkey("PUBKEY", "username", "password", "localhost", 22)
 
         # Use correct credentials (no exception raising)
-        ssh.install_pubkey("PUBKEY", "username", "password", "localhost", 22)
+        ssh.install_pubkey(SSH_TEST_PUBLIC_KEY, "username", "password", "localhost", 22)
 
 
 if __name__ == "__main__":
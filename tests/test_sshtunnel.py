@@ -0,0 +1,262 @@
+#!/usr/bin/env python-wrapper.sh
+# -*- coding: utf-8 -*-
+# vi:ts=2 sw=2 sts=2
+
+# Copyright (C) 2021 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the licence, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program; if not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import
+import os
+import logging
+import signal
+import socket
+import tempfile
+import shutil
+import unittest
+import unittest.mock
+
+from fleetcommander import sshcontroller
+from fleetcommander import sshtunnel
+from tests import (
+    SSH_TUNNEL_SUPERVISED_PARMS,
+    SSH_TUNNEL_CLOSE_PARMS,
+)
+
+logger = logging.getLogger(os.path.basename(__file__))
+
+
+class TestSSHTunnelManager(unittest.TestCase):
+
+    maxDiff = None
+
+    USERNAME = "testuser"
+    HOSTNAME = "localhost"
+    PORT = "2022"
+    REMOTE = "/run/user/1001/fc-session-notifier.socket"
+
+    def setUp(self):
+        self.test_directory = tempfile.mkdtemp(prefix="fc-ssh-tunnel-test")
+
+        self.ssh_parms_file = os.path.join(self.test_directory, "ssh-parms")
+        self.known_hosts_file = os.path.join(self.test_directory, "known_hosts")
+        self.private_key_file = os.path.join(self.test_directory, "id_rsa")
+        self.control_socket = os.path.join(self.test_directory, "control.socket")
+        self.local_socket = os.path.join(self.test_directory, "notifier.socket")
+
+        # Set environment for commands execution
+        os.environ["FC_TEST_DIRECTORY"] = self.test_directory
+
+        self.manager = sshtunnel.SSHTunnelManager(sshcontroller.SSHController())
+
+    def tearDown(self):
+        self.manager.close_all()
+        # Remove test directory
+        shutil.rmtree(self.test_directory)
+
+    def open_tunnel(self):
+        self.manager.open_tunnel(
+            ["{}:{}".format(self.local_socket, self.REMOTE)],
+            self.private_key_file,
+            self.USERNAME,
+            self.HOSTNAME,
+            self.PORT,
+            control_socket=self.control_socket,
+            UserKnownHostsFile=self.known_hosts_file,
+        )
+        return self.manager._tunnels[self.control_socket]
+
+    def test_00_open_tunnel(self):
+        tunnel = self.open_tunnel()
+
+        self.assertTrue(tunnel.is_alive())
+
+        with open(self.ssh_parms_file, encoding="utf-8") as fd:
+            parms = fd.read().strip()
+
+        self.assertEqual(
+            parms,
+            SSH_TUNNEL_SUPERVISED_PARMS.format(
+                local_forward=f"{self.local_socket}:{self.REMOTE}",
+                username=self.USERNAME,
+                control_socket=self.control_socket,
+                hostname=self.HOSTNAME,
+                port=self.PORT,
+                private_key_file=self.private_key_file,
+                optional_args=" ".join(
+                    [
+                        "-o",
+                        f"UserKnownHostsFile={self.known_hosts_file}",
+                        "-o",
+                        "ServerAliveInterval=15",
+                        "-o",
+                        "ServerAliveCountMax=3",
+                        "-o",
+                        "StreamLocalBindUnlink=yes",
+                    ]
+                ),
+            ),
+        )
+
+    def test_01_stats(self):
+        tunnel = self.open_tunnel()
+
+        stats = self.manager.get_stats(self.control_socket)
+        self.assertEqual(stats["pid"], tunnel.pid)
+        self.assertTrue(stats["alive"])
+        self.assertEqual(stats["restarts"], 0)
+        self.assertEqual(stats["failures"], 0)
+        self.assertEqual(stats["forwards"], [self.local_socket])
+        self.assertGreater(stats["bytes_read"], 0)
+        self.assertGreater(stats["bytes_written"], 0)
+        self.assertIsNone(stats["latency"])
+        self.assertIsNone(stats["probed"])
+        self.assertEqual(stats["probe_failures"], 0)
+        self.assertEqual(
+            self.manager.get_forwards(self.control_socket),
+            ["{}:{}".format(self.local_socket, self.REMOTE)],
+        )
+
+    def test_02_close_all(self):
+        tunnel = self.open_tunnel()
+        # Local socket left behind as if SSH was killed
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.bind(self.local_socket)
+
+        self.manager.close_all()
+
+        self.assertFalse(tunnel.is_alive())
+        self.assertFalse(os.path.exists(self.local_socket))
+        self.assertIsNone(self.manager.get_stats(self.control_socket))
+
+    def test_03_restart_dead_tunnel(self):
+        tunnel = self.open_tunnel()
+        pid = tunnel.pid
+
+        # Alive tunnels are left untouched
+        self.manager.check_tunnels()
+        self.assertEqual(tunnel.pid, pid)
+
+        os.kill(pid, signal.SIGKILL)
+        tunnel._prog.wait()
+        self.manager.check_tunnels()
+
+        self.assertTrue(tunnel.is_alive())
+        self.assertNotEqual(tunnel.pid, pid)
+        self.assertEqual(tunnel.restarts, 1)
+
+    def test_04_restart_error(self):
+        tunnel = self.open_tunnel()
+        os.kill(tunnel.pid, signal.SIGKILL)
+        tunnel._prog.wait()
+
+        # Restart fails while control socket does not show up
+        tunnel.READY_TIMEOUT = 0
+        with unittest.mock.patch.object(os.path, "exists", return_value=False):
+            self.manager.check_tunnels()
+        self.assertEqual(tunnel.failures, 1)
+        self.assertGreater(tunnel.next_restart, 0)
+
+        # Tunnel is not restarted again until backoff delay expires
+        self.manager.check_tunnels()
+        self.assertEqual(tunnel.restarts, 1)
+
+    def test_05_close_tunnel(self):
+        tunnel = self.open_tunnel()
+
+        self.manager.close_tunnel(
+            self.private_key_file,
+            self.USERNAME,
+            self.HOSTNAME,
+            self.PORT,
+            control_socket=self.control_socket,
+            UserKnownHostsFile=self.known_hosts_file,
+        )
+
+        self.assertFalse(tunnel.is_alive())
+        self.assertFalse(os.path.exists(self.local_socket))
+        self.assertIsNone(self.manager.get_stats(self.control_socket))
+
+        # SSH was asked to exit gracefully
+        with open(self.ssh_parms_file, encoding="utf-8") as fd:
+            parms = fd.read().strip()
+
+        self.assertEqual(
+            parms,
+            SSH_TUNNEL_CLOSE_PARMS.format(
+                username=self.USERNAME,
+                control_socket=self.control_socket,
+                hostname=self.HOSTNAME,
+                port=self.PORT,
+                private_key_file=self.private_key_file,
+                optional_args=" ".join(
+                    [
+                        "-o",
+                        f"UserKnownHostsFile={self.known_hosts_file}",
+                    ]
+                ),
+            ),
+        )
+
+        # Closed tunnels are not restarted
+        self.manager.check_tunnels()
+        self.assertFalse(tunnel.is_alive())
+
+    def test_06_probe(self):
+        tunnel = self.open_tunnel()
+
+        # Alive tunnels are probed once per interval
+        self.manager.check_tunnels()
+        stats = self.manager.get_stats(self.control_socket)
+        self.assertGreaterEqual(stats["latency"], 0)
+        self.assertIsNotNone(stats["probed"])
+        with unittest.mock.patch.object(tunnel, "probe") as probe:
+            self.manager.check_tunnels()
+            probe.assert_not_called()
+
+        # Probe runs a no-op command through the SSH connection
+        with open(self.ssh_parms_file, encoding="utf-8") as fd:
+            parms = fd.read().strip()
+        self.assertEqual(
+            parms,
+            "-o ControlMaster=no -o BatchMode=yes -S {} {}@{} -p {} true".format(
+                self.control_socket, self.USERNAME, self.HOSTNAME, self.PORT
+            ),
+        )
+
+        latency = tunnel.latency
+        with unittest.mock.patch.object(tunnel.ssh, "SSH_COMMAND", "false"):
+            self.assertFalse(tunnel.probe())
+        self.assertEqual(tunnel.probe_failures, 1)
+        self.assertEqual(tunnel.latency, latency)
+
+    def test_07_traffic_kept_on_restart(self):
+        tunnel = self.open_tunnel()
+        bytes_read, bytes_written = tunnel.get_traffic()
+
+        os.kill(tunnel.pid, signal.SIGKILL)
+        tunnel._prog.wait()
+        # Counters of dead process are kept
+        self.assertEqual(tunnel.get_traffic(), (bytes_read, bytes_written))
+
+        self.manager.check_tunnels()
+        self.assertTrue(tunnel.is_alive())
+        restarted_read, restarted_written = tunnel.get_traffic()
+        self.assertGreater(restarted_read, bytes_read)
+        self.assertGreater(restarted_written, bytes_written)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.DEBUG)
+    unittest.main(verbosity=2)